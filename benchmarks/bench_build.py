@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of docker-build-ami without AWS or a network.
+
+EC2 is replaced by the in-memory fakes in fake_ec2.py and the builder by the
+in-process SSH server in ssh_server.py, then main_with_args() runs against a
+fixture directory or a synthetic build context. The report shows the wall
+time spent in each phase of the build, the per-step SSH overhead and the
+upload throughput.
+
+Examples:
+
+    python benchmarks/bench_build.py --fixture coco-dev
+    python benchmarks/bench_build.py --synthetic-files 2000 \\
+        --synthetic-size 65536 --synthetic-steps 50 --repeat 3
+"""
+
+import argparse
+import collections
+import contextlib
+import functools
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from docker2ami import ami_builder, build_log, docker2ami, \
+    sessions  # noqa: E402
+from fake_ec2 import FakeBoto3, FakeEc2  # noqa: E402
+from ssh_server import LocalSshServer  # noqa: E402
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests',
+                            'docker2ami', 'fixtures')
+
+CONFIG_TEMPLATE = '''[main]
+image_name = bench
+image_id = ami-00000000
+image_user = bench
+region = us-west-1
+aws_access_key_id = BENCHMARKACCESSKEY
+aws_secret_access_key = benchmark-secret-access-key
+tmp_dir = {tmp_dir}
+history_file = {tmp_dir}/history.db
+'''
+
+# AmiBuilder methods whose wall time is reported, as (attribute, phase)
+PHASES = (
+    ('start', 'launch'),
+    ('send_archive', 'context'),
+    ('run_cmd', 'step'),
+    ('save_image', 'save'),
+    ('finish', 'teardown'),
+)
+
+# Order of the phases in the report, upload being part of context
+REPORT_ORDER = ('preflight', 'launch', 'context', 'upload', 'step', 'save',
+                'teardown')
+
+
+class PhaseTimer(object):
+    """ Accumulates the wall time of every call to the patched methods """
+    def __init__(self):
+        self.durations = collections.defaultdict(list)
+        self.uploaded_bytes = 0
+
+    def wrap(self, phase, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.durations[phase].append(time.perf_counter() - start)
+        return wrapper
+
+    @contextlib.contextmanager
+    def patched(self):
+        with contextlib.ExitStack() as stack:
+            for name, phase in PHASES:
+                fn = getattr(ami_builder.AmiBuilder, name)
+                stack.enter_context(mock.patch.object(
+                    ami_builder.AmiBuilder, name, self.wrap(phase, fn)))
+            stack.enter_context(mock.patch.object(
+                docker2ami, 'run_preflight',
+                self.wrap('preflight', docker2ami.run_preflight)))
+            put = paramiko.SFTPClient.put
+
+            def counting_put(sftp, localpath, *args, **kwargs):
+                self.uploaded_bytes += os.path.getsize(localpath)
+                return put(sftp, localpath, *args, **kwargs)
+            stack.enter_context(mock.patch.object(
+                paramiko.SFTPClient, 'put',
+                self.wrap('upload', counting_put)))
+            yield
+
+
+def create_synthetic_context(path, files, size, steps):
+    """
+    Creates a build context with files random files of size bytes and a
+    Dockerfile that copies them and then runs steps trivial RUN steps
+    """
+    data_dir = os.path.join(path, 'data')
+    os.makedirs(data_dir)
+    for ii in range(files):
+        with open(os.path.join(data_dir, f'file{ii:06d}.bin'), 'wb') as f:
+            f.write(os.urandom(size))
+    with open(os.path.join(path, 'Dockerfile'), 'w') as f:
+        f.write('FROM ubuntu:18.04\n')
+        f.write('ENV BENCH=1\n')
+        f.write('COPY data /opt/data\n')
+        for ii in range(steps):
+            f.write(f'RUN echo step {ii}\n')
+
+
+def run_build(context_dir, config_path, ssh_server, fake_ec2, timer):
+    """ Runs main_with_args() in context_dir against the fakes """
+    connect = paramiko.SSHClient.connect
+
+    def local_connect(client, hostname, *args, **kwargs):
+        kwargs['port'] = ssh_server.port
+        return connect(client, hostname, *args, **kwargs)
+
+    start_dir = os.getcwd()
+    os.chdir(context_dir)
+    devnull = open(os.devnull, 'w')
+    try:
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch.object(
+                sessions, 'boto3', FakeBoto3(fake_ec2)))
+            stack.enter_context(mock.patch.object(
+                ami_builder, 'default_factory', sessions.SessionFactory()))
+            stack.enter_context(mock.patch.object(
+                ami_builder, '_check_port',
+                lambda host, port: True))
+            stack.enter_context(mock.patch.object(
+                paramiko.SSHClient, 'connect', local_connect))
+            stack.enter_context(mock.patch.object(
+                ami_builder, 'stdout', devnull))
+            stack.enter_context(mock.patch.object(
+                build_log, 'stdout', devnull))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+            stack.enter_context(timer.patched())
+            start = time.perf_counter()
+            docker2ami.main_with_args(['-c', config_path])
+            return time.perf_counter() - start
+    finally:
+        devnull.close()
+        os.chdir(start_dir)
+
+
+def print_report(name, walls, timer, fake_ec2, ssh_server):
+    runs = len(walls)
+    print(f'\n{name}: {runs} run(s), '
+          f'mean wall time {sum(walls) / runs:.3f}s')
+    print(f'  {"phase":<10} {"calls":>7} {"total s":>10} {"mean ms":>10}')
+    for phase in REPORT_ORDER:
+        durations = timer.durations.get(phase, [])
+        if not durations:
+            continue
+        total = sum(durations)
+        print(f'  {phase:<10} {len(durations) // runs:>7} '
+              f'{total / runs:>10.3f} '
+              f'{1000 * total / len(durations):>10.2f}')
+    upload = sum(timer.durations.get('upload', []))
+    if upload:
+        print(f'  upload throughput: '
+              f'{timer.uploaded_bytes / upload / 2 ** 20:.1f} MiB/s '
+              f'({timer.uploaded_bytes // runs} bytes per run)')
+    print(f'  SSH exec requests per run: {ssh_server.exec_count // runs}')
+    print('  EC2 API calls per run: ' + ', '.join(
+        f'{op}={count // runs}'
+        for op, count in sorted(fake_ec2.calls.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--fixture', action='append', default=[],
+                        help='Fixture directory in tests/docker2ami/fixtures '
+                             'to build (may be repeated)')
+    parser.add_argument('--synthetic-files', type=int, default=0,
+                        help='Also build a synthetic context with this many '
+                             'files')
+    parser.add_argument('--synthetic-size', type=int, default=16384,
+                        help='Size in bytes of each synthetic file')
+    parser.add_argument('--synthetic-steps', type=int, default=20,
+                        help='Number of RUN steps in the synthetic '
+                             'Dockerfile')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of builds per context')
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='Simulated latency of each EC2 API call in '
+                             'seconds')
+    parser.add_argument('--archive-format', choices=('tar.gz', 'indexed'),
+                        default='tar.gz',
+                        help='Format of the build context archive')
+    parser.add_argument('--cache-volume', action='store_true',
+                        help='Build with a cache volume')
+    parser.add_argument('--direct-copy', action='store_true',
+                        help='Build with direct_copy enabled')
+    parser.add_argument('--reuse-image', action='store_true',
+                        help='Build with reuse_image enabled, so the '
+                             'repeated builds reuse the first AMI')
+    parser.add_argument('--execute', action='store_true',
+                        help='Really run the Dockerfile commands on this '
+                             'machine instead of discarding them')
+    args = parser.parse_args()
+
+    # The builder never closes its connection, which the server side of
+    # paramiko reports as an error when the build ends
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    if not args.fixture and not args.synthetic_files:
+        args.fixture = ['coco-dev']
+
+    work_dir = tempfile.mkdtemp(prefix='docker-build-ami-bench-')
+    try:
+        config_path = os.path.join(work_dir, 'docker-build-ami.conf')
+        with open(config_path, 'w') as f:
+            f.write(CONFIG_TEMPLATE.format(tmp_dir=work_dir))
+            f.write(f'archive_format = {args.archive_format}\n')
+            if args.direct_copy:
+                f.write('direct_copy = true\n')
+            if args.cache_volume:
+                f.write('cache_volume = bench\n')
+            if args.reuse_image:
+                f.write('reuse_image = true\n')
+
+        contexts = [(fixture, os.path.join(FIXTURES_DIR, fixture))
+                    for fixture in args.fixture]
+        if args.synthetic_files:
+            synthetic_dir = os.path.join(work_dir, 'synthetic')
+            create_synthetic_context(
+                synthetic_dir, args.synthetic_files, args.synthetic_size,
+                args.synthetic_steps)
+            contexts.append((
+                f'synthetic ({args.synthetic_files} x '
+                f'{args.synthetic_size} bytes, '
+                f'{args.synthetic_steps} steps)', synthetic_dir))
+
+        for name, context_dir in contexts:
+            fake_ec2 = FakeEc2(api_latency=args.api_latency)
+            timer = PhaseTimer()
+            with LocalSshServer(execute=args.execute) as ssh_server:
+                walls = [run_build(context_dir, config_path, ssh_server,
+                                   fake_ec2, timer)
+                         for _ in range(args.repeat)]
+                print_report(name, walls, timer, fake_ec2, ssh_server)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
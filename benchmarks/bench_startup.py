@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Startup benchmark of the docker-build-ami command line.
+
+Every command runs in a new Python process, the way the console script runs,
+and the report shows its wall time and which of the heavy dependencies it
+imported. Commands that do not build, such as --help or plan, should not pay
+for importing boto3 and paramiko, nor sqlite3 and http.server.
+
+Examples:
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 20 --import-time
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), '..', 'src')
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests',
+                            'docker2ami', 'fixtures')
+
+# Modules whose import is reported
+HEAVY_MODULES = ('boto3', 'botocore', 'paramiko', 'cryptography', 'sqlite3',
+                 'http.server')
+
+# Prints the heavy modules imported once the interpreter exits
+REPORT_IMPORTS = f'''
+import atexit, sys
+atexit.register(lambda: sys.stderr.write(
+    '\\nIMPORTED ' + ' '.join(m for m in {HEAVY_MODULES!r}
+                             if m in sys.modules) + '\\n'))
+'''
+
+# Commands that are timed, as (name, Python code, arguments)
+COMMANDS = (
+    ('python', 'pass', []),
+    ('--help', 'from docker2ami.docker2ami import main; main()', ['--help']),
+    ('plan', 'from docker2ami.docker2ami import main; main()',
+     ['plan', os.path.join(FIXTURES_DIR, 'coco-dev', 'Dockerfile')]),
+    ('import ami_builder', 'import docker2ami.ami_builder', []),
+)
+
+
+def run_command(code, args, import_time=False):
+    """
+    Runs code with args in a new interpreter and returns its wall time, the
+    heavy modules it imported and its stderr
+    """
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    argv = ([sys.executable] + (['-X', 'importtime'] if import_time else [])
+            + ['-c', REPORT_IMPORTS + code] + args)
+    start = time.perf_counter()
+    result = subprocess.run(argv, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.perf_counter() - start
+    imported = ''
+    for line in result.stderr.splitlines():
+        if line.startswith('IMPORTED'):
+            imported = line[len('IMPORTED'):].strip()
+    return wall, imported, result.stderr
+
+
+def print_import_times(stderr, top):
+    """ Prints the top modules by cumulative import time """
+    times = []
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            fields = line[len('import time:'):].split('|')
+            if fields[1].strip().isdigit():
+                times.append((int(fields[1]), fields[2].rstrip()))
+    for cumulative, name in sorted(times, reverse=True)[:top]:
+        print(f'    {cumulative / 1000:>8.1f} ms {name}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Number of runs per command')
+    parser.add_argument('--import-time', action='store_true',
+                        help='Also print the slowest imports of each command')
+    args = parser.parse_args()
+
+    print(f'{"command":<20} {"mean ms":>9} {"min ms":>9}  imported')
+    for name, code, command_args in COMMANDS:
+        walls = []
+        for _ in range(args.repeat):
+            wall, imported, stderr = run_command(code, command_args)
+            walls.append(wall)
+        print(f'{name:<20} {1000 * statistics.mean(walls):>9.1f} '
+              f'{1000 * min(walls):>9.1f}  {imported or "-"}')
+        if args.import_time:
+            wall, imported, stderr = run_command(code, command_args, True)
+            print_import_times(stderr, 5)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""
+In-memory stand-in for the parts of boto3's EC2 client and resource that
+docker-build-ami uses, so builds can be benchmarked without AWS.
+"""
+
+import collections
+import io
+import itertools
+import threading
+import time
+
+import paramiko
+
+
+class FakeEc2(object):
+    """
+    Holds the state of the fake EC2 region. Every API call sleeps for
+    api_latency seconds to approximate a round trip to AWS.
+    """
+    def __init__(self, private_ip='127.0.0.1', api_latency=0.0):
+        self.private_ip = private_ip
+        self.api_latency = api_latency
+        self.instances = {}
+        self.images = {}
+        self.key_pairs = {}
+        self.reservations = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.calls = collections.Counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def call(self, operation):
+        """ Records a call of operation and waits for the fake latency """
+        with self._lock:
+            self.calls[operation] += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def new_id(self, prefix):
+        with self._lock:
+            return f'{prefix}-{next(self._ids):08x}'
+
+
+def _matches(item, filters):
+    """ Whether the tags of item match the tag: filters, the others ignored """
+    return all(any(tag['Key'] == f['Name'][4:] and tag['Value'] in f['Values']
+                   for tag in item['Tags'])
+               for f in filters if f['Name'].startswith('tag:'))
+
+
+class FakeEvents(object):
+    """
+    Fake for the botocore event system of a client, whose handlers are
+    registered but never called. The fake calls are counted in FakeEc2.
+    """
+    def __init__(self):
+        self.handlers = collections.defaultdict(list)
+
+    def register(self, event_name, handler):
+        self.handlers[event_name].append(handler)
+
+
+class FakeMeta(object):
+    """ Fake for the meta attribute of boto3 clients and resources """
+    def __init__(self, client=None):
+        self.events = FakeEvents()
+        self.client = client
+
+
+class FakeEc2Client(object):
+    """ Fake for boto3.client('ec2') """
+    def __init__(self, ec2):
+        self._ec2 = ec2
+        self.meta = FakeMeta()
+
+    def create_key_pair(self, KeyName, **kwargs):
+        self._ec2.call('CreateKeyPair')
+        key = paramiko.RSAKey.generate(2048)
+        pem = io.StringIO()
+        key.write_private_key(pem)
+        self._ec2.key_pairs[KeyName] = key
+        return {'KeyName': KeyName, 'KeyMaterial': pem.getvalue()}
+
+    def delete_key_pair(self, KeyName, **kwargs):
+        self._ec2.call('DeleteKeyPair')
+        self._ec2.key_pairs.pop(KeyName, None)
+        return {}
+
+    def run_instances(self, ImageId, MinCount, MaxCount, **kwargs):
+        self._ec2.call('RunInstances')
+        reservation_id = self._ec2.new_id('r')
+        instances = []
+        for _ in range(MaxCount):
+            instance = {
+                'InstanceId': self._ec2.new_id('i'),
+                'ImageId': ImageId,
+                'PrivateIpAddress': self._ec2.private_ip,
+                'Placement': {'AvailabilityZone': 'us-west-1a'},
+                'State': {'Name': 'running'},
+                'Tags': [],
+            }
+            self._ec2.instances[instance['InstanceId']] = instance
+            instances.append(instance)
+        self._ec2.reservations[reservation_id] = instances
+        return {'ReservationId': reservation_id, 'Instances': instances}
+
+    def describe_instances(self, **kwargs):
+        self._ec2.call('DescribeInstances')
+        return {'Reservations': [
+            {'ReservationId': reservation_id, 'Instances': instances}
+            for reservation_id, instances in self._ec2.reservations.items()
+        ]}
+
+    def terminate_instances(self, InstanceIds, **kwargs):
+        self._ec2.call('TerminateInstances')
+        for instance_id in InstanceIds:
+            self._ec2.instances[instance_id]['State'] = \
+                {'Name': 'terminated'}
+        return {}
+
+    def create_tags(self, Resources, Tags, **kwargs):
+        self._ec2.call('CreateTags')
+        for resource_id in Resources:
+            item = (self._ec2.instances.get(resource_id)
+                    or self._ec2.images.get(resource_id))
+            if item is not None:
+                item['Tags'] = item.get('Tags', []) + list(Tags)
+        return {}
+
+    def describe_images(self, ImageIds=None, Filters=(), **kwargs):
+        self._ec2.call('DescribeImages')
+        if ImageIds is None:
+            return {'Images': [
+                image for image in self._ec2.images.values()
+                if _matches(image, Filters)
+            ]}
+        # Images that were not created are source images
+        return {'Images': [
+            self._ec2.images.get(image_id, {'ImageId': image_id})
+            for image_id in ImageIds
+        ]}
+
+    def describe_subnets(self, SubnetIds=(), **kwargs):
+        self._ec2.call('DescribeSubnets')
+        return {'Subnets': [{'SubnetId': subnet_id}
+                            for subnet_id in SubnetIds]}
+
+    def describe_security_groups(self, GroupIds=(), **kwargs):
+        self._ec2.call('DescribeSecurityGroups')
+        return {'SecurityGroups': [{'GroupId': group_id}
+                                   for group_id in GroupIds]}
+
+    def describe_instance_types(self, InstanceTypes=(), **kwargs):
+        self._ec2.call('DescribeInstanceTypes')
+        return {'InstanceTypes': [{'InstanceType': instance_type}
+                                  for instance_type in InstanceTypes]}
+
+    def create_volume(self, Size, SnapshotId=None, **kwargs):
+        self._ec2.call('CreateVolume')
+        volume_id = self._ec2.new_id('vol')
+        self._ec2.volumes[volume_id] = {
+            'VolumeId': volume_id, 'Size': Size, 'SnapshotId': SnapshotId,
+            'State': 'available',
+        }
+        return self._ec2.volumes[volume_id]
+
+    def attach_volume(self, VolumeId, **kwargs):
+        self._ec2.call('AttachVolume')
+        self._ec2.volumes[VolumeId]['State'] = 'in-use'
+        return {}
+
+    def detach_volume(self, VolumeId, **kwargs):
+        self._ec2.call('DetachVolume')
+        self._ec2.volumes[VolumeId]['State'] = 'available'
+        return {}
+
+    def delete_volume(self, VolumeId, **kwargs):
+        self._ec2.call('DeleteVolume')
+        self._ec2.volumes.pop(VolumeId)
+        return {}
+
+    def create_snapshot(self, VolumeId, TagSpecifications=(), **kwargs):
+        self._ec2.call('CreateSnapshot')
+        snapshot_id = self._ec2.new_id('snap')
+        self._ec2.snapshots[snapshot_id] = {
+            'SnapshotId': snapshot_id,
+            'VolumeSize': self._ec2.volumes[VolumeId]['Size'],
+            'StartTime': time.time(), 'State': 'completed',
+            'Tags': [tag for spec in TagSpecifications
+                     for tag in spec['Tags']],
+        }
+        return self._ec2.snapshots[snapshot_id]
+
+    def describe_snapshots(self, Filters=(), **kwargs):
+        self._ec2.call('DescribeSnapshots')
+        return {'Snapshots': [
+            snapshot for snapshot in self._ec2.snapshots.values()
+            if _matches(snapshot, Filters)
+        ]}
+
+    def delete_snapshot(self, SnapshotId, **kwargs):
+        self._ec2.call('DeleteSnapshot')
+        self._ec2.snapshots.pop(SnapshotId)
+        return {}
+
+    def get_waiter(self, name):
+        return FakeWaiter(self._ec2, name)
+
+
+class FakeWaiter(object):
+    """ Fake for the waiters of boto3.client('ec2'), which never wait """
+    def __init__(self, ec2, name):
+        self._ec2 = ec2
+        self._name = name
+
+    def wait(self, **kwargs):
+        self._ec2.call('DescribeSnapshots' if self._name.startswith('snapshot')
+                       else 'DescribeVolumes')
+
+
+class FakeImage(object):
+    """ Fake for boto3.resource('ec2').Image """
+    def __init__(self, ec2, image_id):
+        self._ec2 = ec2
+        self.image_id = image_id
+        self.state = ec2.images[image_id]['State']
+
+    def reload(self):
+        self._ec2.call('DescribeImages')
+        self.state = self._ec2.images[self.image_id]['State']
+
+
+class FakeInstance(object):
+    """ Fake for boto3.resource('ec2').Instance """
+    def __init__(self, ec2, instance_id):
+        self._ec2 = ec2
+        self.instance_id = instance_id
+        self.private_ip_address = ec2.private_ip
+        self.state = ec2.instances[instance_id]['State']
+
+    def reload(self):
+        self._ec2.call('DescribeInstances')
+        self.state = self._ec2.instances[self.instance_id]['State']
+
+    def create_image(self, Name, **kwargs):
+        self._ec2.call('CreateImage')
+        image_id = self._ec2.new_id('ami')
+        self._ec2.images[image_id] = {
+            'ImageId': image_id, 'Name': Name, 'State': 'available',
+            'CreationDate': time.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'Tags': [],
+        }
+        return FakeImage(self._ec2, image_id)
+
+    def terminate(self):
+        FakeEc2Client(self._ec2).terminate_instances(
+            InstanceIds=[self.instance_id])
+
+
+class FakeEc2Resource(object):
+    """ Fake for boto3.resource('ec2') """
+    def __init__(self, ec2):
+        self._ec2 = ec2
+        self.meta = FakeMeta(FakeEc2Client(ec2))
+
+    def Instance(self, instance_id):
+        return FakeInstance(self._ec2, instance_id)
+
+    def Image(self, image_id):
+        return FakeImage(self._ec2, image_id)
+
+
+class FakeBoto3(object):
+    """ Drop-in replacement for the boto3 module and its sessions """
+    def __init__(self, ec2):
+        self.ec2 = ec2
+        self.session = self
+
+    def Session(self, **kwargs):
+        return self
+
+    def client(self, service_name, **kwargs):
+        return FakeEc2Client(self.ec2)
+
+    def resource(self, service_name, **kwargs):
+        return FakeEc2Resource(self.ec2)
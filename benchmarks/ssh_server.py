@@ -0,0 +1,219 @@
+"""
+In-process SSH and SFTP server that stands in for the EC2 builder.
+
+Every exec request runs through /bin/sh on the local machine with a sudo
+shim first on the PATH. By default the shim swallows the script that
+docker-build-ami pipes into `sudo -i --`, so a benchmark measures the
+overhead of docker-build-ami and SSH rather than the Dockerfile's own
+commands. With execute=True the shim runs the script for real.
+"""
+
+import errno
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import tempfile
+import threading
+
+import paramiko
+
+
+SUDO_DRY_RUN = '#!/bin/sh\ncat > /dev/null\n'
+
+SUDO_EXECUTE = '#!/bin/sh\ncd "$HOME" && exec /bin/sh\n'
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    """ SFTP server whose / is the root directory of the LocalSshServer """
+    def __init__(self, server, *args, root='/', **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self._root = root
+
+    def _path(self, path):
+        return os.path.join(self._root,
+                            os.path.normpath('/' + path).lstrip('/'))
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        f = os.fdopen(fd, mode)
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.lstat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(
+                        os.lstat(os.path.join(path, name)), name)
+                    for name in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, ssh_server):
+        self._ssh_server = ssh_server
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._ssh_server.exec_command,
+                         args=(channel, command), daemon=True).start()
+        return True
+
+
+class LocalSshServer(object):
+    """
+    SSH server listening on a free port of 127.0.0.1. Use via with: or call
+    start() and stop().
+    """
+    def __init__(self, execute=False):
+        self.execute = execute
+        self.port = None
+        self.exec_count = 0
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._socket = None
+        self._transports = []
+        self._lock = threading.Lock()
+        self._work_dir = tempfile.mkdtemp(prefix='docker-build-ami-ssh-')
+        self.home_dir = os.path.join(self._work_dir, 'home')
+        self.sftp_root = '/' if execute else \
+            os.path.join(self._work_dir, 'root')
+        self._bin_dir = os.path.join(self._work_dir, 'bin')
+
+    def start(self):
+        for path in (self.home_dir, self.sftp_root, self._bin_dir):
+            os.makedirs(path, exist_ok=True)
+        sudo = os.path.join(self._bin_dir, 'sudo')
+        with open(sudo, 'w') as f:
+            f.write(SUDO_EXECUTE if self.execute else SUDO_DRY_RUN)
+        os.chmod(sudo, os.stat(sudo).st_mode | stat.S_IEXEC)
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(16)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self._host_key)
+            transport.set_subsystem_handler(
+                'sftp', paramiko.SFTPServer, _SFTPServer,
+                root=self.sftp_root)
+            with self._lock:
+                self._transports.append(transport)
+            transport.start_server(server=_ServerInterface(self))
+
+    def exec_command(self, channel, command):
+        """ Runs command for channel and reports its exit status """
+        with self._lock:
+            self.exec_count += 1
+        env = dict(os.environ, HOME=self.home_dir,
+                   PATH=f'{self._bin_dir}{os.pathsep}{os.environ["PATH"]}')
+        try:
+            proc = subprocess.Popen(
+                ['/bin/sh', '-c', command.decode('utf8')], cwd=self.home_dir,
+                env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for chunk in iter(lambda: proc.stdout.read1(32768), b''):
+                channel.sendall(chunk)
+            channel.send_exit_status(proc.wait())
+        except (OSError, socket.error) as e:
+            if e.errno != errno.EPIPE:
+                channel.send_exit_status(255)
+        finally:
+            channel.close()
+
+    def stop(self):
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for transport in transports:
+            transport.close()
+        shutil.rmtree(self._work_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.stop()
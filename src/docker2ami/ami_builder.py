@@ -1,27 +1,74 @@
-import boto3
+import collections
+import concurrent.futures
 import datetime
-import glob
 import json
 import logging
+import os
 import paramiko
 import shlex
 import socket
 import tarfile
+import threading
 import time
 import uuid
 
-from os.path import expanduser, join
+from os.path import expanduser, join, normpath
 from sys import stdout
 
+from .api_calls import ApiMetrics, track, tracked, untrack
+from .build_log import BuildLog, StepOutput
+from .cache_volume import CacheVolume
+from .color import Color
+from .config import ARCHIVE_FORMATS, RETRY_MODES, \
+    AwsConfig, is_true  # noqa: F401
+from .direct_copy import add_placed_files, context_filter, resolve_targets
+from .executor import TIMEOUT_EXIT_CODE, AbstractExecutor
+from .fingerprint import FINGERPRINT_TAG
+from .indexed_archive import IndexedArchive, read_chunks_cmd
+from .sessions import default_factory
+from .storage import SCRATCH_DIR, block_device_mappings, prewarm_cmd, \
+    prewarm_wait_cmd, scratch_mount_cmd, scratch_unmount_cmd
+
 
 logger = logging.getLogger(__name__)
 
+# Delimiter of the here-document that appends to the env file
+ENV_FILE_EOF = 'DOCKER_BUILD_AMI_ENV'
+
+# Where the build context archive is uploaded on the builder
+ARCHIVE_PATH = '/tmp/docker-build-ami.tar.gz'
+
+# Where the commands of the steps leave their markers on the builder, in a
+# directory of each build. It is removed before the AMI is created.
+STEPS_DIR = '/tmp/docker-build-ami-steps'
+
+# Errors of a lost SSH connection
+CONNECTION_ERRORS = (paramiko.SSHException, EOFError, OSError)
+
+# Where cloud_init_ready builders signal that they are ready for the steps.
+# /run is not part of the AMI.
+READY_MARKER = '/run/docker-build-ami-ready'
+
+# UserData of cloud_init_ready builders. cloud-init runs it before it has
+# finished, so it waits in the background for boot-finished, which
+# cloud-init writes last, and for the package managers that cloud-init or
+# the boot started.
+READY_USER_DATA = f'''#!/bin/sh
+(
+  until [ -e /var/lib/cloud/instance/boot-finished ]; do sleep 0.2; done
+  while pgrep -x 'apt|apt-get|dpkg|unattended-upgr|yum|dnf|zypper'; do
+    sleep 0.2
+  done
+  touch {READY_MARKER}
+) > /dev/null 2>&1 &
+'''
 
-class Color:
-    RED = '\033[31m'
-    YELLOW = '\033[33m'
-    DARK_GREY = '\033[90m'
-    CLEAR = '\033[0m'
+# Seconds between the checks of a cloud_init_ready builder
+READY_POLL_INTERVAL = 1
+
+# Seconds to wait for a cloud_init_ready builder to signal it is ready
+# before going on without it
+READY_TIMEOUT = 600
 
 
 def _check_port(host, port):
@@ -35,40 +82,33 @@ def _check_port(host, port):
         return False
 
 
-class AwsConfig(object):
-    """
-    Holds AWS configuration info for the AMI Builder.
-    """
-    def __init__(self, config, section, overrides):
-        """
-        Initialize configuration information from the given config file and
-        section. overrides is an object that will ovverde the values in config.
-        """
-        key_names = [
-            'host_tag', 'tmp_dir', 'image_name', 'region', 'instance_type',
-            'subnet_id', 'image_id', 'image_user', 'aws_access_key_id',
-            'aws_secret_access_key', 'security_group_ids', 'host_tags',
-            'image_tags',
-        ]
-        for key in key_names:
-            setattr(self, key,
-                    getattr(overrides, key)
-                    if hasattr(overrides, key) and
-                    not getattr(overrides, key) is None
-                    else config.get(section, key))
+def _recv(channel):
+    """ Returns the next output of channel, or None if it timed out """
+    try:
+        return channel.recv(32768)
+    except socket.timeout:
+        return None
 
 
-class AmiBuilder(object):
+class AmiBuilder(AbstractExecutor):
     """
     Object for building up an AMI. Can be invoked via with: or by explicitly
     invoking start() and finish()
     """
-    def __init__(self, aws_config):
+    def __init__(self, aws_config, source_dir='.', session=None,
+                 fingerprint=None, events=None):
         """
-        Initializes the AMI from the given configuration.
+        Initializes the AMI from the given configuration. session, if given,
+        is the SharedSession of the AWS clients instead of the one of the
+        default SessionFactory. The AMI is tagged with fingerprint, if given.
+        The progress of the build is emitted to events, if given.
         """
         self._config = aws_config
+        self.source_dir = source_dir
+        self._session = session
+        self._fingerprint = fingerprint
         self._key_name = str(uuid.uuid4())
+        self._steps_dir = f'{STEPS_DIR}/{self._key_name}'
         self._key_path = expanduser(join(self._config.tmp_dir,
                                          f'{self._key_name}.pem'))
         self._security_group_ids = json.loads(aws_config.security_group_ids)
@@ -77,21 +117,58 @@ class AmiBuilder(object):
         self._ec2 = None
         self._key_pair = None
         self._instance_obj = None
+        self._cache_volume = None
+        self._env_file_created = False
+        self._env_statements = []
+        self._env_statements_sent = 0
+        self._build_log = None
+        self._archive = None
+        self._context_start = 0
+        self._fetched_chunks = set()
+        self._upload_thread = None
+        self._upload_cond = threading.Condition()
+        self._uploaded = 0
+        self._upload_done = False
+        self._upload_error = None
+        self._ssh = None
+        self._ssh_lock = threading.Lock()
+        self._step_cmds = collections.Counter()
+        self._step_timeouts = {}
+        self._cancelled = threading.Event()
+        self._scratch = False
+        self._prewarming = False
+        # The AWS API calls of this build, out of those of the session
+        self._api_metrics = ApiMetrics()
+        if events:
+            self.events = events
+        if aws_config.archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(
+                f'Unknown archive format: {aws_config.archive_format}')
+        if aws_config.retry_mode not in RETRY_MODES:
+            raise ValueError(f'Unknown retry mode: {aws_config.retry_mode}')
 
     def start(self):
         """
         Starts the process of building an AMI by launching and connecting to
         an EC2
         """
+        if self._config.log_file:
+            self._build_log = BuildLog(self._config.log_file, 'w')
+        track(self._api_metrics)
+
         # Connect to AWS
         try:
-            self._ec2 = boto3.client(
-              'ec2', region_name=self._config.region,
-              aws_access_key_id=self._config.aws_access_key_id,
-              aws_secret_access_key=self._config.aws_secret_access_key)
-            self._ec2_resource = boto3.resource('ec2')
+            session = self._session or default_factory.session(self._config)
+            self._ec2 = session.client('ec2')
+            self._ec2_resource = session.resource('ec2')
         except BaseException:
             raise RuntimeError('Failed to connect to EC2')
+        if self._config.cache_volume:
+            self._cache_volume = CacheVolume(
+                self._ec2, self._config.cache_volume,
+                int(self._config.cache_volume_size),
+                json.loads(self._config.cache_dirs),
+                int(self._config.cache_snapshots_kept), self._host_tags)
 
         # Create the EC2 instance that we will use to build the AMI
         self._key_pair = self._ec2.create_key_pair(KeyName=self._key_name)
@@ -104,12 +181,19 @@ class AmiBuilder(object):
           {'ResourceType': 'instance', 'Tags': tags},
           {'ResourceType': 'volume', 'Tags': tags},
         ]
+        options = {}
+        cloud_init_ready = is_true(self._config.cloud_init_ready)
+        if cloud_init_ready:
+            options['UserData'] = READY_USER_DATA
+        mappings = block_device_mappings(self._ec2, self._config)
+        if mappings:
+            options['BlockDeviceMappings'] = mappings
         reservation = self._ec2.run_instances(
           ImageId=self._config.image_id, KeyName=self._key_name,
           InstanceType=self._config.instance_type,
           SubnetId=self._config.subnet_id, MinCount=1, MaxCount=1,
           TagSpecifications=tag_spec,
-          SecurityGroupIds=self._security_group_ids)
+          SecurityGroupIds=self._security_group_ids, **options)
 
         # Find the newly created EC2
         self._instance = None
@@ -123,8 +207,49 @@ class AmiBuilder(object):
         print(f'Instance: {self._instance["InstanceId"]}')
         print(f'Instance IP: {self._instance["PrivateIpAddress"]}')
         print(f'Connection SSH key: {self._key_path}')
+        self.events.emit('instance_launched',
+                         instance=self._instance['InstanceId'],
+                         ip=self._instance['PrivateIpAddress'],
+                         instance_type=self._config.instance_type,
+                         image_id=self._config.image_id)
+        launched = time.monotonic()
+
+        # The cache volume is created while the EC2 boots
+        if self._cache_volume:
+            self._cache_volume.create(
+                self._instance['Placement']['AvailabilityZone'])
+
+        if cloud_init_ready:
+            self._wait_until_ready(launched)
+        else:
+            self._wait_until_running(launched)
+        self.events.emit('instance_ready',
+                         elapsed=round(time.monotonic() - launched, 3))
+
+        # The steps wait for it, so it runs along with the upload of the
+        # build context
+        if is_true(self._config.prewarm_root_volume):
+            print('\nPre-warm root volume...')
+            self.run_cmd(prewarm_cmd())
+            self._prewarming = True
+
+        if self._cache_volume:
+            print('\nMount cache volume...')
+            self._cache_volume.attach(self._instance_obj.instance_id)
+            self.run_cmd(self._cache_volume.mount_cmd())
 
-        # Wait around for the EC2 to be running
+        if is_true(self._config.instance_store_scratch):
+            print('\nMount scratch space...')
+            self.run_cmd(scratch_mount_cmd())
+            self._scratch = True
+            self.context_dir = f'{SCRATCH_DIR}/context'
+            self.update_env(f'export TMPDIR={SCRATCH_DIR}/tmp')
+
+    def _wait_until_running(self, launched):
+        """
+        Waits until the builder is running and accepts SSH connections,
+        polling its state, and connects to it
+        """
         stdout.write('Waiting for instance status running.')
         stdout.flush()
         self._instance_obj = self._ec2_resource.Instance(
@@ -132,6 +257,9 @@ class AmiBuilder(object):
         while self._instance_obj.state['Name'] != 'running':
             stdout.write('.')
             stdout.flush()
+            self.events.emit('waiting', until='instance_running',
+                             state=self._instance_obj.state['Name'],
+                             elapsed=round(time.monotonic() - launched, 3))
             time.sleep(5)
             self._instance_obj.reload()
 
@@ -141,82 +269,476 @@ class AmiBuilder(object):
         while not _check_port(self._instance_obj.private_ip_address, 22):
             stdout.write('.')
             stdout.flush()
+            self.events.emit('waiting', until='ssh_ready',
+                             elapsed=round(time.monotonic() - launched, 3))
             time.sleep(5)
 
-        # Connect via ssh
+        self._connect()
+
+    def _wait_until_ready(self, launched):
+        """
+        Connects to the builder as soon as it accepts SSH connections, its
+        state following from that, and waits on that connection for
+        READY_USER_DATA to signal that cloud-init and the package managers
+        are done
+        """
+        self._instance_obj = self._ec2_resource.Instance(
+          self._instance['InstanceId'])
+        stdout.write('Waiting for SSH to become ready.')
+        stdout.flush()
+        ip = self._instance['PrivateIpAddress']
+        while True:
+            if _check_port(ip, 22):
+                try:
+                    self._connect()
+                    break
+                except CONNECTION_ERRORS as e:
+                    # Such as the key that cloud-init has not installed yet
+                    if time.monotonic() - launched >= READY_TIMEOUT:
+                        raise
+                    logger.info(f'Unable to connect yet: {e}')
+            stdout.write('.')
+            stdout.flush()
+            self.events.emit('waiting', until='ssh_ready',
+                             elapsed=round(time.monotonic() - launched, 3))
+            time.sleep(READY_POLL_INTERVAL)
+
+        stdout.write('\nWaiting for cloud-init to finish.')
+        stdout.flush()
+        self.events.emit('waiting', until='cloud_init',
+                         elapsed=round(time.monotonic() - launched, 3))
+        stdin, output, stderr = self._ssh.exec_command(
+          f"timeout {READY_TIMEOUT} sh -c 'until [ -e {READY_MARKER} ]; do "
+          "sleep 0.2; done'")
+        if output.channel.recv_exit_status() != 0:
+            logger.warning('The builder did not signal that cloud-init '
+                           f'finished within {READY_TIMEOUT}s, going on')
+
+    def _connect(self):
+        """ Connects to the builder via SSH """
         key = paramiko.RSAKey.from_private_key_file(self._key_path)
-        self._ssh = paramiko.SSHClient()
-        self._ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self._ssh.connect(hostname=self._instance_obj.private_ip_address,
-                          username=self._config.image_user,
-                          pkey=key)
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(hostname=self._instance_obj.private_ip_address,
+                    username=self._config.image_user,
+                    pkey=key)
+        # Keeps NAT mappings and firewalls from dropping the connection
+        # while a step prints nothing
+        keepalive = int(self._config.ssh_keepalive)
+        if keepalive:
+            ssh.get_transport().set_keepalive(keepalive)
+        self._ssh = ssh
+
+    def _reconnect(self, lost_ssh):
+        """
+        Replaces the lost connection lost_ssh, unless another thread already
+        did, retrying with a growing delay up to ssh_retries times
+        """
+        with self._ssh_lock:
+            if self._ssh is not lost_ssh:
+                return
+            lost_ssh.close()
+            if self._cancelled.is_set():
+                raise RuntimeError('The build was cancelled')
+            for attempt in range(int(self._config.ssh_retries)):
+                delay = min(2 ** attempt, 30)
+                print(f'\nLost the SSH connection, reconnecting in '
+                      f'{delay}s...')
+                self.events.emit('reconnecting', attempt=attempt + 1,
+                                 delay=delay)
+                time.sleep(delay)
+                try:
+                    self._connect()
+                    return
+                except CONNECTION_ERRORS as e:
+                    logger.warning(f'Unable to reconnect: {e}')
+            raise RuntimeError('Lost the SSH connection to the builder')
+
+    def _probe_kinds(self, paths):
+        """
+        Returns path -> 'd' for a directory, 'l' for a symbolic link or '-'
+        for anything else on the builder, or None if the probe failed
+        """
+        script = (f'for p in {" ".join(shlex.quote(p) for p in paths)}; do '
+                  'if [ -L "$p" ]; then echo l; elif [ -d "$p" ]; then '
+                  'echo d; else echo -; fi; done')
+        stdin, stdout, stderr = self._ssh.exec_command(
+          f'echo {shlex.quote(script)} | sudo -i --')
+        kinds = str(stdout.read(), 'utf8').split()
+        if stdout.channel.recv_exit_status() != 0:
+            return None
+        return dict(zip(paths, kinds))
+
+    def send_archive(self, planner=None):
+        placements = planner.placements if planner else {}
+        targets = {}
+        if placements:
+            kinds = self._probe_kinds(
+                sorted({dst for src, dst, is_dir in placements.values()}))
+            if kinds is None:
+                logger.warning('Unable to check COPY and ADD destinations, '
+                               'copying all files with cp')
+            else:
+                targets = resolve_targets(placements, kinds, self.source_dir)
+
+        if self._config.archive_format == 'indexed':
+            self._send_indexed_archive(placements, targets, planner)
+            return set(targets)
 
-    def send_archive(self):
         print('\nCreate archive...')
+        prefix = self.context_dir.lstrip('/') if targets else ''
+        context_filter_fn = context_filter(
+            placements, targets, planner.sources, prefix) if targets else None
         with tarfile.open(
           join(self._config.tmp_dir, 'docker-build-ami.tar.gz'),
           'w:gz') as tar:
-            for fn in glob.glob('*'):
-                logger.info(f'Adding file to archive: {fn}')
-                tar.add(fn)
+            for path, name in self._context_files():
+                logger.info(f'Adding file to archive: {name}')
+                tar.add(path, arcname=join(prefix, name),
+                        filter=context_filter_fn)
+            add_placed_files(tar, placements, targets, self.source_dir)
 
         print('\nCopy archive...')
         sftp = self._ssh.open_sftp()
         sftp.put(self._config.tmp_dir + '/docker-build-ami.tar.gz',
-                 '/tmp/docker-build-ami.tar.gz')
+                 ARCHIVE_PATH)
         sftp.close()
 
         # Untar archive
         print('\nUntar archive...')
-        self.run_cmd('',
-                     'mkdir /tmp/docker-build-ami; '
-                     'tar -xzf /tmp/docker-build-ami.tar.gz'
-                     ' -C /tmp/docker-build-ami')
+        if targets:
+            # Keep the ownership and permissions of existing directories
+            self.run_cmd(f'mkdir -p {self.context_dir}; '
+                         f'tar -xzpf {ARCHIVE_PATH} -C / --no-overwrite-dir')
+        else:
+            self.run_cmd(f'mkdir -p {self.context_dir}; '
+                         f'tar -xzf {ARCHIVE_PATH} -C {self.context_dir}')
+        return set(targets)
 
-    def run_cmd(self, env, cmd):
-        stdin, stdout, stderr = self._ssh.exec_command(
-          f'set -ex; echo {shlex.quote(env)} {shlex.quote(cmd)} | sudo -i --',
+    def _send_indexed_archive(self, placements, targets, planner):
+        """
+        Creates an IndexedArchive, with the placed files in the chunks
+        before _context_start, and uploads it in the background while the
+        steps extract the chunks they need
+        """
+        print('\nCreate archive...')
+        archive_path = join(self._config.tmp_dir, 'docker-build-ami.tar.gz')
+        context_filter_fn = context_filter(
+            placements, targets, planner.sources, '.') if targets else None
+        with IndexedArchive(archive_path, 'w') as archive:
+            add_placed_files(archive, placements, targets, self.source_dir)
+            archive.flush()
+            self._context_start = archive.tell()
+            for path, name in self._context_files():
+                logger.info(f'Adding file to archive: {name}')
+                archive.add(path, arcname=name, filter=context_filter_fn)
+        self._archive = IndexedArchive(archive_path)
+
+        print('\nCopy archive...')
+        self._upload_thread = threading.Thread(
+            target=self._upload, args=(archive_path,), daemon=True)
+        self._upload_thread.start()
+        if targets:
+            print('\nUntar placed files...')
+            chunks = {(0, self._context_start)}
+            self.run_cmd(self._wait_for_upload(chunks)
+                         + read_chunks_cmd(ARCHIVE_PATH, chunks)
+                         + ' | tar -xzip -C / --no-overwrite-dir')
+
+    def _upload(self, path):
+        try:
+            sftp = self._ssh.open_sftp()
+            sftp.put(path, ARCHIVE_PATH, callback=self._upload_progress)
+            sftp.close()
+        except Exception as e:
+            self._upload_error = e
+        finally:
+            with self._upload_cond:
+                self._upload_done = True
+                self._upload_cond.notify_all()
+
+    def _upload_progress(self, uploaded, size):
+        with self._upload_cond:
+            self._uploaded = uploaded
+            self._upload_cond.notify_all()
+
+    def _wait_for_upload(self, chunks):
+        """
+        Waits until the chunks are sent and returns a command that waits
+        until the builder has written them, if the upload is still going on
+        """
+        end = max(offset + length for offset, length in chunks)
+        with self._upload_cond:
+            self._upload_cond.wait_for(
+                lambda: self._uploaded >= end or self._upload_done)
+        if self._upload_error:
+            raise RuntimeError(
+                'Failed to upload the build context') from self._upload_error
+        if self._upload_done:
+            return ''
+        return (f'until [ "$(stat -c %s {ARCHIVE_PATH})" -ge {end} ] '
+                '2> /dev/null; do sleep 0.1; done; ')
+
+    def fetch_context(self, src):
+        if not self._archive:
+            return ''
+
+        # Sources such as globs that are not in the index need everything
+        chunks = (self._archive.chunks([normpath(src)], self._context_start)
+                  or self._archive.chunks(['.'], self._context_start)
+                  or set())
+        chunks -= self._fetched_chunks
+        if not chunks:
+            return ''
+        self._fetched_chunks |= chunks
+        return (f'mkdir -p {self.context_dir}; '
+                + self._wait_for_upload(chunks)
+                + read_chunks_cmd(ARCHIVE_PATH, chunks)
+                + f' | tar -xzi -C {self.context_dir}')
+
+    def update_env(self, statement):
+        # Sent along with the next command so it costs no round trip
+        self._env_statements.append(statement)
+
+    def _env_outdated(self):
+        return not self._env_file_created or \
+            len(self._env_statements) > self._env_statements_sent
+
+    def _env_script(self):
+        """
+        Returns the script that sources env_file, first rewriting it with all
+        the statements when some are new. Unlike appending them, rewriting
+        is right again when the script is run again after reconnecting.
+        """
+        script = ''
+        if self._env_statements and self._env_outdated():
+            statements = '\n'.join(self._env_statements)
+            script = (f"cat > {self.env_file} <<'{ENV_FILE_EOF}'\n"
+                      f'{statements}\n{ENV_FILE_EOF}\n')
+        elif not self._env_file_created:
+            script = f': > {self.env_file}\n'
+        return script + f'. {self.env_file}\n'
+
+    def _prepare_parallel(self):
+        # The env file has to be up to date before the commands share it
+        if self._env_outdated():
+            self.run_cmd('true')
+
+    def _step_marker(self, step):
+        """
+        Returns the path of the markers of the next command of step, which
+        is the same for the same command in every build of the Dockerfile
+        """
+        with self._ssh_lock:
+            self._step_cmds[step] += 1
+            return f'{self._steps_dir}/{step}.{self._step_cmds[step]}'
+
+    def _step_state(self, ssh, marker):
+        """
+        Returns whether the command of marker is 'done', was 'interrupted'
+        or was never started, waiting for it if it is still running
+        """
+        script = (f'if [ -e {marker}.done ]; then echo done; '
+                  f'elif [ -e {marker}.pid ]; then '
+                  f'while kill -0 $(cat {marker}.pid) 2> /dev/null; do '
+                  'sleep 1; done; '
+                  f'if [ -e {marker}.done ]; then echo done; '
+                  'else echo interrupted; fi; '
+                  'else echo missing; fi')
+        stdin, stdout, stderr = ssh.exec_command(
+          f'echo {shlex.quote(script)} | sudo -i --')
+        return (str(stdout.read(), 'utf8').split() or ['missing'])[-1]
+
+    def _exec(self, cmd, step, prefix=None):
+        # The command leaves its PID and, once it succeeded, a done marker
+        # so that it is not run again after reconnecting. Without the signal
+        # trap a hung up shell would exit with the status of its last command.
+        marker = self._step_marker(step)
+        # The steps start once the root volume is pre-warmed
+        prewarming = self._prewarming and step > 0
+        script = (f"mkdir -p {self._steps_dir}; echo $$ > {marker}.pid; "
+                  "trap 'exit 129' HUP INT TERM; "
+                  f"trap 'test $? -ne 0 || touch {marker}.done' EXIT\n"
+                  + self._env_script()
+                  + (prewarm_wait_cmd() if prewarming else '') + cmd)
+        ecode = self._exec_retrying(script, step, prefix, marker)
+        self._env_file_created = True
+        self._env_statements_sent = len(self._env_statements)
+        if prewarming:
+            self._prewarming = False
+        return ecode
+
+    def _exec_retrying(self, script, step, prefix=None, marker=None):
+        """
+        Runs script with _exec_script() and returns its exit code,
+        reconnecting when the connection is lost. Without marker, script is
+        run again after reconnecting.
+        """
+        for attempt in range(int(self._config.ssh_retries) + 1):
+            if self._cancelled.is_set():
+                raise RuntimeError('The build was cancelled')
+            ssh = self._ssh
+            try:
+                return self._exec_script(ssh, script, step, prefix,
+                                         marker if attempt else None)
+            except CONNECTION_ERRORS as e:
+                logger.warning(f'Lost the SSH connection during step {step}: '
+                               f'{e}')
+                self._reconnect(ssh)
+        raise RuntimeError(f'Lost the SSH connection during step {step} '
+                           'too many times')
+
+    def _exec_script(self, ssh, script, step, prefix, marker=None):
+        """
+        Runs script over ssh and returns its exit code. After a reconnect,
+        marker is given and a command that is done is not run again.
+        """
+        if marker:
+            state = self._step_state(ssh, marker)
+            if state == 'done':
+                print(f'{prefix or ""}Step {step} finished while the '
+                      'connection was lost')
+                return 0
+            if state == 'interrupted':
+                print(f'{Color.RED}{prefix or ""}Step {step} was interrupted '
+                      f'by the lost connection, running it again{Color.CLEAR}')
+        stdin, stdout, stderr = ssh.exec_command(
+          f'set -ex; echo {shlex.quote(script)} | sudo -i --',
           get_pty=True)
-        output = stdout.read()
-        if output:
-            print(f'{Color.YELLOW}{str(output, "utf8")}{Color.CLEAR}')
+        output = StepOutput(step, self._build_log,
+                            int(self._config.log_tail_lines), prefix,
+                            self.events)
+        deadline = self._deadline(step)
+        stdout.channel.settimeout(deadline.poll_interval)
+        try:
+            for data in iter(lambda: _recv(stdout.channel), b''):
+                if data:
+                    output.write(data)
+                    deadline.output()
+                expired = deadline.expired()
+                if expired:
+                    # Closing the channel hangs up the command
+                    stdout.channel.close()
+                    print(f'{Color.RED}{prefix or ""}Step {step} {expired}, '
+                          f'stopped it{Color.CLEAR}')
+                    return TIMEOUT_EXIT_CODE
+        finally:
+            output.close()
         output = stderr.read()
         if output:
-            print(f'{Color.RED}{str(output, "utf8")}{Color.CLEAR}')
+            print(f'{Color.RED}{prefix or ""}{str(output, "utf8")}'
+                  f'{Color.CLEAR}')
 
         ecode = stdout.channel.recv_exit_status()
-        if ecode != 0:
-            logger.error(
-                f'The command {cmd} returned a non-zero code: {ecode}')
-            exit(ecode)
+        # The channel closes without an exit status when the connection is
+        # lost, as it does when the command is killed by a signal
+        if ecode == -1 and not ssh.get_transport().is_active():
+            raise paramiko.SSHException('SSH session not active')
+        return ecode
 
     def save_ami(self):
         print(f'\nCreate AMI from instance: {self._instance_obj.instance_id}')
-        image_obj = self._instance_obj.create_image(
-            Name=f'{self._config.image_name}-'
-                 f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}')
-        self._ec2.create_tags(Resources=[image_obj.image_id],
-                              Tags=self._image_tags
-                              + [{'Key': 'Name',
-                                  'Value': self._config.image_name}])
+        name = (f'{self._config.image_name}-'
+                f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}')
+        image_obj = self._instance_obj.create_image(Name=name)
+        created = time.monotonic()
+        tags = self._image_tags + [
+            {'Key': 'Name', 'Value': self._config.image_name}]
+        if self._fingerprint:
+            tags.append({'Key': FINGERPRINT_TAG, 'Value': self._fingerprint})
+        self._ec2.create_tags(Resources=[image_obj.image_id], Tags=tags)
         while image_obj.state == 'pending':
             stdout.write('.')
             stdout.flush()
+            self.events.emit('waiting', until='image_available',
+                             image=image_obj.image_id,
+                             elapsed=round(time.monotonic() - created, 3))
             time.sleep(5)
             image_obj.reload()
 
         print(f'\nCreated image: {image_obj.image_id}')
+        self.events.emit('image_created', image=image_obj.image_id,
+                         name=name)
+        return image_obj.image_id
+
+    def save_image(self):
+        if self._upload_thread:
+            self._upload_thread.join()
+
+        # The cache must not be part of the AMI
+        if self._cache_volume:
+            print('\nUnmount cache volume...')
+            self.run_cmd(self._cache_volume.unmount_cmd())
+            self._cache_volume.detach()
+            self._cache_volume.save()
+        if self._scratch:
+            print('\nUnmount scratch space...')
+            self.run_cmd(scratch_unmount_cmd())
+        self._remove_build_files()
+        return self.save_ami()
+
+    def _remove_build_files(self):
+        """
+        Removes env_file, whose ENV values may be secrets, and the markers of
+        the steps, which would otherwise be found by the builds that start
+        from the AMI. The command leaves no marker.
+        """
+        ecode = self._exec_retrying(f'rm -rf {STEPS_DIR} {self.env_file}', 0)
+        if ecode != 0:
+            logger.error('Removing the files of the build returned a '
+                         f'non-zero code: {ecode}')
+            exit(ecode)
+
+    def _terminate(self):
+        """ Terminates the builder and deletes the cache volume it used """
+        if self._instance_obj:
+            self._instance_obj.terminate()
+        if self._cache_volume:
+            self._cache_volume.delete()
+
+    def _delete_key_pair(self):
+        if self._key_pair:
+            self._ec2.delete_key_pair(KeyName=self._key_name)
+
+    def _remove_key_file(self):
+        if os.path.exists(self._key_path):
+            os.remove(self._key_path)
+
+    def cancel(self):
+        self._cancelled.set()
+        # Closing the connection hangs up the commands
+        if self._ssh:
+            self._ssh.close()
 
     def finish(self):
+        """
+        Stops the commands that still run and releases the builder, its key
+        pair and key file concurrently, logging what could not be released
+        """
         try:
-            if self._instance_obj:
-                self._instance_obj.terminate()
+            self.cancel()
+            releases = ((self._terminate, 'instance'),
+                        (self._delete_key_pair, 'key pair'),
+                        (self._remove_key_file, 'key file'))
+            with concurrent.futures.ThreadPoolExecutor(3) as pool:
+                futures = {pool.submit(tracked(release)): name
+                           for release, name in releases}
+            for future, name in futures.items():
+                if future.exception():
+                    logger.error(
+                        f'Unable to release the {name}: {future.exception()}')
+            if self._build_log:
+                self._build_log.close()
+            self._report_api_calls()
         finally:
+            untrack(self._api_metrics)
             self._instance_obj = None
+            self._key_pair = None
 
-    def __enter__(self):
-        self.start()
-        return self
-
-    def __exit__(self, exception_type, exception_value, traceback):
-        self.finish()
+    def _report_api_calls(self):
+        """ Prints and emits the metrics of the AWS API calls of the build """
+        summary = self._api_metrics.summary()
+        if summary:
+            print(f'\n{summary}')
+            self.events.emit('api_calls',
+                             operations=self._api_metrics.to_dict())
@@ -0,0 +1,170 @@
+import threading
+import time
+
+
+# Error codes of throttled AWS API calls
+THROTTLE_CODES = (
+    'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestThrottledException', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'RequestThrottled', 'EC2ThrottledException',
+    'SlowDown',
+)
+
+# Upper bounds in seconds of the buckets of the latency histograms, the
+# last bucket holding the slower calls
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Calls per second a throttled RateLimiter goes down to at least
+MIN_RATE = 0.5
+
+# Part of the limit a RateLimiter gets back for every call that succeeds
+RECOVERY = 0.05
+
+# The ApiMetrics the calls of the current thread are recorded in
+_tracked = threading.local()
+
+
+class RateLimiter(object):
+    """
+    Spaces the AWS API calls of the builds that share it to limit calls per
+    second. Throttled calls halve the rate and calls that succeed raise it
+    back a little at a time, so the rate settles under what the API allows.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.rate = float(limit)
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def acquire(self):
+        """ Waits for the turn of the next call and returns the seconds """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + 1 / self.rate
+        if start > now:
+            time.sleep(start - now)
+        return start - now
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(MIN_RATE, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.limit, self.rate + self.limit * RECOVERY)
+
+
+class ApiMetrics(object):
+    """
+    Number of calls, errors and throttled calls of every AWS API operation,
+    with their latency histogram and how long they waited for the
+    RateLimiter. Every attempt of a retried call counts as a call.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def record(self, operation, latency, waited=0, error=False,
+               throttled=False):
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS)
+                       if latency <= bound), len(LATENCY_BUCKETS))
+        with self._lock:
+            metrics = self._operations.setdefault(operation, {
+                'calls': 0, 'errors': 0, 'throttles': 0, 'seconds': 0.0,
+                'waited': 0.0, 'latency': [0] * (len(LATENCY_BUCKETS) + 1)})
+            metrics['calls'] += 1
+            metrics['errors'] += bool(error or throttled)
+            metrics['throttles'] += bool(throttled)
+            metrics['seconds'] += latency
+            metrics['waited'] += waited
+            metrics['latency'][bucket] += 1
+
+    def to_dict(self):
+        """
+        Returns the metrics by operation, with the number of calls of every
+        latency bucket by its upper bound
+        """
+        bounds = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+        with self._lock:
+            return {operation: dict(
+                metrics, seconds=round(metrics['seconds'], 3),
+                waited=round(metrics['waited'], 3),
+                latency=dict(zip(bounds, metrics['latency'])))
+                for operation, metrics in sorted(self._operations.items())}
+
+    def summary(self):
+        """ Returns a line with the totals of the calls, or None if none """
+        with self._lock:
+            operations = list(self._operations.values())
+        if not operations:
+            return None
+        calls = sum(metrics['calls'] for metrics in operations)
+        throttles = sum(metrics['throttles'] for metrics in operations)
+        seconds = sum(metrics['seconds'] for metrics in operations)
+        waited = sum(metrics['waited'] for metrics in operations)
+        return (f'AWS API: {calls} calls taking {seconds:.1f}s, {throttles} '
+                f'throttled, {waited:.1f}s waiting for the rate limit')
+
+
+def track(metrics):
+    """ Records the calls of the current thread in metrics as well """
+    _tracked.metrics = getattr(_tracked, 'metrics', ()) + (metrics,)
+
+
+def untrack(metrics):
+    """ Stops recording the calls of the current thread in metrics """
+    _tracked.metrics = tuple(tracked for tracked
+                             in getattr(_tracked, 'metrics', ())
+                             if tracked is not metrics)
+
+
+def tracked(fn):
+    """
+    Returns fn running with the calls of its thread recorded where those of
+    the current thread are
+    """
+    metrics = getattr(_tracked, 'metrics', ())
+
+    def run(*args, **kwargs):
+        _tracked.metrics = metrics
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _tracked.metrics = ()
+    return run
+
+
+def instrument(events, metrics, limiter=None):
+    """
+    Registers handlers to the botocore events of a client that wait for
+    limiter before every call, if given, and record the calls in metrics
+    and in the ApiMetrics tracking the thread making them
+    """
+    # botocore sends a request on the thread making the call
+    calls = threading.local()
+
+    def before_send(event_name, **kwargs):
+        calls.waited = limiter.acquire() if limiter else 0
+        calls.start = time.monotonic()
+
+    def needs_retry(event_name, response=None, caught_exception=None,
+                    **kwargs):
+        latency = time.monotonic() - getattr(calls, 'start', time.monotonic())
+        code = None
+        if response:
+            code = response[1].get('Error', {}).get('Code')
+        throttled = code in THROTTLE_CODES
+        error = caught_exception is not None or code is not None
+        if limiter:
+            if throttled:
+                limiter.throttled()
+            elif not error:
+                limiter.succeeded()
+        operation = event_name.split('.', 1)[1]
+        for tracking in (metrics,) + getattr(_tracked, 'metrics', ()):
+            tracking.record(operation, latency, getattr(calls, 'waited', 0),
+                            error, throttled)
+
+    events.register('before-send', before_send)
+    events.register('needs-retry', needs_retry)
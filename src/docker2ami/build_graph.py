@@ -0,0 +1,181 @@
+import concurrent.futures
+import configparser
+import os
+
+from os.path import dirname, isfile, join
+
+from .executor import cancel_running, sigterm_interrupts
+from .parser import AbstractParserDelegate, FROM_REGEX, \
+    parse_dockerfile_with_delegate
+
+
+# Keys of a manifest target that are not configuration keys
+TARGET_KEYS = ('context', 'from')
+
+# Seconds between the cancellations of the builds after an interrupt, which
+# also stop the builds that were about to start their builder
+CANCEL_INTERVAL = 1
+
+
+class FromDelegate(AbstractParserDelegate):
+    """ ParserDelegate that finds the image of the first FROM line """
+    def __init__(self):
+        self.image = None
+
+    def run_unknown(self, line):
+        match = FROM_REGEX.match(line)
+        if match and self.image is None:
+            self.image = match.group(1)
+
+
+class GraphTarget(object):
+    """
+    Target of a manifest: the Dockerfile in source_dir, built with the
+    configuration keys of overrides from the AMI of the target upstream if
+    any. children are the targets that start from its AMI.
+    """
+    def __init__(self, name, source_dir, overrides, upstream=None):
+        self.name = name
+        self.source_dir = source_dir
+        self.overrides = overrides
+        self.upstream = upstream
+        self.children = []
+
+    def __str__(self):
+        return f'{self.name} ({self.source_dir})'
+
+
+def read_manifest(path, config_keys):
+    """
+    Returns the GraphTargets of the manifest at path, an INI file with a
+    section per target whose name is the image name of its AMI by default.
+    context is the directory of its Dockerfile, relative to the manifest and
+    the name of the target by default. from is the target whose AMI it
+    starts from, by default the one the FROM line of its Dockerfile names if
+    any, whose AMI is then its image_id. The other keys, the DEFAULT section
+    included, override the config_keys of the configuration. Raises
+    ValueError if the manifest is invalid.
+    """
+    manifest = configparser.ConfigParser()
+    manifest.read(path)
+    if not manifest.sections():
+        raise ValueError(f'The manifest has no targets: {path}')
+    targets = []
+    for name in manifest.sections():
+        overrides = dict(manifest.items(name))
+        unknown = sorted(set(overrides) - set(TARGET_KEYS) - set(config_keys))
+        if unknown:
+            raise ValueError(f'Unknown configuration keys of {name}: '
+                             f'{", ".join(unknown)}')
+        source_dir = join(dirname(path), overrides.pop('context', name))
+        dockerfile_path = join(source_dir, 'Dockerfile')
+        if not isfile(dockerfile_path):
+            raise ValueError(f'Dockerfile of {name} doesn\'t exist: '
+                             f'{dockerfile_path}')
+        upstream = overrides.pop('from', None)
+        if upstream is None:
+            delegate = FromDelegate()
+            with open(dockerfile_path, 'r') as dockerfile:
+                parse_dockerfile_with_delegate(dockerfile, delegate)
+            # Other images are left to image_id
+            if delegate.image in manifest.sections():
+                upstream = delegate.image
+        elif upstream not in manifest.sections():
+            raise ValueError(f'{name} starts from an unknown target: '
+                             f'{upstream}')
+        overrides.setdefault('image_name', name)
+        targets.append(GraphTarget(name, os.path.normpath(source_dir),
+                                   overrides, upstream))
+    return targets
+
+
+def plan_build_graph(targets, names=None):
+    """
+    Returns the GraphTargets of targets that start from no other target,
+    with the targets that start from them as children. With names, only
+    those targets and the targets they start from are built. Raises
+    ValueError if a name is unknown or targets start from each other.
+    """
+    by_name = {target.name: target for target in targets}
+    for name in names or ():
+        if name not in by_name:
+            raise ValueError(f'Unknown target: {name}')
+    for target in targets:
+        chain = [target.name]
+        upstream = target.upstream
+        while upstream:
+            if upstream in chain:
+                raise ValueError(f'Targets start from each other: '
+                                 f'{" <- ".join(chain + [upstream])}')
+            chain.append(upstream)
+            upstream = by_name[upstream].upstream
+
+    selected = set()
+    for name in names or by_name:
+        while name and name not in selected:
+            selected.add(name)
+            name = by_name[name].upstream
+    roots = []
+    for target in targets:
+        target.children = []
+    for target in targets:
+        if target.name not in selected:
+            continue
+        if target.upstream:
+            by_name[target.upstream].children.append(target)
+        else:
+            roots.append(target)
+    return roots
+
+
+def iter_graph(roots, depth=0):
+    """ Yields the (depth, node) of roots and their children """
+    for node in roots:
+        yield depth, node
+        yield from iter_graph(node.children, depth + 1)
+
+
+def run_build_graph(roots, build, jobs=4, cancel=cancel_running):
+    """
+    Runs build(node, image_id) for roots and their children, jobs at a time,
+    image_id being the AMI the build of the parent of node returned or None
+    for the roots. A node starts as soon as its parent finishes. Returns the
+    AMI ID of every node, or the exception that failed its build or the
+    build of a node before it. On an interrupt, or SIGTERM in the main
+    thread, the builds that did not start are dropped and cancel() stops
+    the running ones, which are torn down before the interrupt is raised.
+    """
+    results = {}
+
+    def fail(node, error):
+        for _, failed in iter_graph([node]):
+            results[failed] = error
+
+    with sigterm_interrupts(), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = {pool.submit(build, node, None): node for node in roots}
+        try:
+            while running:
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        image_id = future.result()
+                    except (Exception, SystemExit) as e:
+                        # Such as the SystemExit of a failed step
+                        fail(node, e)
+                        continue
+                    results[node] = image_id
+                    for child in node.children:
+                        running[pool.submit(build, child, image_id)] = child
+        except KeyboardInterrupt:
+            for future in running:
+                future.cancel()
+            pending = set(running)
+            while pending:
+                cancel()
+                _, pending = concurrent.futures.wait(pending,
+                                                     CANCEL_INTERVAL)
+            raise
+    return results
@@ -0,0 +1,186 @@
+import codecs
+import collections
+import gzip
+import os
+import threading
+
+from os.path import expanduser
+from sys import stdout
+
+from .color import Color
+
+
+# Serializes the terminal output of steps that run concurrently
+_stdout_lock = threading.Lock()
+
+
+class BuildLog(object):
+    """
+    Append-only log of the output of every step. The output is compressed in
+    chunks that are independent gzip members, so the log is a regular gzip
+    file and any chunk can be read without decompressing the ones before it.
+    The index file next to it holds one "step offset length" line per chunk.
+    """
+
+    # Uncompressed size at which the output of a step starts a new chunk
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path, mode='r'):
+        """
+        Opens the log at path for reading, or truncates it for writing when
+        mode is 'w'
+        """
+        self.path = expanduser(path)
+        self.index_path = f'{self.path}.idx'
+        self._data = None
+        self._index = None
+        self._pending = {}
+        self._lock = threading.RLock()
+        if mode == 'w':
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            self._data = open(self.path, 'wb')
+            self._index = open(self.index_path, 'w')
+
+    def write(self, step, data):
+        """ Appends data to the output of step """
+        with self._lock:
+            pending = self._pending.setdefault(step, bytearray())
+            pending += data
+            if len(pending) >= self.CHUNK_SIZE:
+                self.flush(step)
+
+    def flush(self, step):
+        """ Writes the buffered output of step as a chunk """
+        with self._lock:
+            pending = self._pending.pop(step, None)
+            if not pending:
+                return
+            chunk = gzip.compress(bytes(pending))
+            offset = self._data.tell()
+            self._data.write(chunk)
+            self._data.flush()
+            self._index.write(f'{step} {offset} {len(chunk)}\n')
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            if self._data:
+                for step in list(self._pending):
+                    self.flush(step)
+                self._data.close()
+                self._index.close()
+                self._data = self._index = None
+
+    def chunks(self, step):
+        """ Returns the (offset, length) of the chunks of step in order """
+        with open(self.index_path) as f:
+            return [(int(offset), int(length))
+                    for (s, offset, length) in (line.split() for line in f)
+                    if int(s) == step]
+
+    def steps(self):
+        """ Returns the steps that have output in the log """
+        with open(self.index_path) as f:
+            return sorted({int(line.split()[0]) for line in f})
+
+    def read(self, step):
+        """ Yields the uncompressed output of step chunk by chunk """
+        chunks = self.chunks(step)
+        with open(self.path, 'rb') as f:
+            for offset, length in chunks:
+                f.seek(offset)
+                yield gzip.decompress(f.read(length))
+
+    def tail(self, step, lines):
+        """
+        Returns the last lines lines of the output of step, decompressing
+        only the chunks that hold them
+        """
+        data = b''
+        with open(self.path, 'rb') as f:
+            for offset, length in reversed(self.chunks(step)):
+                f.seek(offset)
+                data = gzip.decompress(f.read(length)) + data
+                if data.count(b'\n', 0, -1) >= lines:
+                    break
+        return b''.join(data.splitlines(True)[-lines:]) if lines else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+class StepOutput(object):
+    """
+    Receives the output of one step. Without a build log the output is
+    echoed to the terminal as it arrives. With one it is written to the log
+    and only the last tail_lines lines are kept, to be echoed when the step
+    ends. When prefix is given, the output is echoed in whole lines that
+    start with prefix so that concurrent steps can be told apart. The
+    output is also emitted to events, if given, as it arrives.
+    """
+    def __init__(self, step, build_log=None, tail_lines=20, prefix=None,
+                 events=None):
+        self._step = step
+        self._build_log = build_log
+        self._prefix = prefix
+        self._events = events
+        self._decoder = codecs.getincrementaldecoder('utf8')('replace')
+        self._tail = collections.deque(maxlen=tail_lines)
+        self._partial = ''
+        self._lines = 0
+
+    def _echo(self, text):
+        with _stdout_lock:
+            stdout.write(text)
+            stdout.flush()
+
+    def _echo_lines(self, lines):
+        self._echo(''.join(f'{Color.YELLOW}{self._prefix}{line}{Color.CLEAR}\n'
+                           for line in lines))
+
+    def write(self, data):
+        text = self._decoder.decode(data)
+        if self._events and text:
+            self._events.emit('output', step=self._step, text=text)
+        if self._build_log:
+            self._build_log.write(self._step, data)
+        elif not self._prefix:
+            self._echo(f'{Color.YELLOW}{text}{Color.CLEAR}')
+            return
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        self._lines += len(lines)
+        if self._build_log:
+            self._tail.extend(lines)
+        elif lines:
+            self._echo_lines(lines)
+
+    def close(self):
+        """ Echoes the kept lines and completes the step in the log """
+        text = self._decoder.decode(b'', final=True)
+        if self._events and text:
+            self._events.emit('output', step=self._step, text=text)
+        if not self._build_log and not self._prefix:
+            self._echo(f'{Color.YELLOW}{text}{Color.CLEAR}')
+            return
+        lines = [self._partial + text] if self._partial + text else []
+        self._lines += len(lines)
+        if not self._build_log:
+            self._echo_lines(lines)
+            return
+        self._tail.extend(lines)
+        self._build_log.flush(self._step)
+        skipped = self._lines - len(self._tail)
+        if skipped:
+            self._echo(f'{Color.DARK_GREY}{self._prefix or ""}... {skipped} '
+                       f'more lines in {self._build_log.path}, see '
+                       f'docker-build-ami log {self._step}{Color.CLEAR}\n')
+        if self._prefix:
+            self._echo_lines(self._tail)
+        elif self._tail:
+            self._echo(f'{Color.YELLOW}' + '\n'.join(self._tail)
+                       + f'{Color.CLEAR}\n')
@@ -0,0 +1,168 @@
+import logging
+import shlex
+
+from os.path import join
+
+
+logger = logging.getLogger(__name__)
+
+# Tag whose value is the name of the cache a snapshot belongs to
+CACHE_TAG = 'docker-build-ami-cache'
+
+# Where the cache volume is mounted on the builder
+MOUNT_DIR = '/mnt/docker-build-ami-cache'
+
+# Device name the cache volume is attached as
+DEVICE_NAME = '/dev/sdf'
+
+# Default package cache directories
+CACHE_DIRS = ['/var/cache/apt/archives', '/var/cache/yum', '/root/.cache/pip']
+
+# How long to wait for a new snapshot of the cache to complete, 30 minutes
+SNAPSHOT_WAITER_CONFIG = {'Delay': 15, 'MaxAttempts': 120}
+
+
+class CacheVolume(object):
+    """
+    EBS volume, restored from the latest snapshot of the cache name, that is
+    bind-mounted over the package cache directories of the builder while the
+    steps run. It is detached before the AMI is created so it never ends up
+    in it, then saved as a new snapshot of the cache, of which the newest
+    kept snapshots are retained.
+    """
+    def __init__(self, ec2, name, size, dirs, kept, tags=()):
+        """
+        ec2 is a boto3 EC2 client. size is the size in GiB of a new cache.
+        """
+        self._ec2 = ec2
+        self._name = name
+        self._size = size
+        self._dirs = dirs
+        self._kept = kept
+        self._tags = list(tags)
+        self.volume_id = None
+
+    def _snapshots(self, **filters):
+        """ Returns the snapshots of the cache, the newest first """
+        response = self._ec2.describe_snapshots(
+            OwnerIds=['self'],
+            Filters=[{'Name': f'tag:{CACHE_TAG}', 'Values': [self._name]}]
+            + [{'Name': key, 'Values': [value]}
+               for key, value in filters.items()])
+        return sorted(response['Snapshots'], key=lambda s: s['StartTime'],
+                      reverse=True)
+
+    def _cache_tags(self):
+        return self._tags + [{'Key': 'Name', 'Value': self._name},
+                             {'Key': CACHE_TAG, 'Value': self._name}]
+
+    def create(self, availability_zone):
+        """ Creates the volume from the latest completed snapshot """
+        snapshots = self._snapshots(status='completed')
+        kwargs = {
+            'AvailabilityZone': availability_zone,
+            'VolumeType': 'gp3',
+            'TagSpecifications': [
+                {'ResourceType': 'volume', 'Tags': self._cache_tags()}],
+        }
+        if snapshots:
+            kwargs['SnapshotId'] = snapshots[0]['SnapshotId']
+            kwargs['Size'] = max(self._size, snapshots[0]['VolumeSize'])
+        else:
+            kwargs['Size'] = self._size
+        self.volume_id = self._ec2.create_volume(**kwargs)['VolumeId']
+        print(f'Cache volume: {self.volume_id} from '
+              f'{kwargs.get("SnapshotId", "scratch")}')
+
+    def attach(self, instance_id):
+        self._ec2.get_waiter('volume_available').wait(
+            VolumeIds=[self.volume_id])
+        self._ec2.attach_volume(Device=DEVICE_NAME, InstanceId=instance_id,
+                                VolumeId=self.volume_id)
+        self._ec2.get_waiter('volume_in_use').wait(VolumeIds=[self.volume_id])
+
+    def _cache_dir(self, path):
+        return join(MOUNT_DIR, path.strip('/').replace('/', '_'))
+
+    def mount_cmd(self):
+        """
+        Returns the command that mounts the volume, creating its file
+        system if it is new, and binds it over the cache directories. An
+        empty cache starts with what the directory holds.
+        """
+        nvme = ('/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_'
+                + self.volume_id.replace('-', ''))
+        lines = [
+            'set -e',
+            'for i in $(seq 120); do',
+            f'  for dev in {nvme} /dev/xvdf {DEVICE_NAME}; do',
+            '    [ -b $dev ] && break 2',
+            '  done',
+            '  sleep 1',
+            'done',
+            '[ -b $dev ]',
+            'blkid $dev > /dev/null || mkfs -t ext4 -q $dev',
+            f'mkdir -p {MOUNT_DIR}',
+            f'mount $dev {MOUNT_DIR}',
+        ]
+        for path in self._dirs:
+            src, dst = self._cache_dir(path), shlex.quote(path)
+            lines += [
+                f'mkdir -p {src} {dst}',
+                f'[ -n "$(ls -A {src})" ] || cp -a {dst}/. {src}/',
+                f'mount --bind {src} {dst}',
+            ]
+        return '\n'.join(lines)
+
+    def unmount_cmd(self):
+        """ Returns the command that undoes mount_cmd() """
+        return '; '.join(
+            ['set -e', 'sync']
+            + [f'umount {shlex.quote(path)}' for path in reversed(self._dirs)]
+            + [f'umount {MOUNT_DIR}'])
+
+    def detach(self):
+        self._ec2.detach_volume(VolumeId=self.volume_id)
+        self._ec2.get_waiter('volume_available').wait(
+            VolumeIds=[self.volume_id])
+
+    def save(self):
+        """
+        Snapshots the detached volume as the latest snapshot of the cache
+        and, once the snapshot is completed, deletes the snapshots beyond
+        the newest kept ones. If it fails the older snapshots are kept.
+        """
+        snapshot_id = self._ec2.create_snapshot(
+            VolumeId=self.volume_id,
+            Description=f'docker-build-ami cache {self._name}',
+            TagSpecifications=[
+                {'ResourceType': 'snapshot', 'Tags': self._cache_tags()}],
+        )['SnapshotId']
+        print(f'Cache snapshot: {snapshot_id}')
+        try:
+            self._ec2.get_waiter('snapshot_completed').wait(
+                SnapshotIds=[snapshot_id], WaiterConfig=SNAPSHOT_WAITER_CONFIG)
+        except Exception as e:
+            # Such as the WaiterError of a snapshot in the error state
+            logger.warning(f'Cache snapshot {snapshot_id} did not complete, '
+                           f'keeping the older snapshots: {e}')
+            return
+        older = [s['SnapshotId'] for s in self._snapshots()
+                 if s['SnapshotId'] != snapshot_id]
+        for old_id in older[max(self._kept - 1, 0):]:
+            logger.info(f'Deleting cache snapshot: {old_id}')
+            self._ec2.delete_snapshot(SnapshotId=old_id)
+
+    def delete(self):
+        """ Deletes the volume once the instance no longer uses it """
+        if not self.volume_id:
+            return
+        try:
+            self._ec2.get_waiter('volume_available').wait(
+                VolumeIds=[self.volume_id])
+            self._ec2.delete_volume(VolumeId=self.volume_id)
+        except Exception as e:
+            logger.warning(
+                f'Unable to delete cache volume {self.volume_id}: {e}')
+        finally:
+            self.volume_id = None
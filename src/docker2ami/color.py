@@ -0,0 +1,5 @@
+class Color:
+    RED = '\033[31m'
+    YELLOW = '\033[33m'
+    DARK_GREY = '\033[90m'
+    CLEAR = '\033[0m'
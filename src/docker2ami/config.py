@@ -0,0 +1,66 @@
+import configparser
+import re
+
+
+# Formats of the build context archive
+ARCHIVE_FORMATS = ('tar.gz', 'indexed')
+
+# Retry modes of the AWS clients
+RETRY_MODES = ('legacy', 'standard', 'adaptive')
+
+# EBS volume types of the root volume of the builder
+VOLUME_TYPES = ('gp2', 'gp3', 'io1', 'io2', 'st1', 'sc1', 'standard')
+
+# Matches durations such as 90, 90s, 30m or 2h
+DURATION_REGEX_STR = r'(\d+)([smh]?)'
+DURATION_REGEX = re.compile(DURATION_REGEX_STR + '$')
+
+# Seconds of the duration units, no unit being seconds
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600}
+
+
+def is_true(value):
+    """ Whether the configuration value is true like ConfigParser has it """
+    return configparser.ConfigParser.BOOLEAN_STATES.get(
+        str(value).lower(), False)
+
+
+def parse_duration(value):
+    """
+    Returns the seconds of a duration such as 90, 90s, 30m or 2h. Raises
+    ValueError if value is not one.
+    """
+    match = DURATION_REGEX.match(str(value).strip())
+    if not match:
+        raise ValueError(f'Invalid duration: {value}')
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+class AwsConfig(object):
+    """
+    Holds AWS configuration info for the AMI Builder.
+    """
+    def __init__(self, config, section, overrides):
+        """
+        Initialize configuration information from the given config file and
+        section. overrides is an object that will ovverde the values in config.
+        """
+        key_names = [
+            'host_tag', 'tmp_dir', 'image_name', 'region', 'instance_type',
+            'subnet_id', 'image_id', 'image_user', 'aws_access_key_id',
+            'aws_secret_access_key', 'security_group_ids', 'host_tags',
+            'image_tags', 'log_file', 'log_tail_lines', 'archive_format',
+            'cache_volume', 'cache_volume_size', 'cache_dirs',
+            'cache_snapshots_kept', 'max_pool_connections', 'retry_mode',
+            'api_rate_limit', 'reuse_image', 'ssh_keepalive', 'ssh_retries',
+            'cloud_init_ready', 'step_timeout', 'idle_timeout',
+            'history_file', 'regression_threshold', 'root_volume_size',
+            'root_volume_type', 'root_volume_iops', 'root_volume_throughput',
+            'instance_store_scratch', 'prewarm_root_volume',
+        ]
+        for key in key_names:
+            setattr(self, key,
+                    getattr(overrides, key)
+                    if hasattr(overrides, key) and
+                    not getattr(overrides, key) is None
+                    else config.get(section, key))
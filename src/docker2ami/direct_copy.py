@@ -0,0 +1,176 @@
+import os
+import re
+
+from os.path import basename, dirname, join, normpath
+
+from .parser import AbstractParserDelegate, LOCAL_ARCHIVE_REGEX, \
+    is_url_arg, parse_dockerfile_with_delegate
+
+
+# Matches paths that mean the same to the shell of a step and to tar
+PLAIN_PATH_REGEX = re.compile(r'^[\w.,+@%:/-]+$')
+
+
+def _is_under(path, parent):
+    """ Whether path is parent or below it, both relative to the context """
+    return parent == '.' or path == parent or path.startswith(f'{parent}/')
+
+
+class DirectCopyPlanner(AbstractParserDelegate):
+    """
+    ParserDelegate that finds the COPY and ADD steps whose files can be
+    placed at their destination along with the build context: those before
+    the first RUN step that copy a plain local path to a plain destination.
+    The steps are numbered like SimpleStateParserDelegate numbers them.
+    """
+    def __init__(self, source_dir='.'):
+        # step -> (src, dst, whether dst is a directory)
+        self.placements = {}
+        # Sources of the other COPY and ADD steps, None if unknown
+        self.sources = set()
+        self._source_dir = source_dir
+        self._step = 0
+        self._skip = False
+        self._workdir = None
+        self._after_run = False
+
+    def _next_step(self):
+        """ Returns the number of the next step, None if it is skipped """
+        if self._skip:
+            self._skip = False
+            return None
+        self._step += 1
+        return self._step
+
+    def _plan(self, step, src, dst):
+        if step is None:
+            return
+        src = normpath(src)
+        if (not PLAIN_PATH_REGEX.match(src) or os.path.isabs(src)
+                or src.startswith('..')
+                or not os.path.lexists(join(self._source_dir, src))):
+            self.sources = None
+            return
+        if (self._after_run or not PLAIN_PATH_REGEX.match(dst)
+                or not (os.path.isabs(dst) or self._workdir)):
+            self._add_source(src)
+            return
+        self.placements[step] = (
+            src, normpath(join(self._workdir or '/', dst)), dst.endswith('/'))
+
+    def _add_source(self, src):
+        if self.sources is not None:
+            self.sources.add(src)
+
+    def run_skip(self):
+        self._skip = True
+
+    def run_env(self, key, value):
+        self._next_step()
+
+    def run_run(self, cmds):
+        if self._next_step() is not None:
+            self._after_run = True
+
+    def run_copy(self, src, dst):
+        self._plan(self._next_step(), src, dst)
+
+    def run_add(self, src, dst):
+        step = self._next_step()
+        if is_url_arg(src):
+            return
+        if LOCAL_ARCHIVE_REGEX.match(src):
+            if step is not None:
+                self._add_source(normpath(src))
+            return
+        self._plan(step, src, dst)
+
+    def run_workdir(self, path):
+        if self._next_step() is None:
+            return
+        if not PLAIN_PATH_REGEX.match(path):
+            self._workdir = None
+        elif os.path.isabs(path) or self._workdir:
+            self._workdir = normpath(join(self._workdir or '/', path))
+
+
+def plan_direct_copies(fp, source_dir='.', steps=None):
+    """
+    Parses the Dockerfile in fp, whose build context is source_dir, and
+    returns its DirectCopyPlanner. With steps, only the steps in that range
+    are placed, since the image already holds those before it and the steps
+    after them may have changed their files.
+    """
+    planner = DirectCopyPlanner(source_dir)
+    parse_dockerfile_with_delegate(fp, planner)
+    if steps is not None:
+        planner.placements = {step: placement for step, placement
+                              in planner.placements.items() if step in steps}
+    return planner
+
+
+def resolve_targets(placements, kinds, source_dir='.'):
+    """
+    Returns step -> target path for the placements of a DirectCopyPlanner,
+    the target being where `cp -rf src dst` would put src. kinds maps each
+    destination to 'd' for a directory, 'l' for a symbolic link or '-' for
+    anything else on the builder. Symbolic links are left to cp.
+    """
+    targets = {}
+    dirs = set()
+    for step in sorted(placements):
+        src, dst, is_dir = placements[step]
+        kind = kinds.get(dst, '-')
+        if kind == 'l':
+            continue
+        if src != '.' and (is_dir or kind == 'd' or dst in dirs):
+            target = join(dst, basename(src))
+        else:
+            target = dst
+        targets[step] = target
+        if os.path.isdir(join(source_dir, src)):
+            dirs.add(target)
+        parent = dirname(target)
+        while parent not in dirs and parent != '/':
+            dirs.add(parent)
+            parent = dirname(parent)
+    return targets
+
+
+def context_filter(placements, targets, sources, prefix):
+    """
+    Returns a tarfile filter for the context, archived below prefix, that
+    leaves out the files that are placed at their targets and that no other
+    step copies from the context. sources are those of DirectCopyPlanner.
+    """
+    if sources is None:
+        return None
+    needed = sources | {placements[step][0] for step in placements
+                        if step not in targets}
+    placed = {placements[step][0] for step in targets}
+
+    def filter(tarinfo):
+        path = os.path.relpath(tarinfo.name, prefix)
+        if (any(_is_under(path, src) for src in placed)
+                and not any(_is_under(path, src) or _is_under(src, path)
+                            for src in needed)):
+            return None
+        return tarinfo
+    return filter
+
+
+def _owned_by_root(tarinfo):
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = 'root'
+    return tarinfo
+
+
+def add_placed_files(tar, placements, targets, source_dir='.'):
+    """
+    Adds the sources of the placed steps to tar under their targets
+    relative to /, owned by root like the files cp creates
+    """
+    for step in sorted(targets):
+        tar.add(join(source_dir, placements[step][0]),
+                arcname=targets[step].lstrip('/') or '.',
+                filter=_owned_by_root)
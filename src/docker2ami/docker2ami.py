@@ -1,52 +1,218 @@
 import argparse
 import colorlog
 import configparser
+import contextlib
+import copy
+import datetime
+import json
 import logging
 import os
-import re
 import sys
+import time
+import uuid
 
-from .ami_builder import AmiBuilder, AwsConfig, Color
-from .parser import AbstractParserDelegate, ParserState, \
-    SimpleStateParserDelegate, is_url_arg, parse_dockerfile_with_delegate
+from .build_graph import iter_graph, plan_build_graph, read_manifest, \
+    run_build_graph
+from .build_log import BuildLog
+from .cache_volume import CACHE_DIRS
+from .color import Color
+from .config import ARCHIVE_FORMATS, AwsConfig, is_true
+from .events import EventWriter, JsonEvents, TakenStdout
+from .local_executor import LocalExecutor
+from .direct_copy import plan_direct_copies
+from .fingerprint import compute_fingerprint, find_image, step_fingerprints
+from .parser import AbstractParserDelegate, LOCAL_ARCHIVE_REGEX, \
+    ParserState, SimpleStateParserDelegate, is_url_arg, \
+    parse_dockerfile_with_delegate
+from .preflight import preflight
+from .prune import find_images, parse_protected_tag, plan_prune, \
+    prune_images, pruned_snapshots
+from .tty_renderer import TtyRenderer
+
+# ami_builder and service are imported when needed, since boto3 and paramiko
+# take longer to import than most commands take to run. So are history, with
+# sqlite3, and estimate and prefix_sharing, which only some commands use.
 
 
 class Docker2AmiParserDelegate(AbstractParserDelegate):
     """
-    ParserDelegate that creates an AMI using an AmiBuilder
+    ParserDelegate that creates an image using an executor such as AmiBuilder
     """
-    def __init__(self, ami_builder, parser_state):
-        self._ami_builder = ami_builder
+    def __init__(self, executor, parser_state, placed_steps=(), steps=None):
+        """
+        placed_steps are the COPY and ADD steps whose files send_archive()
+        already placed at their destination. steps is the range of the steps
+        to run when the image already holds those before it. ENV and WORKDIR
+        steps run regardless, since they only change what the commands after
+        them see.
+        """
+        self._executor = executor
         self._parser_state = parser_state
+        self._placed_steps = placed_steps
+        self._steps = steps
+        self._parallel_cmds = None
+        self._parallel_fetches = []
+
+    def _run_cmd(self, cmd):
+        """ Runs cmd now, or with the group when in an AWS-PARALLEL group """
+        if self._parallel_cmds is None:
+            self._executor.run_cmd(cmd, self._parser_state.step)
+        else:
+            self._parallel_cmds.append((cmd, self._parser_state.step))
+
+    def _run_context_cmd(self, src, cmd):
+        """ Runs cmd, which reads src from the build context """
+        fetch = self._executor.fetch_context(src)
+        if fetch and self._parallel_cmds is not None:
+            # Steps of a group may need the same files, which are fetched
+            # once before the group starts
+            self._parallel_fetches.append(fetch)
+        elif fetch:
+            cmd = f'{fetch} && {cmd}'
+        self._run_cmd(cmd)
+
+    def _run_parallel_cmds(self):
+        cmds, self._parallel_cmds = self._parallel_cmds, []
+        fetches, self._parallel_fetches = self._parallel_fetches, []
+        if fetches:
+            self._executor.run_cmd(' && '.join(fetches), cmds[0][1])
+        if len(cmds) > 1:
+            self._executor.run_parallel(cmds)
+        elif cmds:
+            self._executor.run_cmd(*cmds[0])
+
+    def _update_env(self, statement):
+        # The commands before the statement must not see it
+        if self._parallel_cmds:
+            logging.warning('ENV and WORKDIR split AWS-PARALLEL groups')
+            self._run_parallel_cmds()
+        self._executor.update_env(statement)
+
+    def run_parallel_start(self):
+        self._parallel_cmds = []
+
+    def run_parallel_end(self):
+        self._run_parallel_cmds()
+        self._parallel_cmds = None
+
+    def run_timeout(self, timeout, idle_timeout):
+        # The annotation applies to the step that follows it
+        self._executor.set_timeouts(self._parser_state.step + 1, timeout,
+                                    idle_timeout)
+
+    def _is_left_out(self):
+        return self._steps is not None and \
+            self._parser_state.step not in self._steps
+
+    def run_env(self, key, value):
+        self._update_env(f'{key}={value}')
 
     def run_run(self, cmds):
-        self._ami_builder.run_cmd(self._parser_state.env, cmds)
+        if not self._is_left_out():
+            self._run_cmd(cmds)
+
+    def _check_destination(self, path):
+        """ Stops the build if the executor cannot build a step to path """
+        problem = self._executor.check_destination(path)
+        if problem:
+            logging.critical(f'Step {self._parser_state.step}: {problem}')
+            exit(1)
+
+    def _is_placed(self):
+        if self._parser_state.step in self._placed_steps:
+            logging.info(f'Step {self._parser_state.step} was placed with '
+                         'the build context')
+            return True
+        return False
 
     def run_copy(self, src, dst):
-        self._ami_builder.run_cmd(self._parser_state.env,
-                                  f'cp -rf /tmp/docker-build-ami/{src} {dst}')
+        if self._is_left_out():
+            return
+        self._check_destination(dst)
+        if not self._is_placed():
+            self._run_context_cmd(
+                src, f'cp -rf {self._executor.context_dir}/{src} {dst}')
 
     def run_add(self, src, dst):
+        if self._is_left_out():
+            return
+        self._check_destination(dst)
         if is_url_arg(src):
             dst = os.path.basename(src) if dst == '.' else dst
-            self._ami_builder.run_cmd(
-                self._parser_state.env, f'curl {src} -o {dst}')
-        else:
-            if re.match(r'.*\.(tgz|tar|tar\.gz|tar\.bz|tar\.xz)$', src):
-                self._ami_builder.run_cmd(
-                    self._parser_state.env,
-                    f'tar -xpvf /tmp/docker-build-ami/{src} -C {dst}')
+            self._run_cmd(f'curl {src} -o {dst}')
+        elif not self._is_placed():
+            if LOCAL_ARCHIVE_REGEX.match(src):
+                self._run_context_cmd(
+                    src,
+                    f'tar -xpvf {self._executor.context_dir}/{src} -C {dst}')
             else:
-                self._ami_builder.run_cmd(
-                    self._parser_state.env,
-                    f'cp -rf /tmp/docker-build-ami/{src} {dst}')
+                self._run_context_cmd(
+                    src, f'cp -rf {self._executor.context_dir}/{src} {dst}')
+
+    def run_workdir(self, path):
+        self._check_destination(path)
+        self._update_env(f'cd {path}')
+
+    def run_unknown(self, line):
+        print(f'{Color.YELLOW}Unknown Command: {line}{Color.CLEAR}')
+
+
+class PlanParserDelegate(AbstractParserDelegate):
+    """
+    ParserDelegate that prints how the steps printed by
+    SimpleStateParserDelegate would be built, without building them
+    """
+    def __init__(self, parser_state, placements=None):
+        """
+        placements are those of a DirectCopyPlanner of the Dockerfile, if
+        direct copy is used
+        """
+        self._parser_state = parser_state
+        self._placements = placements or {}
+        self._parallel_groups = 0
+
+    def run_parallel_start(self):
+        self._parallel_groups += 1
+        print(f'AWS-PARALLEL group {self._parallel_groups}:')
+
+    def run_parallel_end(self):
+        print(f'End of AWS-PARALLEL group {self._parallel_groups}')
+
+    def _print_placement(self):
+        if self._parser_state.step in self._placements:
+            src, dst, is_dir = self._placements[self._parser_state.step]
+            print(f'  Placed at {dst}{"/" if is_dir else ""} with the build '
+                  'context')
+
+    def run_copy(self, src, dst):
+        self._print_placement()
+
+    def run_add(self, src, dst):
+        if not is_url_arg(src):
+            self._print_placement()
 
     def run_unknown(self, line):
         print(f'{Color.YELLOW}Unknown Command: {line}{Color.CLEAR}')
 
 
+# Values of --progress
+PROGRESS_MODES = ('auto', 'plain', 'tty', 'json')
+
+
 def create_arg_parser():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='commands:\n'
+               '  graph    build the targets of a manifest in dependency '
+               'order\n'
+               '  history  print past builds and the timings of their steps\n'
+               '  log      print the output of a step from the build log\n'
+               '  multi    build several Dockerfiles sharing their common '
+               'steps\n'
+               '  plan     print the steps of a Dockerfile without building\n'
+               '  prune    deregister old AMIs and delete their snapshots\n'
+               '  serve    run a build service accepting jobs over HTTP\n'
+               'see docker-build-ami <command> -h')
     parser.add_argument('-c', '--config', help='Configuration file')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Print debug info')
@@ -56,6 +222,220 @@ def create_arg_parser():
     parser.add_argument('-n', '--image-name', help='Target AMI image name')
     parser.add_argument('-i', '--image-id', help='Source AMI image ID')
     parser.add_argument('-u', '--image-user', help='AMI image user')
+    parser.add_argument('-l', '--local', metavar='ROOT_DIR',
+                        help='Run the steps in a local directory instead of '
+                             'on EC2 and save the changes as a tarball')
+    parser.add_argument('--chroot', action='store_true',
+                        help='Run local steps in a chroot of ROOT_DIR')
+    parser.add_argument('-f', '--log-file',
+                        help='Write the output of every step to this build '
+                             'log and only show the last lines of each step')
+    parser.add_argument('--cache-volume', metavar='NAME',
+                        help='Keep the package caches on a volume restored '
+                             'from the latest snapshot of this cache')
+    parser.add_argument('--archive-format', choices=ARCHIVE_FORMATS,
+                        help='Format of the build context archive')
+    parser.add_argument('--direct-copy', action='store_true',
+                        help='Place the files of COPY and ADD steps before '
+                             'the first RUN at their destination when '
+                             'uploading the build context')
+    parser.add_argument('--skip-preflight', action='store_true',
+                        help='Do not check the build context, the '
+                             'configuration and its AWS resources before '
+                             'launching the builder')
+    parser.add_argument('--reuse-image', action='store_const', const='true',
+                        help='Return the AMI of an earlier build with the '
+                             'same inputs instead of building it again')
+    parser.add_argument('--progress', choices=PROGRESS_MODES,
+                        default='auto',
+                        help='How to report the progress of the build: '
+                             'plain text, a live status area on a terminal '
+                             'with the full output in a file, or JSON lines '
+                             'on stdout with the rest of the output on '
+                             'stderr. auto is tty on a terminal and plain '
+                             'otherwise')
+    parser.add_argument('--build-id',
+                        help='ID of the build in its JSON events and the '
+                             'name of its output file, a random one by '
+                             'default')
+    return parser
+
+
+def create_log_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='docker-build-ami log',
+        description='Print the output of a step from the build log')
+    parser.add_argument('step', type=int, nargs='?',
+                        help='Step number, 0 being the build preparation. '
+                             'Lists the logged steps when omitted')
+    parser.add_argument('-c', '--config', help='Configuration file')
+    parser.add_argument('-f', '--log-file', help='Build log file')
+    parser.add_argument('-n', '--tail', type=int, metavar='LINES',
+                        help='Only print the last LINES lines')
+    return parser
+
+
+def create_history_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='docker-build-ami history',
+        description='Print past builds and the timings of their steps')
+    parser.add_argument('build_id', nargs='?',
+                        help='Print the steps of the build with this ID or '
+                             'ID prefix. Lists the builds when omitted')
+    parser.add_argument('-c', '--config', help='Configuration file')
+    parser.add_argument('-f', '--history-file', help='History database')
+    parser.add_argument('-n', '--image-name',
+                        help='Only list the builds of this image name')
+    parser.add_argument('-s', '--step', metavar='FINGERPRINT',
+                        help='List the runs of the step with this '
+                             'fingerprint or fingerprint prefix instead')
+    parser.add_argument('--limit', type=int, default=20,
+                        help='Number of builds or runs to list')
+    return parser
+
+
+def create_plan_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='docker-build-ami plan',
+        description='Print the steps a build of a Dockerfile would run '
+                    'without connecting to AWS')
+    parser.add_argument('dockerfile', nargs='?', default='Dockerfile',
+                        help='Dockerfile (default: %(default)s)')
+    parser.add_argument('--direct-copy', action='store_true',
+                        help='Show the COPY and ADD steps whose files '
+                             'direct copy places with the build context')
+    parser.add_argument('--estimate', action='store_true',
+                        help='Estimate how long the build takes from the '
+                             'history of past builds')
+    parser.add_argument('-c', '--config', help='Configuration file')
+    parser.add_argument('-f', '--history-file',
+                        help='History file of the estimate')
+    parser.add_argument('-n', '--image-name',
+                        help='Target AMI image name of the estimate')
+    parser.add_argument('-i', '--image-id',
+                        help='Source AMI image ID of the estimate')
+    parser.add_argument('-r', '--region', help='AWS region of the estimate')
+    return parser
+
+
+def create_multi_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='docker-build-ami multi',
+        description='Build the Dockerfiles of several directories. The steps '
+                    'that Dockerfiles start with alike are built once into '
+                    'an intermediate AMI that the rest of their builds start '
+                    'from.')
+    parser.add_argument('targets', nargs='+', metavar='[NAME=]DIR',
+                        help='Directory with a Dockerfile, whose AMI is named '
+                             'NAME or else after the directory')
+    parser.add_argument('-c', '--config', help='Configuration file')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='Print debug info')
+    parser.add_argument('-r', '--region', help='AWS region')
+    parser.add_argument('-t', '--instance-type', help='EC2 instance type')
+    parser.add_argument('-i', '--image-id', help='Source AMI image ID')
+    parser.add_argument('--direct-copy', action='store_true',
+                        help='Place the files of COPY and ADD steps before '
+                             'the first RUN at their destination when '
+                             'uploading the build context')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of builds to run at the same time '
+                             '(default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only print the builds and what sharing saves')
+    return parser
+
+
+def create_graph_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='docker-build-ami graph',
+        description='Build the targets of a manifest, each one starting from '
+                    'the AMI of the target it names in from or in the FROM '
+                    'line of its Dockerfile. Targets that do not depend on '
+                    'each other are built at the same time.')
+    parser.add_argument('manifest', metavar='MANIFEST',
+                        help='INI file with a section per target')
+    parser.add_argument('names', nargs='*', metavar='TARGET',
+                        help='Target to build along with the targets it '
+                             'starts from (default: all of them)')
+    parser.add_argument('-c', '--config', help='Configuration file')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='Print debug info')
+    parser.add_argument('--direct-copy', action='store_true',
+                        help='Place the files of COPY and ADD steps before '
+                             'the first RUN at their destination when '
+                             'uploading the build context')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of builds to run at the same time '
+                             '(default: %(default)s)')
+    parser.add_argument('--skip-preflight', action='store_true',
+                        help='Do not check the build contexts and the '
+                             'configuration of the targets')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only print the builds')
+    return parser
+
+
+def create_prune_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='docker-build-ami prune',
+        description='Deregister the old AMIs of an image name and delete '
+                    'their snapshots')
+    parser.add_argument('-c', '--config', help='Configuration file')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='Print debug info')
+    parser.add_argument('-r', '--region', help='AWS region')
+    parser.add_argument('-n', '--image-name', action='append',
+                        dest='image_names', metavar='IMAGE_NAME',
+                        help='Image name whose AMIs are pruned (may be '
+                             'repeated, default: image_name)')
+    parser.add_argument('-k', '--keep', type=int, default=3, metavar='N',
+                        help='Number of newest AMIs to keep per image name '
+                             '(default: %(default)s)')
+    parser.add_argument('--min-age', type=float, default=0, metavar='DAYS',
+                        help='Keep the AMIs younger than DAYS days')
+    parser.add_argument('--protect-tag', action='append', default=[],
+                        metavar='KEY[=VALUE]',
+                        help='Keep the AMIs with this tag (may be repeated)')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Number of AMIs to prune at the same time '
+                             '(default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only print what would be pruned')
+    return parser
+
+
+def create_serve_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='docker-build-ami serve',
+        description='Run a build service that builds the jobs posted to '
+                    'its HTTP API, sharing the AWS clients between them')
+    parser.add_argument('-c', '--config', help='Configuration file')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='Print debug info')
+    parser.add_argument('--listen', default='127.0.0.1:8080',
+                        metavar='HOST:PORT',
+                        help='Address to listen on (default: %(default)s)')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='Listen on this Unix socket instead')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Number of builds to run at the same time '
+                             '(default: %(default)s)')
+    parser.add_argument('--max-per-account', type=int, default=0,
+                        metavar='N',
+                        help='Running builds allowed per AWS access key, '
+                             '0 for no limit')
+    parser.add_argument('--max-per-region', type=int, default=0,
+                        metavar='N',
+                        help='Running builds allowed per region, 0 for no '
+                             'limit')
+    parser.add_argument('--max-per-instance-type', type=int, default=0,
+                        metavar='N',
+                        help='Running builds allowed per instance type, 0 '
+                             'for no limit')
+    parser.add_argument('--jobs-dir', default='~/.docker-build-ami/jobs',
+                        help='Directory of the build logs and files of the '
+                             'jobs (default: %(default)s)')
     return parser
 
 
@@ -75,6 +455,31 @@ def create_config_parser():
     config.set('main', 'aws_access_key_id', '')
     config.set('main', 'aws_secret_access_key', '')
     config.set('main', 'tmp_dir', '/tmp')
+    config.set('main', 'log_file', '')
+    config.set('main', 'log_tail_lines', '20')
+    config.set('main', 'direct_copy', 'false')
+    config.set('main', 'archive_format', 'tar.gz')
+    config.set('main', 'cache_volume', '')
+    config.set('main', 'cache_volume_size', '20')
+    config.set('main', 'cache_dirs', json.dumps(CACHE_DIRS))
+    config.set('main', 'cache_snapshots_kept', '3')
+    config.set('main', 'max_pool_connections', '10')
+    config.set('main', 'retry_mode', 'standard')
+    config.set('main', 'api_rate_limit', '20')
+    config.set('main', 'reuse_image', 'false')
+    config.set('main', 'ssh_keepalive', '30')
+    config.set('main', 'ssh_retries', '5')
+    config.set('main', 'cloud_init_ready', 'false')
+    config.set('main', 'step_timeout', '0')
+    config.set('main', 'idle_timeout', '0')
+    config.set('main', 'history_file', '~/.docker-build-ami/history.db')
+    config.set('main', 'regression_threshold', '50')
+    config.set('main', 'root_volume_size', '0')
+    config.set('main', 'root_volume_type', '')
+    config.set('main', 'root_volume_iops', '0')
+    config.set('main', 'root_volume_throughput', '0')
+    config.set('main', 'instance_store_scratch', 'false')
+    config.set('main', 'prewarm_root_volume', 'false')
     return config
 
 
@@ -109,7 +514,553 @@ def get_config_path(config_path):
     return cfile
 
 
+def log_with_args(argv):
+    args = create_log_arg_parser().parse_args(argv)
+    setup_logger(False)
+    config = create_config_parser()
+    config_path = get_config_path(args.config)
+    if config_path:
+        config.read(config_path)
+    log_file = args.log_file or config.get('main', 'log_file')
+    if not log_file:
+        logging.critical('You need to specify a build log file')
+        exit(1)
+
+    build_log = BuildLog(log_file)
+    if not os.path.isfile(build_log.index_path):
+        logging.critical(f'Build log doesn\'t exist: {log_file}')
+        exit(1)
+    out = sys.stdout.buffer
+    if args.step is None:
+        out.write(''.join(f'{step}\n' for step in build_log.steps())
+                  .encode('utf8'))
+    elif args.tail is not None:
+        out.write(build_log.tail(args.step, args.tail))
+    else:
+        for data in build_log.read(args.step):
+            out.write(data)
+    out.flush()
+
+
+def _format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime(
+        '%Y-%m-%d %H:%M:%S')
+
+
+def _format_duration(duration):
+    return '-' if duration is None else f'{duration:.1f}s'
+
+
+def history_with_args(argv):
+    from .history import History
+    args = create_history_arg_parser().parse_args(argv)
+    setup_logger(False)
+    config = create_config_parser()
+    config_path = get_config_path(args.config)
+    if config_path:
+        config.read(config_path)
+    history_file = args.history_file or config.get('main', 'history_file')
+    if not history_file:
+        logging.critical('You need to specify a history file')
+        exit(1)
+    if not os.path.isfile(os.path.expanduser(history_file)):
+        logging.critical(f'History file doesn\'t exist: {history_file}')
+        exit(1)
+
+    history = History(history_file)
+    if args.step:
+        for run in history.step_runs(args.step, args.limit):
+            print(f'{run["build_id"][:12]}  {_format_time(run["started"])}  '
+                  f'{run["image_name"]}  step {run["step"]}  '
+                  f'{_format_duration(run["duration"])}  '
+                  f'exit {run["exit_code"]}')
+    elif args.build_id:
+        build, steps = history.build(args.build_id)
+        if not build:
+            logging.critical(f'No single build matches: {args.build_id}')
+            exit(1)
+        print(f'Build {build["id"]} of {build["image_name"]} on '
+              f'{build["instance_type"]} in {build["region"]} from '
+              f'{build["source_image"]}')
+        print(f'Started {_format_time(build["started"])}, '
+              f'{build["status"]} after '
+              f'{_format_duration(build["duration"])}: '
+              f'{build["image"] or build["error"] or "no image"}')
+        print('STEP  DURATION  EXIT  OUTPUT  FINGERPRINT   INSTRUCTION')
+        for step in steps:
+            exit_code, output_bytes = (
+                '-' if value is None else value
+                for value in (step['exit_code'], step['output_bytes']))
+            print(f'{step["step"]:>4}  '
+                  f'{_format_duration(step["duration"]):>8}  '
+                  f'{exit_code:>4}  {output_bytes:>6}  '
+                  f'{(step["fingerprint"] or "-")[:12]:<12}  '
+                  f'{step["instruction"] or "(preparation)"}')
+    else:
+        for build in history.builds(args.image_name, args.limit):
+            print(f'{build["id"][:12]}  {_format_time(build["started"])}  '
+                  f'{build["image_name"]}  {build["status"]}  '
+                  f'{_format_duration(build["duration"])}  '
+                  f'{build["image"] or build["error"] or ""}')
+
+
+def plan_with_args(argv):
+    args = create_plan_arg_parser().parse_args(argv)
+    setup_logger(False)
+    if not os.path.isfile(args.dockerfile):
+        logging.critical(f'Dockerfile doesn\'t exist: {args.dockerfile}')
+        exit(1)
+
+    with open(args.dockerfile, 'r') as dockerfile:
+        placements = None
+        if args.direct_copy:
+            source_dir = os.path.dirname(args.dockerfile) or '.'
+            placements = plan_direct_copies(dockerfile, source_dir).placements
+            dockerfile.seek(0)
+        parser_state = ParserState()
+        parser_delegate = SimpleStateParserDelegate(
+            PlanParserDelegate(parser_state, placements), parser_state)
+        parse_dockerfile_with_delegate(dockerfile, parser_delegate)
+    print(f'{parser_state.step} steps')
+    if args.estimate:
+        print_estimate(args)
+
+
+def print_estimate(args):
+    """ Prints the estimate of how long the build of plan args takes """
+    from .estimate import PHASES, estimate_build, format_seconds
+    from .history import History
+    config = create_config_parser()
+    config_path = get_config_path(args.config)
+    if config_path:
+        config.read(config_path)
+    aws_config = AwsConfig(config, 'main', args)
+    if not aws_config.history_file:
+        logging.critical('You need to specify a history file')
+        exit(1)
+    if not os.path.isfile(os.path.expanduser(aws_config.history_file)):
+        logging.critical(
+            f'History file doesn\'t exist: {aws_config.history_file}')
+        exit(1)
+
+    with open(args.dockerfile, 'r') as dockerfile:
+        estimate = estimate_build(History(aws_config.history_file),
+                                  dockerfile, aws_config,
+                                  os.path.dirname(args.dockerfile) or '.')
+    print(f'Estimate for {aws_config.image_name}:')
+    for phase in PHASES:
+        seconds, basis = estimate.phases[phase]
+        print(f'  {phase:<10} {format_seconds(seconds):>7}  ({basis})')
+        if phase != 'steps':
+            continue
+        for step, instruction, seconds, basis in estimate.steps:
+            instruction = ' '.join(instruction.split())
+            if len(instruction) > 50:
+                instruction = f'{instruction[:47]}...'
+            print(f'    step {step:<3} {format_seconds(seconds):>7}  '
+                  f'{instruction} ({basis})')
+    print(f'  {"total":<10} {format_seconds(estimate.total):>7}')
+    unknown = [f'step {name}' if isinstance(name, int) else name
+               for name in estimate.unknown]
+    if unknown:
+        print(f'No history for {", ".join(unknown)}, left out of the total')
+
+
+def multi_with_args(argv):
+    from .estimate import format_seconds
+    from .history import History
+    from .prefix_sharing import Target, estimate_saving, \
+        plan_shared_builds, run_shared_builds
+    args = create_multi_arg_parser().parse_args(argv)
+    setup_logger(args.debug)
+    config = create_config_parser()
+    config_path = get_config_path(args.config)
+    if config_path:
+        config.read(config_path)
+    aws_config = AwsConfig(config, 'main', args)
+    if not args.dry_run and (not aws_config.aws_access_key_id or
+                             not aws_config.aws_secret_access_key):
+        logging.critical('You need to specify AWS credentials')
+        exit(1)
+
+    targets = []
+    for arg in args.targets:
+        name, _, source_dir = arg.rpartition('=')
+        name = name or os.path.basename(os.path.abspath(source_dir))
+        dockerfile_path = os.path.join(source_dir, 'Dockerfile')
+        if not os.path.isfile(dockerfile_path):
+            logging.critical(f'Dockerfile doesn\'t exist: {dockerfile_path}')
+            exit(1)
+        if name in (target.name for target in targets):
+            logging.critical(f'Image name is used twice: {name}')
+            exit(1)
+        target_config = copy.copy(aws_config)
+        target_config.image_name = name
+        with open(dockerfile_path, 'r') as dockerfile:
+            fingerprint = compute_fingerprint(dockerfile, target_config,
+                                              source_dir)
+            dockerfile.seek(0)
+            steps = step_fingerprints(dockerfile, target_config, source_dir)
+        targets.append(Target(name, source_dir, fingerprint, steps))
+
+    builds = plan_shared_builds(targets)
+    print('Builds:')
+    for depth, shared in iter_graph(builds):
+        print(f'{"  " * (depth + 1)}{shared}')
+    history = None
+    if aws_config.history_file and \
+            os.path.isfile(os.path.expanduser(aws_config.history_file)):
+        history = History(aws_config.history_file)
+    saving = estimate_saving(builds, targets, history)
+    print(f'Sharing runs {saving.total_step_runs - saving.step_runs} '
+          f'instead of {saving.total_step_runs} steps with '
+          f'{saving.extra_builds} intermediate AMI'
+          f'{"s" if saving.extra_builds != 1 else ""}')
+    if saving.seconds is not None:
+        net = saving.seconds - saving.overhead
+        print(f'Expected to {"save" if net >= 0 else "cost"} about '
+              f'{format_seconds(abs(net))} of build time: '
+              f'{format_seconds(saving.seconds)} of steps, less '
+              f'{format_seconds(saving.overhead)} for the intermediate AMIs')
+    if args.dry_run:
+        return
+
+    def build(shared, image_id):
+        build_config = concurrent_config(aws_config, shared.fingerprint[:12])
+        build_config.image_name = shared.image_name
+        if image_id:
+            build_config.image_id = image_id
+        print(f'Building {shared}, logging to {build_config.log_file}')
+        return build_ami(build_config, shared.source_dir, args.direct_copy,
+                         part=shared)
+
+    results = run_shared_builds(builds, build, args.jobs)
+    print_results([(target.name, results[target.name]) for target in targets])
+
+
+def concurrent_config(aws_config, build_name):
+    """
+    Returns a copy of aws_config for a build that runs at the same time as
+    others, with its own archive and build log in a directory of tmp_dir
+    named after build_name
+    """
+    build_config = copy.copy(aws_config)
+    build_config.tmp_dir = os.path.join(
+        os.path.expanduser(aws_config.tmp_dir),
+        f'docker-build-ami-{build_name}')
+    os.makedirs(build_config.tmp_dir, exist_ok=True)
+    build_config.log_file = os.path.join(build_config.tmp_dir, 'build.log')
+    return build_config
+
+
+def print_results(results):
+    """
+    Prints the AMI ID of every (name, result) of results, or what failed
+    its build, and exits if any failed
+    """
+    failed = False
+    for name, result in results:
+        if isinstance(result, BaseException):
+            print(f'{name}: failed, {describe_error(result)}')
+            failed = True
+        else:
+            print(f'{name}: {result}')
+    if failed:
+        exit(1)
+
+
+def graph_with_args(argv):
+    args = create_graph_arg_parser().parse_args(argv)
+    setup_logger(args.debug)
+    config = create_config_parser()
+    config_path = get_config_path(args.config)
+    if config_path:
+        config.read(config_path)
+    try:
+        targets = read_manifest(args.manifest, config.options('main'))
+        roots = plan_build_graph(targets, args.names)
+    except ValueError as e:
+        logging.critical(e)
+        exit(1)
+
+    configs = {}
+    for _, target in iter_graph(roots):
+        aws_config = AwsConfig(config, 'main',
+                               argparse.Namespace(**target.overrides))
+        if not args.dry_run and (not aws_config.aws_access_key_id or
+                                 not aws_config.aws_secret_access_key):
+            logging.critical(f'You need to specify AWS credentials for '
+                             f'{target.name}')
+            exit(1)
+        if not args.skip_preflight:
+            # The source AMI of the targets after the roots is built first
+            run_preflight(aws_config,
+                          not args.dry_run and target.upstream is None,
+                          target.source_dir)
+        configs[target] = aws_config
+    print('Builds:')
+    for depth, target in iter_graph(roots):
+        print(f'{"  " * (depth + 1)}{target}')
+    if args.dry_run:
+        return
+
+    def build(target, image_id):
+        build_config = concurrent_config(configs[target], target.name)
+        if image_id:
+            build_config.image_id = image_id
+        print(f'Building {target}, logging to {build_config.log_file}')
+        return build_ami(build_config, target.source_dir, args.direct_copy)
+
+    results = run_build_graph(roots, build, args.jobs)
+    print_results([(target.name, results[target])
+                   for _, target in iter_graph(roots)])
+
+
+def prune_with_args(argv):
+    args = create_prune_arg_parser().parse_args(argv)
+    setup_logger(args.debug)
+    config = create_config_parser()
+    config_path = get_config_path(args.config)
+    if config_path:
+        config.read(config_path)
+    aws_config = AwsConfig(config, 'main', args)
+    if not aws_config.aws_access_key_id or \
+            not aws_config.aws_secret_access_key:
+        logging.critical('You need to specify AWS credentials')
+        exit(1)
+
+    from .sessions import default_factory
+    ec2 = default_factory.session(aws_config).client('ec2')
+    protected_tags = [parse_protected_tag(tag) for tag in args.protect_tag]
+    plan = []
+    for image_name in args.image_names or [aws_config.image_name]:
+        image_plan = plan_prune(find_images(ec2, image_name), args.keep,
+                                datetime.timedelta(days=args.min_age),
+                                protected_tags)
+        pruned = sum(1 for image, reason in image_plan if reason is None)
+        print(f'{image_name}: {len(image_plan) - pruned} kept, {pruned} '
+              'to prune')
+        plan += image_plan
+
+    snapshots = pruned_snapshots(plan)
+    for image, reason in plan:
+        action = f'keep ({reason})' if reason else \
+            ' '.join(['prune'] + snapshots[image['ImageId']])
+        print(f'  {image["ImageId"]}  {image["Name"]}  '
+              f'{image["CreationDate"][:10]}  {action}')
+    counts = (f'{len(snapshots)} images and '
+              f'{sum(len(ids) for ids in snapshots.values())} snapshots')
+    if args.dry_run:
+        print(f'Would prune {counts}')
+        return
+
+    problems = prune_images(ec2, plan, args.workers)
+    for problem in problems:
+        logging.critical(problem)
+    if problems:
+        exit(1)
+    print(f'Pruned {counts}')
+
+
+def run_preflight(aws_config, check_aws=True, source_dir='.'):
+    """
+    Checks the build of the Dockerfile in source_dir before anything is
+    launched, exiting after reporting all the problems if there are any.
+    check_aws checks the AWS resources of aws_config as well.
+    """
+    session_factory = None
+    if check_aws:
+        from .sessions import default_factory as session_factory
+    problems = preflight(os.path.join(source_dir, 'Dockerfile'), aws_config,
+                         source_dir, session_factory)
+    for problem in problems:
+        logging.critical(problem)
+    if problems:
+        exit(1)
+
+
+def describe_error(e):
+    """ Returns what failed a build with the exception e """
+    # Such as the SystemExit of a failed step, with its exit code
+    if isinstance(e, SystemExit):
+        return f'exit code {e.code}'
+    return str(e) or type(e).__name__
+
+
+def build_image(executor, direct_copy=False, steps=None):
+    """
+    Builds the Dockerfile in the source_dir of executor and returns what
+    save_image() returns, emitting build_started and build_finished to the
+    events of executor. With steps, only the steps in that range are run.
+    """
+    events = executor.events
+    events.emit('build_started', source_dir=executor.source_dir)
+    start = time.monotonic()
+    try:
+        image = _build_image(executor, direct_copy, steps)
+    except BaseException as e:
+        events.emit('build_finished', status='failed',
+                    error=describe_error(e),
+                    duration=round(time.monotonic() - start, 3))
+        raise
+    events.emit('build_finished', status='succeeded', image=image,
+                duration=round(time.monotonic() - start, 3))
+    return image
+
+
+def _build_image(executor, direct_copy, steps):
+    dockerfile_path = os.path.join(executor.source_dir, 'Dockerfile')
+    with open(dockerfile_path, 'r') as dockerfile:
+        planner = None
+        if direct_copy:
+            planner = plan_direct_copies(dockerfile, executor.source_dir,
+                                         steps)
+            dockerfile.seek(0)
+        with executor:
+            placed_steps = executor.send_archive(planner)
+            parser_state = ParserState()
+            ami_parser_delegate = Docker2AmiParserDelegate(
+                executor, parser_state, placed_steps, steps)
+            parser_delegate = SimpleStateParserDelegate(
+                ami_parser_delegate, parser_state)
+            parse_dockerfile_with_delegate(dockerfile, parser_delegate)
+            if steps is not None:
+                # Other builds go on from the image with their own build
+                # context and environment
+                executor.run_cmd(
+                    f'rm -rf {executor.context_dir} {executor.env_file}')
+            return executor.save_image()
+
+
+def build_ami(aws_config, source_dir='.', direct_copy=False, session=None,
+              events=None, build_id=None, part=None):
+    """
+    Builds the Dockerfile in source_dir on EC2 and returns the AMI ID. The
+    AMI is tagged with the fingerprint of the build, and with reuse_image
+    the AMI of an earlier build with the same fingerprint is returned.
+    session is the SharedSession of the build, the default one if None.
+    The progress of the build is emitted to events, if given, and the build
+    is recorded in the history_file as build_id, a random ID if None.
+    part is the SharedBuild of a multi-Dockerfile build this build runs,
+    starting from the AMI of the image_id of aws_config.
+    """
+    from .ami_builder import AmiBuilder
+    from .history import History, HistoryRecorder
+    if part:
+        fingerprint, steps = part.fingerprint, part.step_fingerprints
+    else:
+        with open(os.path.join(source_dir, 'Dockerfile'), 'r') as dockerfile:
+            fingerprint = compute_fingerprint(dockerfile, aws_config,
+                                              source_dir)
+            steps = None
+            if aws_config.history_file:
+                dockerfile.seek(0)
+                steps = step_fingerprints(dockerfile, aws_config, source_dir)
+    if aws_config.history_file:
+        events = HistoryRecorder(
+            History(aws_config.history_file), build_id or uuid.uuid4().hex,
+            aws_config, steps, fingerprint, events)
+    if is_true(aws_config.reuse_image):
+        if session is None:
+            from .sessions import default_factory
+            session = default_factory.session(aws_config)
+        image_id = find_image(session.client('ec2'), fingerprint)
+        if image_id:
+            print(f'Reusing image {image_id} built from the same inputs')
+            if events:
+                events.emit('image_reused', image=image_id)
+            return image_id
+    return build_image(
+        AmiBuilder(aws_config, source_dir, session, fingerprint, events),
+        direct_copy, part.steps if part else None)
+
+
+def serve_with_args(argv):
+    from .service import BuildService, JobQueue, create_server
+    args = create_serve_arg_parser().parse_args(argv)
+    setup_logger(args.debug)
+    config = create_config_parser()
+    config_path = get_config_path(args.config)
+    if config_path:
+        config.read(config_path)
+
+    queue = JobQueue(args.max_per_account, args.max_per_region,
+                     args.max_per_instance_type)
+    service = BuildService(config, build_ami, args.jobs_dir, args.workers,
+                           queue)
+    if args.socket:
+        server = create_server(service, socket_path=args.socket)
+        print(f'Listening on {args.socket}')
+    else:
+        host, _, port = args.listen.rpartition(':')
+        server = create_server(service, (host or '127.0.0.1', int(port)))
+        print(f'Listening on {args.listen}')
+    service.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Waiting for the running builds...')
+    finally:
+        server.server_close()
+        if args.socket:
+            os.remove(args.socket)
+        service.stop()
+
+
+@contextlib.contextmanager
+def progress_events(progress, build_id, tmp_dir, log_file=None,
+                    tail_lines=20):
+    """
+    Returns the Events that report the progress of the build build_id as
+    the --progress mode progress has it, None for plain text. With tty, what
+    the build prints goes to a file in tmp_dir, and a failed step shows its
+    output from the build log at log_file if given, or else its last
+    tail_lines lines.
+    """
+    if progress == 'auto':
+        progress = 'tty' if sys.stdout.isatty() and \
+            os.environ.get('TERM') != 'dumb' else 'plain'
+    if progress == 'json':
+        stdout = TakenStdout()
+        writer = EventWriter(stdout.fp)
+        try:
+            yield JsonEvents(writer, build_id)
+        finally:
+            writer.close()
+            stdout.restore()
+    elif progress == 'tty':
+        output_path = os.path.join(os.path.expanduser(tmp_dir),
+                                   f'docker-build-ami-{build_id}.log')
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        stdout = TakenStdout(output_path)
+        renderer = TtyRenderer(stdout.fp, log_file=log_file,
+                               tail_lines=tail_lines)
+        try:
+            yield renderer
+        finally:
+            renderer.close()
+            stdout.restore()
+            print(f'Full output in {output_path}')
+    else:
+        yield None
+
+
+# Commands that can be given as the first argument instead of building
+COMMANDS = {
+    'graph': graph_with_args,
+    'history': history_with_args,
+    'log': log_with_args,
+    'multi': multi_with_args,
+    'plan': plan_with_args,
+    'prune': prune_with_args,
+    'serve': serve_with_args,
+}
+
+
 def main_with_args(argv):
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
     # get the configuration
     argparser = create_arg_parser()
     args = argparser.parse_args(argv)
@@ -125,24 +1076,27 @@ def main_with_args(argv):
         logging.critical(
             'There needs to be a Dockerfile in the current directory')
         exit(1)
-    if not aws_config.aws_access_key_id:
-        logging.critical('You need to specify an AWS Access Key ID')
-        exit(1)
-    if not aws_config.aws_secret_access_key:
-        logging.critical('You need to specify a AWS Secret Access Key')
-        exit(1)
+    if not args.local:
+        if not aws_config.aws_access_key_id:
+            logging.critical('You need to specify an AWS Access Key ID')
+            exit(1)
+        if not aws_config.aws_secret_access_key:
+            logging.critical('You need to specify a AWS Secret Access Key')
+            exit(1)
+    if not args.skip_preflight:
+        run_preflight(aws_config, not args.local)
 
-    # Parse the Dockerfile and create the AMI
-    with open('Dockerfile', 'r') as dockerfile:
-        with AmiBuilder(aws_config) as ami_builder:
-            parser_state = ParserState()
-            ami_parser_delegate = Docker2AmiParserDelegate(
-                ami_builder, parser_state)
-            parser_delegate = SimpleStateParserDelegate(
-                ami_parser_delegate, parser_state)
-            ami_builder.send_archive()
-            parse_dockerfile_with_delegate(dockerfile, parser_delegate)
-            ami_builder.save_ami()
+    direct_copy = args.direct_copy or config.getboolean('main', 'direct_copy')
+    build_id = args.build_id or uuid.uuid4().hex
+    with progress_events(args.progress, build_id, aws_config.tmp_dir,
+                         aws_config.log_file,
+                         int(aws_config.log_tail_lines)) as events:
+        if args.local:
+            build_image(LocalExecutor(aws_config, args.local, args.chroot,
+                                      events=events), direct_copy)
+        else:
+            build_ami(aws_config, '.', direct_copy, events=events,
+                      build_id=build_id)
 
 
 def main():
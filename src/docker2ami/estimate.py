@@ -0,0 +1,194 @@
+import difflib
+import statistics
+
+from .fingerprint import FingerprintDelegate, fingerprint_steps
+from .parser import parse_dockerfile_with_delegate
+
+
+# Phases of a build on EC2 in order: until the builder is ready, until the
+# last step finished, until the AMI is available and releasing the builder
+PHASES = ('launch', 'steps', 'save', 'teardown')
+
+# Past runs whose median is the baseline of a step or a phase
+BASELINE_RUNS = 10
+
+# Past runs a baseline needs before a build is compared with it
+BASELINE_MIN_RUNS = 3
+
+# Regressions of fewer seconds than this are left out as noise
+REGRESSION_MIN_SECONDS = 5
+
+# How alike an instruction must be to a past one to be estimated from it
+SIMILARITY_CUTOFF = 0.6
+
+
+def format_seconds(seconds):
+    """ Returns seconds as 12.3s, 4m05s or 1h02m """
+    if seconds is None:
+        return '?'
+    if seconds < 60:
+        return f'{seconds:.1f}s'
+    minutes = int(seconds + 0.5) // 60
+    if minutes < 60:
+        return f'{minutes}m{int(seconds + 0.5) % 60:02d}s'
+    return f'{minutes // 60}h{minutes % 60:02d}m'
+
+
+def _runs(durations):
+    return f'{len(durations)} run{"s" if len(durations) != 1 else ""}'
+
+
+def estimate_step(history, instruction, fingerprint):
+    """
+    Returns the (seconds, basis) estimate of the step with instruction and
+    fingerprint: the median of the past runs of the same step, else of the
+    same instruction, else of the most similar instruction of the same
+    kind, else (None, 'no history')
+    """
+    durations = history.step_durations(fingerprint=fingerprint,
+                                       limit=BASELINE_RUNS)
+    if durations:
+        return statistics.median(durations), f'same step, {_runs(durations)}'
+    durations = history.step_durations(instruction=instruction,
+                                       limit=BASELINE_RUNS)
+    if durations:
+        return statistics.median(durations), \
+            f'same instruction, {_runs(durations)}'
+    similar = difflib.get_close_matches(
+        instruction, history.instructions(instruction.split(' ', 1)[0]),
+        n=1, cutoff=SIMILARITY_CUTOFF)
+    if similar:
+        durations = history.step_durations(instruction=similar[0],
+                                           limit=BASELINE_RUNS)
+        if durations:
+            return statistics.median(durations), \
+                f'similar to {similar[0]!r}, {_runs(durations)}'
+    return None, 'no history'
+
+
+def estimate_phase(history, phase, image_name):
+    """
+    Returns the (seconds, basis) estimate of phase: the median of the last
+    builds of image_name, else of any image, else (None, 'no history')
+    """
+    durations = history.phase_durations(phase, image_name,
+                                        limit=BASELINE_RUNS)
+    if durations:
+        return statistics.median(durations), \
+            f'{_runs(durations)} of {image_name}'
+    durations = history.phase_durations(phase, limit=BASELINE_RUNS)
+    if durations:
+        return statistics.median(durations), \
+            f'{_runs(durations)} of other images'
+    return None, 'no history'
+
+
+class Estimate(object):
+    """
+    Expected duration of a build. steps holds the (step, instruction,
+    seconds, basis) of every step, the preparation of the builder being step
+    0, and phases the (seconds, basis) of every phase of PHASES by name.
+    seconds is None for the steps and phases without history.
+    """
+    def __init__(self, steps, phases):
+        self.steps = steps
+        self.phases = phases
+
+    @property
+    def total(self):
+        """ Returns the sum of the phases that have an estimate """
+        return sum(seconds for seconds, _ in self.phases.values()
+                   if seconds is not None)
+
+    @property
+    def unknown(self):
+        """ Returns the steps and phases without an estimate """
+        return [step for step, _, seconds, _ in self.steps
+                if seconds is None] + \
+            [phase for phase, (seconds, _) in self.phases.items()
+             if seconds is None]
+
+
+def estimate_build(history, fp, aws_config, source_dir='.'):
+    """
+    Returns the Estimate of the build of the Dockerfile in fp whose build
+    context is source_dir, from the past builds in history. The RUN steps of
+    an AWS-PARALLEL section take as long as the longest of them.
+    """
+    delegate = FingerprintDelegate()
+    parse_dockerfile_with_delegate(fp, delegate)
+    fingerprints = fingerprint_steps(delegate.steps, aws_config, source_dir)
+    image_name = aws_config.image_name
+
+    durations = history.step_durations(step=0, image_name=image_name,
+                                       limit=BASELINE_RUNS)
+    steps = [(0, 'Prepare the builder', statistics.median(durations),
+              f'{_runs(durations)} of {image_name}') if durations
+             else (0, 'Prepare the builder', None, 'no history')]
+    group_seconds = {}
+    steps_seconds = steps[0][2] or 0
+    for step, ((instruction, fingerprint), group) in enumerate(
+            zip(fingerprints, delegate.groups), 1):
+        seconds, basis = estimate_step(history, instruction, fingerprint)
+        steps.append((step, instruction, seconds, basis))
+        if group is None:
+            steps_seconds += seconds or 0
+        else:
+            group_seconds[group] = max(group_seconds.get(group, 0),
+                                       seconds or 0)
+    steps_seconds += sum(group_seconds.values())
+
+    phases = {phase: estimate_phase(history, phase, image_name)
+              for phase in PHASES}
+    phases['steps'] = (steps_seconds, 'sum of the steps')
+    return Estimate(steps, phases)
+
+
+def _regression(name, duration, baselines, threshold):
+    """
+    Returns the (name, duration, baseline) regression of duration compared
+    with the median of baselines, or None
+    """
+    if len(baselines) < BASELINE_MIN_RUNS:
+        return None
+    baseline = statistics.median(baselines)
+    if duration > baseline * (1 + threshold / 100) and \
+            duration - baseline >= REGRESSION_MIN_SECONDS:
+        return name, duration, baseline
+    return None
+
+
+def find_regressions(history, build_id, threshold):
+    """
+    Returns the (name, duration, baseline) of the steps and phases of the
+    build build_id in history that took more than threshold percent longer
+    than their baseline, the median of their last BASELINE_RUNS successful
+    runs before it. The steps are compared with the runs of the same step,
+    the phases with the builds of the same image.
+    """
+    build, steps = history.build(build_id)
+    if not build:
+        return []
+    regressions = []
+    for step in steps:
+        if step['exit_code'] != 0 or step['duration'] is None:
+            continue
+        if step['fingerprint']:
+            baselines = history.step_durations(
+                fingerprint=step['fingerprint'], before=build['started'],
+                limit=BASELINE_RUNS)
+        else:
+            baselines = history.step_durations(
+                step=step['step'], image_name=build['image_name'],
+                before=build['started'], limit=BASELINE_RUNS)
+        regressions.append(_regression(f'step {step["step"]}',
+                                       step['duration'], baselines,
+                                       threshold))
+    phases = history.phases(build['id'])
+    for phase in PHASES:
+        if phase in phases:
+            regressions.append(_regression(
+                phase, phases[phase], history.phase_durations(
+                    phase, build['image_name'], before=build['started'],
+                    limit=BASELINE_RUNS), threshold))
+    return [regression for regression in regressions if regression]
@@ -0,0 +1,113 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+
+class Events(object):
+    """
+    Receives the events of a build, such as step_started or image_created,
+    with their fields. This one ignores them.
+    """
+    def emit(self, event, **fields):
+        pass
+
+
+class EventWriter(object):
+    """
+    Writes events to fp as JSON lines from a background thread, so that
+    write() never blocks on fp. The events that arrive within flush_interval
+    seconds of each other are written and flushed together.
+    """
+    def __init__(self, fp, flush_interval=0.2):
+        self._fp = fp
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='docker-build-ami-events')
+        self._thread.start()
+
+    def write(self, event):
+        """ Queues the dict event to be written """
+        self._queue.put(event)
+
+    def _batch(self):
+        """
+        Returns the events that arrive until flush_interval after the first
+        one, None being the end of the events
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self._flush_interval
+        while batch[-1] is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._batch()
+            lines = ''.join(json.dumps(event) + '\n'
+                            for event in batch if event is not None)
+            try:
+                self._fp.write(lines)
+                self._fp.flush()
+            except (OSError, ValueError):
+                # Such as a collector that went away, which must not fail
+                # the build
+                pass
+            if batch[-1] is None:
+                return
+
+    def close(self):
+        """ Writes the queued events and waits until they are flushed """
+        self._queue.put(None)
+        self._thread.join()
+
+
+class JsonEvents(Events):
+    """ Events of the build build_id that an EventWriter writes """
+    def __init__(self, writer, build_id):
+        self._writer = writer
+        self.build_id = build_id
+
+    def emit(self, event, **fields):
+        self._writer.write(dict(time=round(time.time(), 3),
+                                build=self.build_id, event=event, **fields))
+
+
+class TakenStdout(object):
+    """
+    Keeps stdout for one writer, the file object fp, while everything else
+    the process writes to it goes elsewhere, subprocesses included: to
+    stderr, or with path to the file at path along with stderr. restore()
+    puts stdout and stderr back.
+    """
+    def __init__(self, path=None):
+        stdout_fd, stderr_fd = sys.stdout.fileno(), sys.stderr.fileno()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self._saved = {fd: os.dup(fd) for fd in (stdout_fd, stderr_fd)}
+        self.fp = os.fdopen(os.dup(stdout_fd), 'w')
+        if path:
+            path_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                              0o644)
+            os.dup2(path_fd, stdout_fd)
+            os.dup2(path_fd, stderr_fd)
+            os.close(path_fd)
+        else:
+            os.dup2(stderr_fd, stdout_fd)
+
+    def restore(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.fp.close()
+        for fd, saved_fd in self._saved.items():
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
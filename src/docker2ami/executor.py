@@ -0,0 +1,271 @@
+import concurrent.futures
+import contextlib
+import glob
+import logging
+import os
+import signal
+import threading
+import time
+
+from .config import parse_duration
+from .events import Events
+
+
+logger = logging.getLogger(__name__)
+
+# Exit code of a command that was stopped for running too long, as with
+# timeout(1)
+TIMEOUT_EXIT_CODE = 124
+
+
+# Executors between __enter__ and __exit__, which cancel_running() stops
+_running = set()
+_running_lock = threading.Lock()
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+@contextlib.contextmanager
+def sigterm_interrupts():
+    """
+    Makes SIGTERM raise KeyboardInterrupt like SIGINT does within the with
+    block, if run in the main thread, which signal handlers are limited to
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous = signal.signal(signal.SIGTERM, _raise_interrupt)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous or signal.SIG_DFL)
+
+
+def cancel_running():
+    """
+    Cancels the builds of the executors that run in other threads, which
+    then tear down as they fail
+    """
+    with _running_lock:
+        executors = list(_running)
+    for executor in executors:
+        executor.cancel()
+
+
+class StepDeadline(object):
+    """
+    Limits a command to timeout seconds and to idle_timeout seconds without
+    output, 0 being no limit
+    """
+    def __init__(self, timeout=0, idle_timeout=0):
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._start = self._last_output = time.monotonic()
+        # How often to check the limits while waiting for output
+        self.poll_interval = 1.0 if timeout or idle_timeout else None
+
+    def output(self):
+        """ Invoked when the command prints something """
+        self._last_output = time.monotonic()
+
+    def expired(self):
+        """ Returns why the command has to stop, or None if it may run """
+        now = time.monotonic()
+        if self._timeout and now - self._start >= self._timeout:
+            return f'ran longer than {self._timeout}s'
+        if self._idle_timeout and \
+                now - self._last_output >= self._idle_timeout:
+            return f'printed nothing for {self._idle_timeout}s'
+        return None
+
+
+class AbstractExecutor(object):
+    """
+    Object responsible for carrying out the steps of a Dockerfile on behalf
+    of Docker2AmiParserDelegate. Can be invoked via with: or by explicitly
+    invoking start() and finish()
+    """
+
+    # Where send_archive() places the build context, as seen by run_cmd()
+    context_dir = '/tmp/docker-build-ami'
+
+    # Local directory holding the Dockerfile and the build context
+    source_dir = '.'
+
+    # File holding the ENV and WORKDIR statements, as seen by run_cmd()
+    env_file = '/tmp/docker-build-ami.env'
+
+    # Events that receive the progress of the build
+    events = Events()
+
+    def start(self):
+        """ Invoked before the build context is delivered """
+        pass
+
+    def send_archive(self, planner=None):
+        """
+        Invoked to deliver the files in source_dir to context_dir.
+        When given the DirectCopyPlanner of the Dockerfile, the files of its
+        placements may be put at their destination instead. Returns the
+        steps whose files were placed that way.
+        """
+        raise NotImplementedError()
+
+    def _context_files(self):
+        """
+        Returns the (path, name) of the files in source_dir, name being
+        relative to it
+        """
+        return [(path, os.path.relpath(path, self.source_dir))
+                for path in glob.glob(
+                    os.path.join(glob.escape(self.source_dir), '*'))]
+
+    def fetch_context(self, src):
+        """
+        Invoked before a step reads src from context_dir. Returns a command
+        that makes src available there, or '' if it already is.
+        """
+        return ''
+
+    def check_destination(self, path):
+        """
+        Invoked with the destination of a COPY or ADD step or the path of a
+        WORKDIR step before it runs. Returns why the step cannot be built,
+        or None if it can.
+        """
+        return None
+
+    def update_env(self, statement):
+        """
+        Invoked to add the shell statement to env_file, which is sourced
+        before every command run after it
+        """
+        raise NotImplementedError()
+
+    def set_timeouts(self, step, timeout, idle_timeout=None):
+        """
+        Invoked to limit the commands of step to timeout seconds and to
+        idle_timeout seconds without output, 0 being no limit and None the
+        configured one
+        """
+        self._step_timeouts[step] = (timeout, idle_timeout)
+
+    def _deadline(self, step):
+        """ Returns the StepDeadline of a command of step starting now """
+        timeout, idle_timeout = self._step_timeouts.get(step, (None, None))
+        return StepDeadline(
+            parse_duration(self._config.step_timeout) if timeout is None
+            else timeout,
+            parse_duration(self._config.idle_timeout) if idle_timeout is None
+            else idle_timeout)
+
+    def run_cmd(self, cmd, step=0):
+        """
+        Invoked to run cmd as part of step after sourcing env_file. Step 0
+        holds the commands that prepare the build.
+        """
+        ecode = self._exec_step(cmd, step)
+        if ecode != 0:
+            logger.error(
+                f'The command {cmd} returned a non-zero code: {ecode}')
+            exit(ecode)
+
+    def run_parallel(self, cmds):
+        """
+        Invoked to run the (cmd, step) pairs in cmds concurrently, with their
+        output prefixed by the step. Fails like run_cmd() once all of them
+        are done if any of them failed.
+        """
+        self._prepare_parallel()
+        with concurrent.futures.ThreadPoolExecutor(len(cmds)) as pool:
+            futures = [pool.submit(self._exec_step, cmd, step,
+                                   f'[step {step}] ')
+                       for cmd, step in cmds]
+        ecodes = [future.result() for future in futures]
+        for (cmd, step), ecode in zip(cmds, ecodes):
+            if ecode != 0:
+                logger.error(f'The command {cmd} of step {step} returned a '
+                             f'non-zero code: {ecode}')
+        for ecode in ecodes:
+            if ecode != 0:
+                exit(ecode)
+
+    def _prepare_parallel(self):
+        """ Invoked before the commands of run_parallel() are started """
+        pass
+
+    def _exec_step(self, cmd, step, prefix=None):
+        """ Runs _exec() between the step_started and step_finished events """
+        self.events.emit('step_started', step=step, command=cmd)
+        start = time.monotonic()
+        ecode = self._exec(cmd, step, prefix)
+        self.events.emit('step_finished', step=step, exit_code=ecode,
+                         duration=round(time.monotonic() - start, 3))
+        return ecode
+
+    def _exec(self, cmd, step, prefix=None):
+        """
+        Runs cmd as part of step, with its output lines prefixed by prefix
+        if given, and returns its exit code
+        """
+        raise NotImplementedError()
+
+    def save_image(self):
+        """ Invoked after the last step to turn the result into an image """
+        raise NotImplementedError()
+
+    def cancel(self):
+        """
+        Invoked from another thread to stop the build, whose commands then
+        fail
+        """
+        pass
+
+    def finish(self):
+        """ Invoked to release whatever start() acquired """
+        pass
+
+    def __enter__(self):
+        # SIGTERM tears the build down like SIGINT does, which signal
+        # handlers only do in the main thread
+        self._handles_signals = \
+            threading.current_thread() is threading.main_thread()
+        if self._handles_signals:
+            self._previous_sigterm = signal.signal(
+                signal.SIGTERM, _raise_interrupt) or signal.SIG_DFL
+        with _running_lock:
+            _running.add(self)
+        try:
+            self.start()
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.events.emit('teardown_started')
+        start = time.monotonic()
+        try:
+            self._finish_unsignalled()
+        finally:
+            with _running_lock:
+                _running.discard(self)
+            self.events.emit('teardown_finished',
+                             duration=round(time.monotonic() - start, 3))
+
+    def _finish_unsignalled(self):
+        """ Invokes finish() without letting interrupts stop it """
+        if not self._handles_signals:
+            self.finish()
+            return
+        # Another interrupt must not leave what start() acquired behind
+        handlers = {signum: signal.signal(signum, signal.SIG_IGN)
+                    for signum in (signal.SIGINT, signal.SIGTERM)}
+        handlers[signal.SIGTERM] = self._previous_sigterm
+        try:
+            self.finish()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
@@ -0,0 +1,190 @@
+import glob
+import hashlib
+import json
+import os
+import stat
+
+from os.path import join, relpath
+
+from .parser import AbstractParserDelegate, is_quoted, is_url_arg, \
+    parse_dockerfile_with_delegate
+
+
+# Tag of the AMIs whose value is the fingerprint of the build
+FINGERPRINT_TAG = 'docker-build-ami-fingerprint'
+
+# Version of the fingerprint, changed when what goes into it changes
+FINGERPRINT_VERSION = 1
+
+# AwsConfig keys that change the AMI a build creates
+FINGERPRINT_KEYS = ('image_id', 'region', 'instance_type', 'image_name',
+                    'image_tags', 'root_volume_size', 'root_volume_type')
+
+# AwsConfig keys that change what the steps of a build start from
+STEP_FINGERPRINT_KEYS = ('image_id', 'region')
+
+
+class FingerprintDelegate(AbstractParserDelegate):
+    """
+    ParserDelegate that collects the steps a build runs, with the sources of
+    their COPY and ADD steps. steps holds the (instruction, sources) of each
+    step in order, and groups the number of the group of RUN steps that run
+    concurrently each step is in, None for the steps that run alone.
+    """
+    def __init__(self):
+        self.instructions = []
+        self.sources = []
+        self.steps = []
+        self.groups = []
+        self._skip = False
+        self._group = None
+        self._groups = 0
+
+    def _add(self, instruction, src=None, group=None):
+        """
+        Adds instruction, which reads src from the build context if given,
+        unless it is skipped
+        """
+        if self._skip:
+            self._skip = False
+            return
+        self.instructions.append(instruction)
+        self.steps.append((instruction, [src] if src else []))
+        self.groups.append(group)
+        if src:
+            self.sources.append(src)
+        # The other steps of an AWS-PARALLEL section wait for the RUN steps
+        # before them, so that the RUN steps after them are a new group
+        if group is None and self._group is not None:
+            self._groups += 1
+            self._group = self._groups
+
+    def run_skip(self):
+        self._skip = True
+
+    def run_parallel_start(self):
+        self.instructions.append('AWS-PARALLEL')
+        self._groups += 1
+        self._group = self._groups
+
+    def run_parallel_end(self):
+        self.instructions.append('AWS-PARALLEL-END')
+        self._group = None
+
+    def run_env(self, key, value):
+        self._add(f'ENV {key}={value}')
+
+    def run_run(self, cmds):
+        self._add(f'RUN {cmds.strip()}', group=self._group)
+
+    def run_copy(self, src, dst):
+        self._add(f'COPY {src} {dst}', src)
+
+    def run_add(self, src, dst):
+        self._add(f'ADD {src} {dst}', None if is_url_arg(src) else src)
+
+    def run_workdir(self, path):
+        self._add(f'WORKDIR {path}')
+
+
+def _hash_file(digest, path, source_dir):
+    """ Adds the name, mode and content of path to digest """
+    st = os.lstat(path)
+    digest.update(f'{relpath(path, source_dir)}\0'
+                  f'{stat.S_IMODE(st.st_mode):o}\0'.encode('utf8'))
+    if stat.S_ISLNK(st.st_mode):
+        digest.update(os.readlink(path).encode('utf8'))
+    elif stat.S_ISREG(st.st_mode):
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(data)
+    digest.update(b'\0')
+
+
+def hash_sources(sources, source_dir='.'):
+    """
+    Returns the SHA-256 of the files below the sources, globs included, in
+    source_dir. The whole directory is hashed when a source has variables.
+    """
+    paths = []
+    for src in sorted(set(sources)):
+        src = src[1:-1] if is_quoted(src) else src
+        if '$' in src:
+            paths = [source_dir]
+            break
+        paths += glob.glob(join(glob.escape(source_dir), src))
+
+    digest = hashlib.sha256()
+    for path in sorted(set(paths)):
+        _hash_file(digest, path, source_dir)
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(dirs + files):
+                    _hash_file(digest, join(root, name), source_dir)
+    return digest.hexdigest()
+
+
+def compute_fingerprint(fp, aws_config, source_dir='.'):
+    """
+    Returns the fingerprint of the build of the Dockerfile in fp whose build
+    context is source_dir: the SHA-256 of its steps, the files they copy and
+    the configuration of the AMI
+    """
+    delegate = FingerprintDelegate()
+    parse_dockerfile_with_delegate(fp, delegate)
+    inputs = {
+        'version': FINGERPRINT_VERSION,
+        'config': {key: getattr(aws_config, key) for key in FINGERPRINT_KEYS},
+        'instructions': delegate.instructions,
+        'context': hash_sources(delegate.sources, source_dir),
+    }
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def step_fingerprints(fp, aws_config, source_dir='.'):
+    """
+    Returns the (instruction, fingerprint) of every step of the Dockerfile in
+    fp whose build context is source_dir, in order. The fingerprint of a
+    step is the SHA-256 of the one of the step before it, its instruction and
+    the files it copies, the first step starting from the source AMI. A step
+    with the same fingerprint in two builds ran on the same state.
+    """
+    delegate = FingerprintDelegate()
+    parse_dockerfile_with_delegate(fp, delegate)
+    return fingerprint_steps(delegate.steps, aws_config, source_dir)
+
+
+def fingerprint_steps(steps, aws_config, source_dir='.'):
+    """
+    Returns the (instruction, fingerprint) of the steps of a
+    FingerprintDelegate, as step_fingerprints() does
+    """
+    fingerprint = hashlib.sha256(json.dumps({
+        'version': FINGERPRINT_VERSION,
+        'config': {key: getattr(aws_config, key)
+                   for key in STEP_FINGERPRINT_KEYS},
+    }, sort_keys=True).encode('utf8')).hexdigest()
+    fingerprints = []
+    for instruction, sources in steps:
+        context = hash_sources(sources, source_dir) if sources else ''
+        fingerprint = hashlib.sha256(
+            f'{fingerprint}\0{instruction}\0{context}'.encode('utf8')
+        ).hexdigest()
+        fingerprints.append((instruction, fingerprint))
+    return fingerprints
+
+
+def find_image(ec2, fingerprint):
+    """
+    Returns the ID of the newest available AMI of the account tagged with
+    fingerprint, or None if there is none
+    """
+    images = ec2.describe_images(Owners=['self'], Filters=[
+        {'Name': f'tag:{FINGERPRINT_TAG}', 'Values': [fingerprint]},
+        {'Name': 'state', 'Values': ['available']},
+    ])['Images']
+    if not images:
+        return None
+    return max(images, key=lambda image: image['CreationDate'])['ImageId']
@@ -0,0 +1,349 @@
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from os.path import expanduser
+
+from .estimate import find_regressions, format_seconds
+from .events import Events
+
+
+logger = logging.getLogger(__name__)
+
+# Version of the schema, kept in PRAGMA user_version. The schema only adds
+# tables and indexes, so that older databases are upgraded by creating them.
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    id TEXT PRIMARY KEY,
+    image_name TEXT NOT NULL,
+    region TEXT,
+    instance_type TEXT,
+    source_image TEXT,
+    fingerprint TEXT,
+    config TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL,
+    status TEXT NOT NULL,
+    image TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS builds_image_name ON builds (image_name, started);
+CREATE INDEX IF NOT EXISTS builds_started ON builds (started);
+CREATE TABLE IF NOT EXISTS steps (
+    build_id TEXT NOT NULL REFERENCES builds (id) ON DELETE CASCADE,
+    step INTEGER NOT NULL,
+    instruction TEXT,
+    fingerprint TEXT,
+    duration REAL,
+    output_bytes INTEGER,
+    exit_code INTEGER,
+    PRIMARY KEY (build_id, step)
+);
+CREATE INDEX IF NOT EXISTS steps_fingerprint ON steps (fingerprint);
+CREATE INDEX IF NOT EXISTS steps_instruction ON steps (instruction);
+CREATE TABLE IF NOT EXISTS phases (
+    build_id TEXT NOT NULL REFERENCES builds (id) ON DELETE CASCADE,
+    phase TEXT NOT NULL,
+    duration REAL NOT NULL,
+    PRIMARY KEY (build_id, phase)
+);
+'''
+
+# AwsConfig keys that are left out of the recorded configuration
+SECRET_KEYS = ('aws_access_key_id', 'aws_secret_access_key')
+
+BUILD_COLUMNS = ('id', 'image_name', 'region', 'instance_type',
+                 'source_image', 'fingerprint', 'config', 'started',
+                 'duration', 'status', 'image', 'error')
+
+STEP_COLUMNS = ('build_id', 'step', 'instruction', 'fingerprint', 'duration',
+                'output_bytes', 'exit_code')
+
+
+class History(object):
+    """
+    SQLite store of past builds with the timings of their steps, at path.
+    Every call uses its own connection, so that builds on several threads
+    or in several processes can share it.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def _connect(self):
+        path = expanduser(self.path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = sqlite3.connect(path, timeout=30)
+        try:
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA foreign_keys = ON')
+            if db.execute('PRAGMA user_version').fetchone()[0] < \
+                    SCHEMA_VERSION:
+                # Readers do not block the build that records itself
+                db.execute('PRAGMA journal_mode = WAL')
+                db.executescript(
+                    f'{SCHEMA}PRAGMA user_version = {SCHEMA_VERSION};')
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add_build(self, build, steps, phases=None):
+        """
+        Records build, a dict of BUILD_COLUMNS, with steps, dicts of the
+        STEP_COLUMNS but build_id, and the durations of its phases by name
+        """
+        with self._connect() as db:
+            db.execute('DELETE FROM steps WHERE build_id = ?', (build['id'],))
+            db.execute('DELETE FROM phases WHERE build_id = ?',
+                       (build['id'],))
+            db.execute(
+                f'INSERT OR REPLACE INTO builds ({", ".join(BUILD_COLUMNS)}) '
+                f'VALUES ({", ".join("?" * len(BUILD_COLUMNS))})',
+                [build.get(column) for column in BUILD_COLUMNS])
+            db.executemany(
+                f'INSERT INTO steps ({", ".join(STEP_COLUMNS)}) '
+                f'VALUES ({", ".join("?" * len(STEP_COLUMNS))})',
+                [[build['id']] + [step.get(column)
+                                  for column in STEP_COLUMNS[1:]]
+                 for step in steps])
+            db.executemany(
+                'INSERT INTO phases (build_id, phase, duration) '
+                'VALUES (?, ?, ?)',
+                [(build['id'], phase, duration)
+                 for phase, duration in (phases or {}).items()])
+
+    def builds(self, image_name=None, limit=20):
+        """ Returns the last limit builds, of image_name if given """
+        with self._connect() as db:
+            if image_name:
+                return db.execute(
+                    'SELECT * FROM builds WHERE image_name = ? '
+                    'ORDER BY started DESC LIMIT ?',
+                    (image_name, limit)).fetchall()
+            return db.execute('SELECT * FROM builds ORDER BY started DESC '
+                              'LIMIT ?', (limit,)).fetchall()
+
+    def build(self, build_id):
+        """
+        Returns the build whose ID starts with build_id with its steps, or
+        (None, []) if there is no such build or more than one
+        """
+        with self._connect() as db:
+            builds = db.execute(
+                "SELECT * FROM builds WHERE id LIKE ? || '%' LIMIT 2",
+                (build_id,)).fetchall()
+            if len(builds) != 1:
+                return None, []
+            return builds[0], db.execute(
+                'SELECT * FROM steps WHERE build_id = ? ORDER BY step',
+                (builds[0]['id'],)).fetchall()
+
+    def step_runs(self, fingerprint, limit=20):
+        """
+        Returns the last limit runs of the step whose fingerprint starts with
+        fingerprint, with the image_name and started of their build
+        """
+        with self._connect() as db:
+            return db.execute(
+                'SELECT steps.*, builds.image_name, builds.started '
+                'FROM steps JOIN builds ON builds.id = steps.build_id '
+                "WHERE steps.fingerprint LIKE ? || '%' "
+                'AND steps.duration IS NOT NULL '
+                'ORDER BY builds.started DESC LIMIT ?',
+                (fingerprint, limit)).fetchall()
+
+    def phases(self, build_id):
+        """ Returns the durations of the phases of build_id by name """
+        with self._connect() as db:
+            return dict(db.execute(
+                'SELECT phase, duration FROM phases WHERE build_id = ?',
+                (build_id,)).fetchall())
+
+    def step_durations(self, fingerprint=None, instruction=None, step=None,
+                       image_name=None, before=None, limit=10):
+        """
+        Returns the durations of the last limit successful runs of the steps
+        with the given fingerprint, instruction and step number, in builds
+        of image_name that started before the given time, if given
+        """
+        conditions = ['steps.exit_code = 0', 'steps.duration IS NOT NULL']
+        params = []
+        for condition, value in (('steps.fingerprint = ?', fingerprint),
+                                 ('steps.instruction = ?', instruction),
+                                 ('steps.step = ?', step),
+                                 ('builds.image_name = ?', image_name),
+                                 ('builds.started < ?', before)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        with self._connect() as db:
+            return [row[0] for row in db.execute(
+                'SELECT steps.duration FROM steps '
+                'JOIN builds ON builds.id = steps.build_id '
+                f'WHERE {" AND ".join(conditions)} '
+                'ORDER BY builds.started DESC LIMIT ?',
+                params + [limit]).fetchall()]
+
+    def phase_durations(self, phase, image_name=None, before=None,
+                        limit=10):
+        """
+        Returns the durations of phase in the last limit successful builds,
+        of image_name and started before the given time if given
+        """
+        conditions = ['phases.phase = ?', "builds.status = 'succeeded'"]
+        params = [phase]
+        for condition, value in (('builds.image_name = ?', image_name),
+                                 ('builds.started < ?', before)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        with self._connect() as db:
+            return [row[0] for row in db.execute(
+                'SELECT phases.duration FROM phases '
+                'JOIN builds ON builds.id = phases.build_id '
+                f'WHERE {" AND ".join(conditions)} '
+                'ORDER BY builds.started DESC LIMIT ?',
+                params + [limit]).fetchall()]
+
+    def instructions(self, keyword, limit=200):
+        """
+        Returns the distinct instructions of the last limit steps that
+        start with keyword, such as RUN
+        """
+        with self._connect() as db:
+            return [row[0] for row in db.execute(
+                'SELECT DISTINCT instruction FROM (SELECT steps.instruction '
+                'FROM steps JOIN builds ON builds.id = steps.build_id '
+                "WHERE steps.instruction LIKE ? || ' %' "
+                'ORDER BY builds.started DESC LIMIT ?)',
+                (keyword, limit)).fetchall()]
+
+
+class HistoryRecorder(Events):
+    """
+    Events that record the build build_id of aws_config in a History once it
+    finishes, passing every event on to events if given. steps are the
+    (instruction, fingerprint) of its steps and fingerprint the one of the
+    build. The build is written in one transaction at the end, so that
+    recording it costs the steps nothing. A successful build is then
+    compared with the past ones, and the steps and phases that took more
+    than the regression_threshold of aws_config percent longer are reported
+    and emitted as regression events before build_finished.
+    """
+    def __init__(self, history, build_id, aws_config, steps,
+                 fingerprint=None, events=None):
+        self._history = history
+        self._events = events
+        self._lock = threading.Lock()
+        self._threshold = int(aws_config.regression_threshold)
+        self._times = {}
+        self._phases = {}
+        self._build = {
+            'id': build_id,
+            'image_name': aws_config.image_name,
+            'region': aws_config.region,
+            'instance_type': aws_config.instance_type,
+            'source_image': aws_config.image_id,
+            'fingerprint': fingerprint,
+            'config': json.dumps({key: value
+                                  for key, value in vars(aws_config).items()
+                                  if key not in SECRET_KEYS},
+                                 sort_keys=True),
+            'started': time.time(),
+        }
+        self._steps = {step: {'step': step, 'instruction': instruction,
+                              'fingerprint': step_fingerprint}
+                       for step, (instruction, step_fingerprint)
+                       in enumerate(steps, 1)}
+
+    def emit(self, event, **fields):
+        regressions = []
+        if event != 'build_finished' and self._events:
+            self._events.emit(event, **fields)
+        with self._lock:
+            if event in ('build_started', 'instance_ready', 'image_created'):
+                self._times[event] = time.monotonic()
+            if event == 'step_finished':
+                if fields['step']:
+                    self._times['steps_finished'] = time.monotonic()
+                step = self._steps.setdefault(fields['step'],
+                                              {'step': fields['step']})
+                step['duration'] = round(
+                    step.get('duration', 0) + fields['duration'], 3)
+                step.setdefault('output_bytes', 0)
+                # A step fails with the first command that fails
+                if not step.get('exit_code'):
+                    step['exit_code'] = fields['exit_code']
+            elif event == 'output':
+                step = self._steps.setdefault(fields['step'],
+                                              {'step': fields['step']})
+                step['output_bytes'] = step.get('output_bytes', 0) + \
+                    len(fields['text'].encode('utf8'))
+            elif event == 'image_created':
+                self._build['image'] = fields['image']
+            elif event == 'teardown_finished':
+                self._phases['teardown'] = fields['duration']
+            elif event == 'image_reused':
+                self._record(status='reused', image=fields['image'],
+                             duration=0)
+            elif event == 'build_finished':
+                if self._record(**fields) and fields['status'] == 'succeeded':
+                    regressions = self._regressions()
+        if event == 'build_finished' and self._events:
+            for name, duration, baseline in regressions:
+                self._events.emit('regression', name=name,
+                                  duration=duration, baseline=baseline)
+            self._events.emit(event, **fields)
+
+    def _phase_durations(self):
+        """ Returns the durations of the phases that are known by name """
+        phases = dict(self._phases)
+        bounds = (('launch', 'build_started', 'instance_ready'),
+                  ('steps', 'instance_ready', 'steps_finished'),
+                  ('save', 'steps_finished', 'image_created'))
+        for phase, start, end in bounds:
+            if start in self._times and end in self._times:
+                phases[phase] = round(self._times[end] - self._times[start], 3)
+        return phases
+
+    def _record(self, status, duration, image=None, error=None):
+        """ Records the build and returns whether it could """
+        self._build.update(status=status, duration=duration, error=error)
+        if image:
+            self._build['image'] = image
+        try:
+            self._history.add_build(
+                self._build, [self._steps[step] for step in sorted(
+                    self._steps)], self._phase_durations())
+        except (sqlite3.Error, OSError) as e:
+            # The build itself went fine
+            logger.warning(f'Unable to record the build in the history '
+                           f'{self._history.path}: {e}')
+            return False
+        return True
+
+    def _regressions(self):
+        """ Prints and returns the regressions of the build """
+        if not self._threshold:
+            return []
+        try:
+            regressions = find_regressions(self._history, self._build['id'],
+                                           self._threshold)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f'Unable to compare the build with the history '
+                           f'{self._history.path}: {e}')
+            return []
+        if regressions:
+            print(f'Slower than the median of the last builds by more than '
+                  f'{self._threshold}%:')
+        for name, duration, baseline in regressions:
+            print(f'  {name}: {format_seconds(duration)} instead of '
+                  f'{format_seconds(baseline)}')
+        return regressions
@@ -0,0 +1,129 @@
+import gzip
+import io
+import os
+import tarfile
+
+from os.path import join
+
+
+def _is_under(name, parent):
+    """ Whether the member name is parent or below it """
+    return (parent == '.' or name == parent
+            or name.startswith(f'{parent.rstrip("/")}/'))
+
+
+class IndexedArchive(object):
+    """
+    Build context archive made of chunks that are complete tar archives
+    compressed as independent gzip members. The whole file extracts with
+    `tar -xzi` and any run of chunks, read with a byte range, extracts the
+    same way without decompressing the others. The index file next to it
+    holds one "offset length name" line per member, separated by tabs.
+    """
+
+    # Uncompressed size at which the members added start a new chunk
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path, mode='r'):
+        """
+        Opens the archive at path for reading, or truncates it for writing
+        when mode is 'w'
+        """
+        self.path = path
+        self.index_path = f'{path}.idx'
+        self._data = None
+        self._index = None
+        self._pending = []
+        self._pending_size = 0
+        self._infos = tarfile.TarFile(fileobj=io.BytesIO(), mode='w')
+        if mode == 'w':
+            self._data = open(self.path, 'wb')
+            self._index = open(self.index_path, 'w')
+
+    def add(self, name, arcname=None, filter=None):
+        """ Adds name and what is below it like TarFile.add() does """
+        # Hard links become copies since their chunks extract on their own
+        self._infos.inodes = {}
+        info = self._infos.gettarinfo(name, arcname)
+        info = filter(info) if filter else info
+        if info is None:
+            return
+        self._pending.append((name, info))
+        self._pending_size += info.size if info.isreg() else 0
+        if self._pending_size >= self.CHUNK_SIZE:
+            self.flush()
+        if info.isdir():
+            for child in sorted(os.listdir(name)):
+                self.add(join(name, child), join(info.name, child), filter)
+
+    def flush(self):
+        """ Writes the members added since the last chunk as a chunk """
+        if not self._pending:
+            return
+        offset = self._data.tell()
+        with gzip.GzipFile(fileobj=self._data, mode='wb') as gz:
+            with tarfile.open(fileobj=gz, mode='w') as tar:
+                for name, info in self._pending:
+                    if info.isreg():
+                        with open(name, 'rb') as f:
+                            tar.addfile(info, f)
+                    else:
+                        tar.addfile(info)
+        length = self._data.tell() - offset
+        for name, info in self._pending:
+            self._index.write(f'{offset}\t{length}\t{info.name}\n')
+        self._pending = []
+        self._pending_size = 0
+
+    def tell(self):
+        """ Returns the size of the chunks written so far """
+        return self._data.tell()
+
+    def close(self):
+        if self._data:
+            self.flush()
+            self._data.close()
+            self._index.close()
+            self._data = self._index = None
+
+    def chunks(self, names, start=0):
+        """
+        Returns the (offset, length) of the chunks at or after start that
+        hold the members names and those below them, or None if one of
+        names is not in the archive
+        """
+        chunks = set()
+        with open(self.index_path) as f:
+            index = [line.rstrip('\n').split('\t', 2) for line in f]
+        for parent in names:
+            found = {(int(offset), int(length))
+                     for offset, length, name in index
+                     if int(offset) >= start and _is_under(name, parent)}
+            if not found:
+                return None
+            chunks |= found
+        return chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+def merge_ranges(chunks):
+    """ Returns the (offset, length) of chunks with adjacent ones merged """
+    ranges = []
+    for offset, length in sorted(chunks):
+        if ranges and sum(ranges[-1]) == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+        else:
+            ranges.append((offset, length))
+    return ranges
+
+
+def read_chunks_cmd(path, chunks):
+    """ Returns a shell command writing the chunks of path to stdout """
+    cmds = [f'tail -c +{offset + 1} {path} | head -c {length}'
+            for offset, length in merge_ranges(chunks)]
+    return cmds[0] if len(cmds) == 1 else f'{{ {"; ".join(cmds)}; }}'
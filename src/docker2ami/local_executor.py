@@ -0,0 +1,183 @@
+import datetime
+import logging
+import os
+import select
+import shutil
+import signal
+import subprocess
+import tarfile
+
+from os.path import expanduser, join
+
+from .build_log import BuildLog, StepOutput
+from .color import Color
+from .executor import TIMEOUT_EXIT_CODE, AbstractExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+def _snapshot(root_dir, exclude):
+    """
+    Returns a dict of path relative to root_dir -> (mode, size, mtime) for
+    everything below root_dir except the paths in exclude
+    """
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames[:] = [d for d in dirnames if join(dirpath, d) not in exclude]
+        for name in dirnames + filenames:
+            path = join(dirpath, name)
+            if path in exclude:
+                continue
+            st = os.lstat(path)
+            entries[os.path.relpath(path, root_dir)] = \
+                (st.st_mode, st.st_size, st.st_mtime_ns)
+    return entries
+
+
+class LocalExecutor(AbstractExecutor):
+    """
+    Object for running the steps of a Dockerfile in a local directory
+    instead of on an EC2. Steps run in a subprocess shell whose HOME is
+    root_dir, or inside a chroot of root_dir when chroot is True. The image
+    is a tarball of the filesystem changes below root_dir.
+    """
+    def __init__(self, aws_config, root_dir, chroot=False, source_dir='.',
+                 events=None):
+        """
+        Initializes the executor from the given configuration. The progress
+        of the build is emitted to events, if given.
+        """
+        self._config = aws_config
+        self.source_dir = source_dir
+        self._root_dir = os.path.abspath(expanduser(root_dir))
+        self._chroot = chroot
+        self._context_path = join(self._root_dir,
+                                  AbstractExecutor.context_dir.lstrip('/'))
+        self._env_path = join(self._root_dir,
+                              AbstractExecutor.env_file.lstrip('/'))
+        self.context_dir = (AbstractExecutor.context_dir if chroot
+                            else self._context_path)
+        self.env_file = AbstractExecutor.env_file if chroot else self._env_path
+        self._snapshot = None
+        self._build_log = None
+        self._step_timeouts = {}
+        if events:
+            self.events = events
+
+    def start(self):
+        if self._config.log_file:
+            self._build_log = BuildLog(self._config.log_file, 'w')
+        os.makedirs(os.path.dirname(self._env_path), exist_ok=True)
+        open(self._env_path, 'w').close()
+        self._snapshot = _snapshot(self._root_dir, self._build_paths())
+        print(f'Local root: {self._root_dir}')
+
+    def _build_paths(self):
+        """ Returns the paths that are not part of the image """
+        return {self._context_path, self._env_path}
+
+    def send_archive(self, planner=None):
+        # Destinations are outside of root_dir without a chroot, so the
+        # files are always copied by the steps
+        print('\nCopy context...')
+        shutil.rmtree(self._context_path, ignore_errors=True)
+        os.makedirs(self._context_path)
+        for path, name in self._context_files():
+            logger.info(f'Adding file to context: {name}')
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.copytree(path, join(self._context_path, name),
+                                symlinks=True)
+            else:
+                shutil.copy2(path, self._context_path, follow_symlinks=False)
+        return set()
+
+    def check_destination(self, path):
+        # Without a chroot the steps run on this machine, where absolute
+        # paths outside of root_dir are not part of the image
+        if self._chroot or not os.path.isabs(path):
+            return None
+        path = os.path.normpath(path)
+        if path == self._root_dir or \
+                path.startswith(self._root_dir + os.sep):
+            return None
+        return (f'{path} is outside of {self._root_dir}, use a relative '
+                'path or --chroot')
+
+    def update_env(self, statement):
+        with open(self._env_path, 'a') as f:
+            f.write(f'{statement}\n')
+
+    def _exec(self, cmd, step, prefix=None):
+        script = f'cd; . {self.env_file}\n{cmd}'
+        if self._chroot:
+            args = ['chroot', self._root_dir, '/bin/sh', '-c', script]
+            proc_env = dict(os.environ, HOME='/root')
+        else:
+            args = ['/bin/sh', '-c', script]
+            proc_env = dict(os.environ, HOME=self._root_dir)
+        # The command gets its own process group so that it can be stopped
+        # with everything it started
+        proc = subprocess.Popen(args, env=proc_env, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=True)
+        output = StepOutput(step, self._build_log,
+                            int(self._config.log_tail_lines), prefix,
+                            self.events)
+        deadline = self._deadline(step)
+        try:
+            while True:
+                if deadline.poll_interval and not select.select(
+                        [proc.stdout], [], [], deadline.poll_interval)[0]:
+                    data = None
+                else:
+                    data = proc.stdout.read1(32768)
+                    if not data:
+                        break
+                    output.write(data)
+                    deadline.output()
+                expired = deadline.expired()
+                if expired:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    proc.wait()
+                    print(f'{Color.RED}{prefix or ""}Step {step} {expired}, '
+                          f'stopped it{Color.CLEAR}')
+                    return TIMEOUT_EXIT_CODE
+        except BaseException:
+            # Such as KeyboardInterrupt, which the command no longer gets
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            raise
+        finally:
+            output.close()
+        return proc.wait()
+
+    def save_image(self):
+        after = _snapshot(self._root_dir, self._build_paths())
+        image_path = expanduser(join(
+            self._config.tmp_dir,
+            f'{self._config.image_name}-'
+            f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.tar.gz'))
+        print(f'\nCreate image from: {self._root_dir}')
+        with tarfile.open(image_path, 'w:gz') as tar:
+            for path in sorted(after):
+                if self._snapshot.get(path) != after[path]:
+                    tar.add(join(self._root_dir, path), arcname=path,
+                            recursive=False)
+
+            # Deleted files are recorded as whiteouts like in Docker layers
+            deleted = set(self._snapshot) - set(after)
+            for path in sorted(deleted):
+                parent, name = os.path.split(path)
+                if parent in deleted:
+                    continue
+                whiteout = tarfile.TarInfo(join(parent, f'.wh.{name}'))
+                tar.addfile(whiteout)
+
+        print(f'\nCreated image: {image_path}')
+        self.events.emit('image_created', image=image_path)
+        return image_path
+
+    def finish(self):
+        if self._build_log:
+            self._build_log.close()
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 import re
-from docker2ami.ami_builder import Color
+from docker2ami.color import Color
+from docker2ami.config import DURATION_REGEX_STR, parse_duration
 
 
 # Match bash args
@@ -23,9 +24,28 @@ URL_REGEX = re.compile(
   r'[a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+'
   r'(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:\'".,<>?«»“”‘’]))')
 
+# Matches local archives that ADD extracts
+LOCAL_ARCHIVE_REGEX = re.compile(r'.*\.(tgz|tar|tar\.gz|tar\.bz|tar\.xz)$')
+
 # Matches # AWS-SKIP
 AWS_SKIP_REGEX = re.compile(r'^\s*#\s*AWS-SKIP.*$')
 
+# Matches # AWS-PARALLEL, which starts a group of steps that may run
+# concurrently
+AWS_PARALLEL_REGEX = re.compile(r'^\s*#\s*AWS-PARALLEL\s*$')
+
+# Matches # AWS-PARALLEL-END, which ends a group of steps that may run
+# concurrently
+AWS_PARALLEL_END_REGEX = re.compile(r'^\s*#\s*AWS-PARALLEL-END\s*$')
+
+# Matches # AWS-TIMEOUT 30m [5m], which limits how long the next step runs
+# and, optionally, how long it may go without printing anything
+AWS_TIMEOUT_REGEX = re.compile(r'^\s*#\s*AWS-TIMEOUT\s+' + DURATION_REGEX_STR
+                               + r'(?:\s+' + DURATION_REGEX_STR + r')?\s*$')
+
+# Matches FROM image, whose AMI is image_id rather than the image
+FROM_REGEX = re.compile(r'^\s*FROM\s+(\S+)', re.IGNORECASE)
+
 # Matches empty lines and comments
 COMMENT_REGEX = re.compile(r'^(\s*#.*|)$')
 
@@ -91,12 +111,35 @@ def parse_dockerfile_with_delegate(fp, delegate):
     """
     mline = False
     line = ''
+    parallel = False
     for line0 in fp.read().splitlines():
         # Skip next instruction
         if AWS_SKIP_REGEX.match(line0):
             delegate.run_skip()
             continue
 
+        # Start or end a group of steps that may run concurrently
+        elif AWS_PARALLEL_REGEX.match(line0):
+            if parallel:
+                delegate.run_parallel_end()
+            parallel = True
+            delegate.run_parallel_start()
+            continue
+        elif AWS_PARALLEL_END_REGEX.match(line0):
+            if parallel:
+                delegate.run_parallel_end()
+            parallel = False
+            continue
+
+        # Limit how long the next step runs
+        elif AWS_TIMEOUT_REGEX.match(line0):
+            durations = AWS_TIMEOUT_REGEX.match(line0).groups()
+            delegate.run_timeout(
+                parse_duration(''.join(durations[:2])),
+                parse_duration(''.join(durations[2:])) if durations[2]
+                else None)
+            continue
+
         # Skip empty lines and  comments
         elif COMMENT_REGEX.match(line0):
             delegate.run_nop()
@@ -143,6 +186,10 @@ def parse_dockerfile_with_delegate(fp, delegate):
         else:
             delegate.run_unknown(line)
 
+    # A group that is still open ends with the Dockerfile
+    if parallel:
+        delegate.run_parallel_end()
+
 
 class AbstractParserDelegate(object):
     """
@@ -153,6 +200,25 @@ class AbstractParserDelegate(object):
         """ Invoked when the AWS-SKIP tag is encountered """
         pass
 
+    def run_parallel_start(self):
+        """ Invoked when the AWS-PARALLEL tag is encountered """
+        pass
+
+    def run_parallel_end(self):
+        """
+        Invoked when the group started by AWS-PARALLEL ends with the
+        AWS-PARALLEL-END tag, another AWS-PARALLEL tag or the Dockerfile
+        """
+        pass
+
+    def run_timeout(self, timeout, idle_timeout):
+        """
+        Invoked when the AWS-TIMEOUT tag limits the next step to timeout
+        seconds and, unless it is None, to idle_timeout seconds without
+        output. 0 is no limit.
+        """
+        pass
+
     def run_nop(self):
         """ Invoked when a COMMENT or blank linke is encountered """
         pass
@@ -185,12 +251,11 @@ class AbstractParserDelegate(object):
 class ParserState(object):
     """
     Object that holds simple state information such as the step
-    number, the skip state and the environment state
+    number and the skip state
     """
     def __init__(self):
         self.step = 0
         self.skip = False
-        self.env = ''
 
 
 class SimpleStateParserDelegate(AbstractParserDelegate):
@@ -206,6 +271,15 @@ class SimpleStateParserDelegate(AbstractParserDelegate):
         self._parser_state.skip = True
         self._parser_delegate.run_skip()
 
+    def run_parallel_start(self):
+        self._parser_delegate.run_parallel_start()
+
+    def run_parallel_end(self):
+        self._parser_delegate.run_parallel_end()
+
+    def run_timeout(self, timeout, idle_timeout):
+        self._parser_delegate.run_timeout(timeout, idle_timeout)
+
     def run_nop(self):
         self._parser_delegate.run_nop()
 
@@ -213,7 +287,6 @@ class SimpleStateParserDelegate(AbstractParserDelegate):
         if (not self._parser_state.skip):
             self._parser_state.step = self._parser_state.step + 1
             print(f'Step {self._parser_state.step}: ENV {key} {value}')
-            self._parser_state.env += f'{key}={value};'
             self._parser_delegate.run_env(key, value)
         else:
             print(f'{Color.DARK_GREY}Skipping for AWS: '
@@ -254,7 +327,6 @@ class SimpleStateParserDelegate(AbstractParserDelegate):
         if (not self._parser_state.skip):
             self._parser_state.step = self._parser_state.step + 1
             print(f'Step {self._parser_state.step}: WORKDIR {path}')
-            self._parser_state.env += f'cd {path};'
             self._parser_delegate.run_workdir(path)
         else:
             print(f'{Color.DARK_GREY}Skipping for AWS: '
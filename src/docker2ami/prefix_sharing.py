@@ -0,0 +1,194 @@
+import collections
+import statistics
+
+from .build_graph import iter_graph, run_build_graph
+from .estimate import BASELINE_RUNS, estimate_step
+
+
+# Image name of the intermediate AMIs, followed by their fingerprint
+SHARED_IMAGE_PREFIX = 'docker-build-ami-shared'
+
+# Phases a build adds to a multi-Dockerfile build besides its steps
+BUILD_OVERHEAD_PHASES = ('launch', 'save', 'teardown')
+
+# Steps that leave the image as it is, which every build runs again
+STATE_INSTRUCTIONS = ('ENV', 'WORKDIR')
+
+
+class Target(object):
+    """
+    Dockerfile of a multi-Dockerfile build: the name of its AMI, its build
+    context source_dir, the fingerprint of its build and the (instruction,
+    fingerprint) of its steps, as step_fingerprints() returns them
+    """
+    def __init__(self, name, source_dir, fingerprint, steps):
+        self.name = name
+        self.source_dir = source_dir
+        self.fingerprint = fingerprint
+        self.steps = steps
+
+
+class SharedBuild(object):
+    """
+    Build of a multi-Dockerfile build that runs the steps in the range
+    steps of the Dockerfile in source_dir, starting from the AMI of the
+    SharedBuild before it or from the source AMI. It builds the AMI of
+    target, or without one an intermediate AMI that its children start
+    from. The targets of aliases end where target does and get its AMI
+    without a build of their own. step_fingerprints are those of the whole
+    Dockerfile.
+    """
+    def __init__(self, source_dir, steps, step_fingerprints, targets,
+                 target=None, aliases=()):
+        self.source_dir = source_dir
+        self.steps = steps
+        self.step_fingerprints = step_fingerprints
+        # The number of targets that need the steps
+        self.targets = targets
+        self.target = target
+        self.aliases = list(aliases)
+        self.children = []
+        if target:
+            self.image_name = target.name
+            self.fingerprint = target.fingerprint
+        else:
+            # The AMI is the state after the last step, whatever it is for
+            self.fingerprint = step_fingerprints[steps[-1] - 1][1]
+            self.image_name = f'{SHARED_IMAGE_PREFIX}-{self.fingerprint[:12]}'
+
+    def __str__(self):
+        names = ', '.join([self.image_name]
+                          + [target.name for target in self.aliases])
+        if not self.steps:
+            return f'no steps -> {names}'
+        if len(self.steps) == 1:
+            return f'step {self.steps[0]} of {self.source_dir} -> {names}'
+        return f'steps {self.steps[0]}-{self.steps[-1]} of ' \
+               f'{self.source_dir} -> {names}'
+
+
+class _Node(object):
+    """ Node of a trie of steps, keyed by their fingerprints """
+    def __init__(self, depth=0):
+        self.depth = depth
+        self.children = collections.OrderedDict()
+        self.targets = []
+        self.count = 0
+
+
+def plan_shared_builds(targets):
+    """
+    Returns the SharedBuilds that build targets with every sequence of
+    steps their Dockerfiles start with built once. The steps are compared by
+    fingerprint, so that steps only match when they run the same instruction
+    with the same files on the same state. A target that ends where other
+    targets go on is the AMI they start from, and the targets that end
+    where another one does get its AMI. Sequences of ENV and WORKDIR
+    steps alone are not worth an intermediate AMI and are run by the builds
+    after them instead.
+    """
+    root = _Node()
+    for target in targets:
+        node = root
+        for _, fingerprint in target.steps:
+            node = node.children.setdefault(fingerprint,
+                                            _Node(node.depth + 1))
+            node.count += 1
+        node.targets.append(target)
+
+    def builds(start, first_step=None):
+        """
+        Returns the SharedBuilds of the subtrie below start, starting from
+        the AMI of the build that stops at it or before first_step
+        """
+        if first_step is None:
+            first_step = start.depth + 1
+        # The targets without steps start from their own source AMI
+        result = [SharedBuild(target.source_dir, range(0), target.steps, 1,
+                              target)
+                  for target in start.targets] if start is root else []
+        for node in start.children.values():
+            while len(node.children) == 1 and not node.targets:
+                node = next(iter(node.children.values()))
+            first = _first_target(node)
+            steps = range(first_step, node.depth + 1)
+            if not node.targets and all(
+                    first.steps[step - 1][0].split(' ', 1)[0]
+                    in STATE_INSTRUCTIONS for step in steps):
+                result += builds(node, first_step)
+                continue
+            build = SharedBuild(first.source_dir, steps, first.steps,
+                                node.count,
+                                node.targets[0] if node.targets else None,
+                                node.targets[1:])
+            build.children = builds(node)
+            result.append(build)
+        return result
+
+    return builds(root)
+
+
+def _first_target(node):
+    """ Returns the first target that ends at node or below it """
+    while not node.targets:
+        node = next(iter(node.children.values()))
+    return node.targets[0]
+
+
+class Saving(object):
+    """
+    What sharing the builds saves: step_runs out of total_step_runs, and
+    the seconds those take minus the overhead of the extra builds, or None
+    without history
+    """
+    def __init__(self, step_runs, total_step_runs, extra_builds,
+                 seconds=None, overhead=None):
+        self.step_runs = step_runs
+        self.total_step_runs = total_step_runs
+        self.extra_builds = extra_builds
+        self.seconds = seconds
+        self.overhead = overhead
+
+
+def estimate_saving(builds, targets, history=None):
+    """
+    Returns the Saving of building targets as the SharedBuilds builds, in
+    seconds when given the History of past builds
+    """
+    total = sum(len(target.steps) for target in targets)
+    runs = sum(len(build.steps) for _, build in iter_graph(builds))
+    extra_builds = sum(1 for _, build in iter_graph(builds)
+                       if not build.target)
+    if history is None:
+        return Saving(total - runs, total, extra_builds)
+
+    seconds = 0
+    for _, build in iter_graph(builds):
+        for step in build.steps:
+            instruction, fingerprint = build.step_fingerprints[step - 1]
+            estimate, _ = estimate_step(history, instruction, fingerprint)
+            seconds += (build.targets - 1) * (estimate or 0)
+    overhead = 0
+    durations = history.step_durations(step=0, limit=BASELINE_RUNS)
+    if durations:
+        overhead += statistics.median(durations)
+    for phase in BUILD_OVERHEAD_PHASES:
+        durations = history.phase_durations(phase, limit=BASELINE_RUNS)
+        if durations:
+            overhead += statistics.median(durations)
+    return Saving(total - runs, total, extra_builds, seconds,
+                  overhead * extra_builds)
+
+
+def run_shared_builds(builds, build, jobs=4):
+    """
+    Runs build(shared_build, image_id) for every SharedBuild of builds as
+    run_build_graph() does. Returns the AMI ID of every target by name, or
+    the exception that failed its build or a build before it.
+    """
+    results = {}
+    for shared, result in run_build_graph(builds, build, jobs).items():
+        if shared.target:
+            for target in [shared.target] + shared.aliases:
+                results[target.name] = result
+    return results
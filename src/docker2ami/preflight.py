@@ -0,0 +1,273 @@
+import concurrent.futures
+import configparser
+import glob
+import json
+import logging
+
+from os.path import join, normpath
+
+from .config import ARCHIVE_FORMATS, RETRY_MODES, VOLUME_TYPES, \
+    parse_duration
+from .parser import AbstractParserDelegate, is_quoted, is_url_arg, \
+    parse_dockerfile_with_delegate
+
+
+logger = logging.getLogger(__name__)
+
+
+def _are_strings(value):
+    return isinstance(value, list) and all(isinstance(i, str) for i in value)
+
+
+def _are_tags(value):
+    return isinstance(value, list) and all(
+        isinstance(tag, dict) and set(tag) == {'Key', 'Value'}
+        for tag in value)
+
+
+# Configuration keys holding JSON, as (key, check of the value, expected)
+JSON_KEYS = (
+    ('security_group_ids', _are_strings, 'a list of security group IDs'),
+    ('host_tags', _are_tags, 'a list of {"Key", "Value"} tags'),
+    ('image_tags', _are_tags, 'a list of {"Key", "Value"} tags'),
+    ('cache_dirs', _are_strings, 'a list of directories'),
+)
+
+# Configuration keys holding booleans
+BOOL_KEYS = ('reuse_image', 'cloud_init_ready', 'instance_store_scratch',
+             'prewarm_root_volume')
+
+# Configuration keys holding durations
+DURATION_KEYS = ('step_timeout', 'idle_timeout')
+
+# Configuration keys holding integers, as (key, minimum)
+INT_KEYS = (
+    ('log_tail_lines', 0),
+    ('cache_volume_size', 1),
+    ('cache_snapshots_kept', 0),
+    ('max_pool_connections', 1),
+    ('api_rate_limit', 0),
+    ('ssh_keepalive', 0),
+    ('ssh_retries', 0),
+    ('regression_threshold', 0),
+    ('root_volume_size', 0),
+    ('root_volume_iops', 0),
+    ('root_volume_throughput', 0),
+)
+
+
+class ContextSourcesDelegate(AbstractParserDelegate):
+    """
+    ParserDelegate that collects the sources of the COPY and ADD steps that
+    are read from the build context
+    """
+    def __init__(self):
+        self.sources = []
+        self._skip = False
+
+    def run_skip(self):
+        self._skip = True
+
+    def _add(self, src):
+        if self._skip:
+            self._skip = False
+        elif not is_url_arg(src):
+            self.sources.append(src)
+
+    def run_env(self, key, value):
+        self._skip = False
+
+    def run_run(self, cmds):
+        self._skip = False
+
+    def run_copy(self, src, dst):
+        self._add(src)
+
+    def run_add(self, src, dst):
+        self._add(src)
+
+    def run_workdir(self, path):
+        self._skip = False
+
+
+def check_context(fp, source_dir='.'):
+    """
+    Returns the problems with the sources of the COPY and ADD steps of the
+    Dockerfile in fp whose build context is source_dir
+    """
+    delegate = ContextSourcesDelegate()
+    parse_dockerfile_with_delegate(fp, delegate)
+    problems = []
+    for src in delegate.sources:
+        path = src[1:-1] if is_quoted(src) else src
+        # Variables are only known on the builder
+        if '$' in path:
+            continue
+        if normpath(path).startswith('..'):
+            problems.append(f'COPY/ADD source is outside of the build '
+                            f'context: {src}')
+        elif not glob.glob(join(glob.escape(source_dir), path)):
+            problems.append(f'COPY/ADD source is missing from the build '
+                            f'context: {src}')
+    return problems
+
+
+def check_config(aws_config):
+    """ Returns the problems with the values of aws_config """
+    problems = []
+    for key, check, expected in JSON_KEYS:
+        value = getattr(aws_config, key)
+        try:
+            valid = check(json.loads(value))
+        except ValueError as e:
+            problems.append(f'{key} is not valid JSON ({e}): {value}')
+            continue
+        if not valid:
+            problems.append(f'{key} must be {expected}: {value}')
+    for key, minimum in INT_KEYS:
+        value = getattr(aws_config, key)
+        try:
+            valid = int(value) >= minimum
+        except ValueError:
+            valid = False
+        if not valid:
+            problems.append(
+                f'{key} must be an integer of at least {minimum}: {value}')
+    for key in DURATION_KEYS:
+        value = getattr(aws_config, key)
+        try:
+            parse_duration(value)
+        except ValueError:
+            problems.append(f'{key} must be a duration such as 90s, 30m or '
+                            f'2h: {value}')
+    for key in BOOL_KEYS:
+        value = getattr(aws_config, key)
+        if str(value).lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+            problems.append(f'{key} must be true or false: {value}')
+    if aws_config.archive_format not in ARCHIVE_FORMATS:
+        problems.append(f'archive_format must be one of '
+                        f'{", ".join(ARCHIVE_FORMATS)}: '
+                        f'{aws_config.archive_format}')
+    if aws_config.retry_mode not in RETRY_MODES:
+        problems.append(f'retry_mode must be one of {", ".join(RETRY_MODES)}: '
+                        f'{aws_config.retry_mode}')
+    if aws_config.root_volume_type and \
+            aws_config.root_volume_type not in VOLUME_TYPES:
+        problems.append(f'root_volume_type must be one of '
+                        f'{", ".join(VOLUME_TYPES)}: '
+                        f'{aws_config.root_volume_type}')
+    return problems
+
+
+def _json_list(value):
+    """ Returns the JSON list in value, or [] if it is not one """
+    try:
+        value = json.loads(value)
+    except ValueError:
+        return []
+    return value if isinstance(value, list) else []
+
+
+def check_image(ec2, aws_config):
+    images = ec2.describe_images(ImageIds=[aws_config.image_id])['Images']
+    if not images:
+        return [f'AMI {aws_config.image_id} does not exist in '
+                f'{aws_config.region}']
+    return []
+
+
+def check_subnet(ec2, aws_config):
+    if not aws_config.subnet_id:
+        return []
+    subnets = ec2.describe_subnets(
+        SubnetIds=[aws_config.subnet_id])['Subnets']
+    if not subnets:
+        return [f'Subnet {aws_config.subnet_id} does not exist in '
+                f'{aws_config.region}']
+    return []
+
+
+def check_security_groups(ec2, aws_config):
+    group_ids = _json_list(aws_config.security_group_ids)
+    if not group_ids:
+        return []
+    groups = ec2.describe_security_groups(
+        GroupIds=group_ids)['SecurityGroups']
+    missing = set(group_ids) - {group['GroupId'] for group in groups}
+    if missing:
+        return [f'Security groups do not exist in {aws_config.region}: '
+                f'{", ".join(sorted(missing))}']
+    return []
+
+
+def check_instance_type(ec2, aws_config):
+    types = ec2.describe_instance_types(
+        InstanceTypes=[aws_config.instance_type])['InstanceTypes']
+    if not types:
+        return [f'Instance type {aws_config.instance_type} does not exist in '
+                f'{aws_config.region}']
+    return []
+
+
+# Checks that describe the AWS resources of the configuration
+AWS_CHECKS = (
+    ('AMI', check_image),
+    ('subnet', check_subnet),
+    ('security groups', check_security_groups),
+    ('instance type', check_instance_type),
+)
+
+# Error codes of the AWS checks that mean the configuration is invalid, such
+# as InvalidAMIID.NotFound. Others, such as UnauthorizedOperation for a policy
+# without the Describe calls, only skip the check.
+INVALID_CODE_SUFFIXES = ('.NotFound', '.Malformed')
+INVALID_CODES = ('InvalidInstanceType',)
+
+
+def _is_invalid_code(code):
+    return code in INVALID_CODES or code.endswith(INVALID_CODE_SUFFIXES)
+
+
+def preflight(dockerfile_path, aws_config, source_dir='.',
+              session_factory=None):
+    """
+    Checks the build of the Dockerfile at dockerfile_path and returns all
+    the problems found. The AWS checks, which are left out without a
+    SessionFactory, run concurrently with the check of the build context.
+    """
+    problems = check_config(aws_config)
+    ec2 = None
+    # The clients cannot be configured with an invalid configuration
+    if session_factory and not problems:
+        try:
+            ec2 = session_factory.session(aws_config).client('ec2')
+        except Exception as e:
+            problems.append(f'Unable to connect to EC2: {e}')
+
+    def read_check_context():
+        with open(dockerfile_path, 'r') as dockerfile:
+            return check_context(dockerfile, source_dir)
+
+    def aws_check(name, check):
+        try:
+            return check(ec2, aws_config)
+        except Exception as e:
+            # Such as InvalidAMIID.NotFound for an AMI of another region
+            error = getattr(e, 'response', {}).get('Error', {})
+            if not error.get('Code'):
+                return [f'Unable to check the {name}: {e}']
+            message = error.get('Message') or error['Code']
+            if _is_invalid_code(error['Code']):
+                return [f'Invalid {name}: {message}']
+            logger.warning(f'Skipped the check of the {name}: '
+                           f'{error["Code"]}: {message}')
+            return []
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(AWS_CHECKS) + 1) as pool:
+        futures = [pool.submit(read_check_context)]
+        if ec2:
+            futures += [pool.submit(aws_check, name, check)
+                        for name, check in AWS_CHECKS]
+        return problems + [problem for future in futures
+                           for problem in future.result()]
@@ -0,0 +1,121 @@
+import concurrent.futures
+import datetime
+import logging
+import re
+
+
+logger = logging.getLogger(__name__)
+
+# Format of the CreationDate of images
+CREATION_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def _created(image):
+    return datetime.datetime.strptime(image['CreationDate'],
+                                      CREATION_DATE_FORMAT)
+
+
+def image_snapshots(image):
+    """ Returns the IDs of the EBS snapshots backing image """
+    return [mapping['Ebs']['SnapshotId']
+            for mapping in image.get('BlockDeviceMappings', [])
+            if mapping.get('Ebs', {}).get('SnapshotId')]
+
+
+def parse_protected_tag(value):
+    """ Returns the (key, value) of a KEY[=VALUE] tag, value None for any """
+    key, sep, tag_value = value.partition('=')
+    return key, tag_value if sep else None
+
+
+def is_protected(image, protected_tags):
+    """ Whether image has one of the (key, value) protected_tags """
+    return any(tag['Key'] == key and value in (None, tag['Value'])
+               for tag in image.get('Tags', [])
+               for key, value in protected_tags)
+
+
+def find_images(ec2, image_name):
+    """
+    Returns the available AMIs of the account that builds of image_name
+    saved, named image_name-<timestamp>, the newest first
+    """
+    name_regex = re.compile(re.escape(image_name) + r'-\d{14}$')
+    images = ec2.describe_images(Owners=['self'], Filters=[
+        {'Name': 'name', 'Values': [f'{image_name}-*']},
+        {'Name': 'state', 'Values': ['available']},
+    ])['Images']
+    return sorted((image for image in images
+                   if name_regex.match(image['Name'])),
+                  key=_created, reverse=True)
+
+
+def plan_prune(images, keep, min_age=None, protected_tags=(), now=None):
+    """
+    Returns the (image, reason) of images, which are those of one image
+    name the newest first, with the reason it is kept or None if it is
+    pruned. The newest keep images, those younger than the timedelta
+    min_age and those with protected tags are kept.
+    """
+    now = now or datetime.datetime.utcnow()
+    plan = []
+    for i, image in enumerate(images):
+        if i < keep:
+            reason = f'newest {keep}'
+        elif min_age and now - _created(image) < min_age:
+            reason = 'too young'
+        elif is_protected(image, protected_tags):
+            reason = 'protected'
+        else:
+            reason = None
+        plan.append((image, reason))
+    return plan
+
+
+def prune_image(ec2, image, snapshot_ids):
+    """
+    Deregisters image and deletes its snapshot_ids, returning the problems
+    met. The snapshots are left when the image cannot be deregistered.
+    """
+    try:
+        ec2.deregister_image(ImageId=image['ImageId'])
+    except Exception as e:
+        return [f'Unable to deregister {image["ImageId"]}: {e}']
+    logger.info(f'Deregistered image: {image["ImageId"]}')
+    problems = []
+    for snapshot_id in snapshot_ids:
+        try:
+            ec2.delete_snapshot(SnapshotId=snapshot_id)
+        except Exception as e:
+            problems.append(f'Unable to delete snapshot {snapshot_id} of '
+                            f'{image["ImageId"]}: {e}')
+        else:
+            logger.info(f'Deleted snapshot: {snapshot_id}')
+    return problems
+
+
+def pruned_snapshots(plan):
+    """
+    Returns the IDs of the snapshots to delete with each image of plan that
+    is not kept, by image ID. Snapshots that also back a kept image are left.
+    """
+    kept = {snapshot_id for image, reason in plan if reason
+            for snapshot_id in image_snapshots(image)}
+    return {image['ImageId']: [snapshot_id
+                               for snapshot_id in image_snapshots(image)
+                               if snapshot_id not in kept]
+            for image, reason in plan if reason is None}
+
+
+def prune_images(ec2, plan, workers=4):
+    """
+    Prunes the images of plan that are not kept, workers of them at a
+    time, and returns the problems met
+    """
+    snapshots = pruned_snapshots(plan)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(prune_image, ec2, image,
+                               snapshots[image['ImageId']])
+                   for image, reason in plan if reason is None]
+        return [problem for future in futures
+                for problem in future.result()]
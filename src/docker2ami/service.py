@@ -0,0 +1,356 @@
+import argparse
+import collections
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import socketserver
+import threading
+import uuid
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import isabs, isfile, join
+
+from .config import AwsConfig
+from .sessions import SessionFactory
+
+
+logger = logging.getLogger(__name__)
+
+# States of a job, the last three being final
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat() + 'Z'
+
+
+class Job(object):
+    """ Build of the Dockerfile in a context directory """
+    def __init__(self, job_id, context, aws_config, priority=0,
+                 direct_copy=False):
+        self.id = job_id
+        self.context = context
+        self.aws_config = aws_config
+        self.priority = priority
+        self.direct_copy = direct_copy
+        self.state = QUEUED
+        self.image_id = None
+        self.error = None
+        self.created = _now()
+        self.started = None
+        self.finished = None
+
+    def limit_keys(self):
+        """ Returns the keys whose number of running jobs is limited """
+        return (('account', self.aws_config.aws_access_key_id),
+                ('region', self.aws_config.region),
+                ('instance_type', self.aws_config.instance_type))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'context': self.context,
+            'priority': self.priority,
+            'state': self.state,
+            'image_id': self.image_id,
+            'error': self.error,
+            'log_file': self.aws_config.log_file,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobQueue(object):
+    """
+    Queue of jobs handed out by priority, then in the order they were put,
+    skipping those that would exceed the number of running jobs allowed per
+    account, region or instance type. A limit of 0 is no limit.
+    """
+    def __init__(self, max_per_account=0, max_per_region=0,
+                 max_per_instance_type=0):
+        self._limits = {
+            'account': max_per_account,
+            'region': max_per_region,
+            'instance_type': max_per_instance_type,
+        }
+        self._heap = []
+        self._counter = itertools.count()
+        self._running = collections.Counter()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def _allowed(self, job):
+        return all(not self._limits[kind]
+                   or self._running[(kind, value)] < self._limits[kind]
+                   for kind, value in job.limit_keys())
+
+    def put(self, job):
+        with self._cond:
+            heapq.heappush(self._heap,
+                           (-job.priority, next(self._counter), job))
+            self._cond.notify_all()
+
+    def _next(self):
+        for entry in sorted(self._heap):
+            if self._allowed(entry[2]):
+                return entry
+        return None
+
+    def get(self):
+        """
+        Waits for a job that is allowed to run and returns it, or None once
+        the queue is closed
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._closed or self._next())
+            if self._closed:
+                return None
+            entry = self._next()
+            self._heap.remove(entry)
+            heapq.heapify(self._heap)
+            self._running.update(entry[2].limit_keys())
+            return entry[2]
+
+    def done(self, job):
+        """ Releases the limits held by a job returned by get() """
+        with self._cond:
+            self._running.subtract(job.limit_keys())
+            self._cond.notify_all()
+
+    def remove(self, job):
+        """ Removes a queued job, returning whether it was queued """
+        with self._cond:
+            for entry in self._heap:
+                if entry[2] is job:
+                    self._heap.remove(entry)
+                    heapq.heapify(self._heap)
+                    return True
+            return False
+
+    def close(self):
+        """ Makes get() return None and returns the jobs left queued """
+        with self._cond:
+            self._closed = True
+            jobs = [entry[2] for entry in sorted(self._heap)]
+            self._heap = []
+            self._cond.notify_all()
+            return jobs
+
+
+class BuildService(object):
+    """
+    Runs the jobs of a JobQueue on worker threads. build(aws_config,
+    source_dir, direct_copy, session) builds a job and returns the image ID.
+    """
+    def __init__(self, config, build, jobs_dir, workers=4, queue=None):
+        """
+        config is the ConfigParser the configuration of the jobs overrides.
+        Every job gets a directory in jobs_dir for its build log and files.
+        """
+        self._config = config
+        self._build = build
+        self._jobs_dir = os.path.expanduser(jobs_dir)
+        self._workers = workers
+        self._queue = queue or JobQueue()
+        self._jobs = collections.OrderedDict()
+        self._sessions = SessionFactory()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._work,
+                                      name=f'docker-build-ami-worker-{i}')
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Cancels the queued jobs and waits for the running ones """
+        for job in self._queue.close():
+            self._finish(job, CANCELLED)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, context, priority=0, config=None, direct_copy=False):
+        """
+        Queues a build of the Dockerfile in the context directory and
+        returns its Job. config overrides the configuration of the service.
+        Raises ValueError if the job cannot run.
+        """
+        if not isabs(context) or not isfile(join(context, 'Dockerfile')):
+            raise ValueError(
+                f'There needs to be a Dockerfile in the context: {context}')
+        overrides = {}
+        for key, value in (config or {}).items():
+            if not self._config.has_option('main', key):
+                raise ValueError(f'Unknown configuration key: {key}')
+            overrides[key] = value if isinstance(value, str) \
+                else json.dumps(value)
+
+        job_id = str(uuid.uuid4())
+        job_dir = join(self._jobs_dir, job_id)
+        overrides.setdefault('tmp_dir', job_dir)
+        overrides.setdefault('log_file', join(job_dir, 'build.log'))
+        aws_config = AwsConfig(self._config, 'main',
+                               argparse.Namespace(**overrides))
+        if not aws_config.aws_access_key_id or \
+                not aws_config.aws_secret_access_key:
+            raise ValueError('You need to specify AWS credentials')
+        os.makedirs(job_dir)
+
+        job = Job(job_id, context, aws_config, int(priority),
+                  bool(direct_copy))
+        with self._lock:
+            self._jobs[job_id] = job
+        self._queue.put(job)
+        logger.info(f'Queued job {job_id}: {context}')
+        return job
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """ Cancels a queued job, returning whether it was queued """
+        job = self.job(job_id)
+        if not job or not self._queue.remove(job):
+            return False
+        self._finish(job, CANCELLED)
+        return True
+
+    def _finish(self, job, state, image_id=None, error=None):
+        job.state = state
+        job.image_id = image_id
+        job.error = error
+        job.finished = _now()
+        logger.info(f'Job {job.id} {state}')
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self._run(job)
+            finally:
+                self._queue.done(job)
+
+    def _run(self, job):
+        job.state = RUNNING
+        job.started = _now()
+        logger.info(f'Running job {job.id}')
+        try:
+            image_id = self._build(job.aws_config, job.context,
+                                   job.direct_copy,
+                                   self._sessions.session(job.aws_config))
+        except SystemExit as e:
+            # Failed steps exit with their exit code
+            self._finish(job, FAILED, error=f'Exited with code {e.code}')
+        except BaseException as e:
+            logger.exception(f'Job {job.id} failed')
+            self._finish(job, FAILED, error=str(e) or type(e).__name__)
+        else:
+            self._finish(job, SUCCEEDED, image_id)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of a BuildService:
+
+    POST /jobs           queues a job
+    GET /jobs            lists the jobs
+    GET /jobs/<id>       describes a job
+    DELETE /jobs/<id>    cancels a queued job
+    """
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'jobs':
+            return None
+        return self.server.service.job(parts[1])
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/jobs':
+            self._send(200, [job.to_dict()
+                             for job in self.server.service.jobs()])
+            return
+        job = self._job()
+        if job:
+            self._send(200, job.to_dict())
+        else:
+            self._send(404, {'error': 'No such job'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self._send(404, {'error': 'No such resource'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(str(self.rfile.read(length), 'utf8'))
+            if not isinstance(body, dict) or 'context' not in body:
+                raise ValueError('The job needs a context')
+            job = self.server.service.submit(
+                body['context'], body.get('priority', 0),
+                body.get('config'), body.get('direct_copy', False))
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+        self._send(202, job.to_dict())
+
+    def do_DELETE(self):
+        job = self._job()
+        if not job:
+            self._send(404, {'error': 'No such job'})
+        elif self.server.service.cancel(job.id):
+            self._send(200, job.to_dict())
+        else:
+            self._send(409, {'error': f'Job is {job.state}'})
+
+    def address_string(self):
+        # Clients of Unix sockets have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.info(f'{self.address_string()} {format % args}')
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service, listen=('127.0.0.1', 8080), socket_path=None):
+    """
+    Returns a server of the API of service listening on the (host, port)
+    listen or, if given, on the Unix socket at socket_path
+    """
+    if socket_path:
+        server = _UnixHTTPServer(socket_path, _RequestHandler)
+    else:
+        server = _HTTPServer(listen, _RequestHandler)
+    server.service = service
+    return server
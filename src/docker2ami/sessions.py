@@ -0,0 +1,98 @@
+import boto3
+import botocore.config
+import threading
+
+from .api_calls import ApiMetrics, RateLimiter, instrument
+
+
+# Attempts of an AWS API call before it fails, throttled ones included
+API_MAX_ATTEMPTS = 10
+
+
+class SharedSession(object):
+    """
+    boto3 session for one set of credentials and region, shared by the
+    builds using them. Clients are thread safe and created once, so their
+    connection pools are reused. Resources are created once as well, on the
+    client of their service, but the objects they create, such as an
+    Instance, are not thread safe and belong to one build. The calls of
+    both are recorded in metrics.
+    """
+    def __init__(self, aws_access_key_id, aws_secret_access_key, region_name,
+                 config, limiter=None):
+        """
+        config is the botocore Config of the clients and resources, and
+        limiter the RateLimiter of their calls if any
+        """
+        self._session = boto3.session.Session(
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            region_name=region_name)
+        self._config = config
+        self._limiter = limiter
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._resources = {}
+        self.metrics = ApiMetrics()
+
+    def client(self, service_name):
+        # Creating clients and resources from a session is not thread safe
+        with self._lock:
+            return self._client(service_name)
+
+    def _client(self, service_name):
+        if service_name not in self._clients:
+            client = self._session.client(service_name, config=self._config)
+            instrument(client.meta.events, self.metrics, self._limiter)
+            self._clients[service_name] = client
+        return self._clients[service_name]
+
+    def resource(self, service_name):
+        with self._lock:
+            if service_name not in self._resources:
+                resource = self._session.resource(service_name,
+                                                  config=self._config)
+                # The resource and the objects it creates call the API
+                # through the shared client and its connection pool
+                resource.meta.client = self._client(service_name)
+                self._resources[service_name] = resource
+            return self._resources[service_name]
+
+
+class SessionFactory(object):
+    """
+    Creates and caches a SharedSession per credentials and region. The
+    sessions of an access key and region share a RateLimiter, since the API
+    throttles the calls of an account in a region together.
+    """
+    def __init__(self):
+        self._sessions = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def session(self, aws_config):
+        """
+        Returns the SharedSession of the credentials, region, connection
+        pool size, retry mode and API rate limit of aws_config
+        """
+        key = (aws_config.aws_access_key_id,
+               aws_config.aws_secret_access_key, aws_config.region,
+               int(aws_config.max_pool_connections), aws_config.retry_mode,
+               int(aws_config.api_rate_limit))
+        with self._lock:
+            if key not in self._sessions:
+                limiter = None
+                if key[5]:
+                    limiter = self._limiters.setdefault(
+                        (key[0], key[2], key[5]), RateLimiter(key[5]))
+                self._sessions[key] = SharedSession(
+                    *key[:3], botocore.config.Config(
+                        max_pool_connections=key[3],
+                        retries={'mode': key[4],
+                                 'max_attempts': API_MAX_ATTEMPTS}),
+                    limiter)
+            return self._sessions[key]
+
+
+# Sessions of the builds that are not given one
+default_factory = SessionFactory()
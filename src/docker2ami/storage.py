@@ -0,0 +1,93 @@
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Where the instance store is mounted on the builder, holding the build
+# context and the temporary files of the steps
+SCRATCH_DIR = '/mnt/docker-build-ami'
+
+# Created on the builder once its root volume is pre-warmed. /run is not
+# part of the AMI.
+PREWARM_MARKER = '/run/docker-build-ami-prewarmed'
+
+# Number of reads of the root volume that pre-warm it at the same time
+PREWARM_JOBS = 16
+
+
+def block_device_mappings(ec2, aws_config):
+    """
+    Returns the BlockDeviceMappings of a builder that gives its root volume
+    the size, type, IOPS and throughput of aws_config, those that are 0 or
+    empty being those of the AMI, or [] if they all are
+    """
+    ebs = {}
+    for key, name in (('root_volume_size', 'VolumeSize'),
+                      ('root_volume_iops', 'Iops'),
+                      ('root_volume_throughput', 'Throughput')):
+        if int(getattr(aws_config, key)):
+            ebs[name] = int(getattr(aws_config, key))
+    if aws_config.root_volume_type:
+        ebs['VolumeType'] = aws_config.root_volume_type
+    if not ebs:
+        return []
+    image = ec2.describe_images(ImageIds=[aws_config.image_id])['Images'][0]
+    ebs['DeleteOnTermination'] = True
+    return [{'DeviceName': image['RootDeviceName'], 'Ebs': ebs}]
+
+
+def scratch_mount_cmd():
+    """
+    Returns the command that mounts the first NVMe instance store of the
+    builder on SCRATCH_DIR, whose context and tmp directories stay on the
+    root volume without one
+    """
+    return '\n'.join([
+        'set -e',
+        'dev=',
+        'for path in /sys/block/nvme*n1; do',
+        '  if grep -qs "Instance Storage" $path/device/model; then',
+        '    dev=/dev/${path##*/}',
+        '    break',
+        '  fi',
+        'done',
+        f'mkdir -p {SCRATCH_DIR}',
+        'if [ -n "$dev" ]; then',
+        '  mkfs -t ext4 -q -F -E nodiscard $dev',
+        f'  mount -o noatime $dev {SCRATCH_DIR}',
+        'else',
+        '  echo "No instance store, the scratch space is on the root volume"',
+        'fi',
+        f'mkdir -p {SCRATCH_DIR}/context {SCRATCH_DIR}/tmp',
+        f'chmod 1777 {SCRATCH_DIR}/tmp',
+    ])
+
+
+def scratch_unmount_cmd():
+    """ Returns the command that undoes scratch_mount_cmd() """
+    return (f'set -e; sync; if mountpoint -q {SCRATCH_DIR}; then '
+            f'umount {SCRATCH_DIR}; fi; rm -rf {SCRATCH_DIR}')
+
+
+def prewarm_cmd(jobs=PREWARM_JOBS):
+    """
+    Returns the command that reads every block of the root volume in the
+    background, jobs parts at a time, so that the steps do not wait for
+    the blocks to be loaded from the snapshot of the AMI one by one. It
+    creates PREWARM_MARKER once done.
+    """
+    script = '; '.join([
+        'dev=$(findmnt -no SOURCE /)',
+        f'part=$(($(blockdev --getsize64 $dev) / 1048576 / {jobs} + 1))',
+        f'for i in $(seq 0 {jobs - 1}); do '
+        'dd if=$dev of=/dev/null bs=1M skip=$((i * part)) count=$part '
+        'iflag=direct status=none & done',
+        'wait',
+        f'touch {PREWARM_MARKER}',
+    ])
+    return f"setsid nohup sh -c '{script}' > /dev/null 2>&1 < /dev/null &"
+
+
+def prewarm_wait_cmd():
+    """ Returns the command that waits until prewarm_cmd() is done """
+    return f'until [ -e {PREWARM_MARKER} ]; do sleep 1; done; '
@@ -0,0 +1,200 @@
+import collections
+import os
+import re
+import threading
+import time
+
+from .build_log import BuildLog
+from .color import Color
+from .events import Events
+
+
+# Matches the escape sequences that commands print, such as colors
+ESCAPE_REGEX = re.compile(r'\x1b(\[[0-?]*[ -/]*[@-~]|[@-Z\\-_])')
+
+# Moves the cursor to the start of the line n lines up and clears below it
+_ERASE_LINES = '\033[{}F\033[J'
+
+# Characters kept of an output line, the end of it being what a terminal
+# shows of a line that progress bars rewrite
+MAX_LINE_LENGTH = 4096
+
+
+def _plain(line):
+    """ Returns the text of an output line as the terminal last showed it """
+    return ESCAPE_REGEX.sub('', line.rsplit('\r', 1)[-1]).expandtabs()
+
+
+class _RunningStep(object):
+    """ Running step, keeping the last tail_lines lines of its output """
+    def __init__(self, step, command, start, tail_lines):
+        self.step = step
+        self.command = ' '.join(command.split())
+        self.start = start
+        self._lines = collections.deque(maxlen=tail_lines)
+        self._partial = ''
+
+    def write(self, text):
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()[-MAX_LINE_LENGTH:]
+        self._lines.extend(line[-MAX_LINE_LENGTH:] for line in lines)
+
+    def tail(self, lines):
+        """ Returns the last lines lines of the output so far """
+        tail = list(self._lines) + ([self._partial] if self._partial else [])
+        return tail[-lines:] if lines else []
+
+
+class TtyRenderer(Events):
+    """
+    Events that draw the progress of a build on the terminal fp in the style
+    of buildkit. Finished steps scroll up as one line each, and a status
+    area below them shows the running steps with their elapsed time and last
+    output_lines lines of output. The status area is redrawn fps times a
+    second at most, however much the steps print. A step that fails is
+    expanded in place with its whole output, read from the BuildLog at
+    log_file if given, or else with its last tail_lines lines.
+    """
+    def __init__(self, fp, fps=10, output_lines=5, log_file=None,
+                 tail_lines=20):
+        self._fp = fp
+        self._output_lines = output_lines
+        self._log_file = log_file
+        self._tail_lines = max(output_lines, tail_lines)
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._status = 'Starting'
+        self._failed = False
+        self._running = {}
+        self._finished = []
+        self._drawn = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(1 / fps,), daemon=True,
+            name='docker-build-ami-renderer')
+        self._thread.start()
+
+    def _width(self):
+        try:
+            # Such as a pseudo terminal whose size was never set
+            return os.get_terminal_size(self._fp.fileno()).columns or 80
+        except (AttributeError, OSError, ValueError):
+            return 80
+
+    def emit(self, event, **fields):
+        handler = getattr(self, f'_on_{event}', None)
+        if handler:
+            with self._lock:
+                handler(**fields)
+
+    def _on_build_started(self, **fields):
+        self._status = 'Building'
+
+    def _on_instance_launched(self, instance, instance_type, **fields):
+        self._finished.append(f'=> Launched {instance} ({instance_type})')
+        self._status = 'Waiting for the instance'
+
+    def _on_waiting(self, until, **fields):
+        self._status = f'Waiting until {until.replace("_", " ")}'
+
+    def _on_instance_ready(self, elapsed, **fields):
+        self._finished.append(f'=> Instance ready after {elapsed:.1f}s')
+        self._status = 'Building'
+
+    def _on_reconnecting(self, attempt, **fields):
+        self._status = f'Lost the connection, reconnecting (attempt {attempt})'
+
+    def _on_step_started(self, step, command, **fields):
+        self._running[step] = _RunningStep(step, command, time.monotonic(),
+                                           self._tail_lines)
+        self._status = 'Building'
+
+    def _on_output(self, step, text, **fields):
+        if step in self._running:
+            self._running[step].write(text)
+
+    def _on_step_finished(self, step, exit_code, duration, **fields):
+        running = self._running.pop(step, None)
+        if not running:
+            return
+        line = f'=> [step {step}] {running.command}'
+        if exit_code == 0:
+            self._finished.append(f'{line} {duration:.1f}s')
+            return
+        self._finished.append(
+            f'{Color.RED}{line} failed with exit code {exit_code} after '
+            f'{duration:.1f}s{Color.CLEAR}')
+        self._finished += [f'{Color.YELLOW}{output_line}{Color.CLEAR}'
+                           for output_line in self._failed_output(running)]
+
+    def _failed_output(self, running):
+        """ Returns the lines of the output of the failed step running """
+        if self._log_file:
+            try:
+                # The executor completes the step in the log before the
+                # step_finished event
+                output = b''.join(BuildLog(self._log_file).read(running.step))
+                return str(output, 'utf8', 'replace').rstrip('\n').split(
+                    '\n') if output else []
+            except OSError:
+                pass
+        return running.tail(self._tail_lines)
+
+    def _on_image_created(self, image, **fields):
+        self._finished.append(f'=> Created image {image}')
+
+    def _on_image_reused(self, image, **fields):
+        self._finished.append(f'=> Reusing image {image}')
+
+    def _on_regression(self, name, duration, baseline, **fields):
+        self._finished.append(
+            f'{Color.YELLOW}=> {name} took {duration:.1f}s, {baseline:.1f}s '
+            f'usually{Color.CLEAR}')
+
+    def _on_teardown_started(self, **fields):
+        self._status = 'Tearing down'
+
+    def _on_build_finished(self, status, **fields):
+        self._failed = status != 'succeeded'
+        self._status = f'Failed: {fields["error"]}' if self._failed \
+            else 'Finished'
+
+    def _status_lines(self, width):
+        """ Returns the lines of the status area """
+        now = time.monotonic()
+        # The last column is left free, so that lines never wrap
+        width -= 1
+        header = f'[+] {self._status}'
+        elapsed = f' {now - self._start:.1f}s'
+        lines = [header[:width - len(elapsed)] + elapsed]
+        if self._failed:
+            lines[0] = f'{Color.RED}{lines[0]}{Color.CLEAR}'
+        for running in self._running.values():
+            elapsed = f' {now - running.start:.1f}s'
+            line = f' => [step {running.step}] {running.command}'
+            lines.append(line[:width - len(elapsed)] + elapsed)
+            lines += [f'    {Color.DARK_GREY}{_plain(output_line)[:width - 4]}'
+                      f'{Color.CLEAR}'
+                      for output_line in running.tail(self._output_lines)]
+        return lines
+
+    def _draw(self):
+        width = self._width()
+        with self._lock:
+            finished, self._finished = self._finished, []
+            lines = self._status_lines(width)
+        text = _ERASE_LINES.format(self._drawn) if self._drawn else ''
+        text += ''.join(f'{line}\n' for line in finished + lines)
+        self._drawn = len(lines)
+        self._fp.write(text)
+        self._fp.flush()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self._draw()
+
+    def close(self):
+        """ Stops redrawing after drawing the last state of the build """
+        self._stop.set()
+        self._thread.join()
+        self._draw()
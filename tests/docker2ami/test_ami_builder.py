@@ -2,10 +2,16 @@ import configparser
 import os
 import pytest
 import socket
+import subprocess
+import tarfile
+from paramiko import AuthenticationException
 from unittest.mock import call, MagicMock, patch
 
 import docker2ami.ami_builder as ami_builder
+from docker2ami import api_calls, storage
 from docker2ami.ami_builder import Color
+from docker2ami.build_log import BuildLog
+from docker2ami.indexed_archive import IndexedArchive
 
 
 class EmptyObj(object):
@@ -60,6 +66,30 @@ def config_test_fixtures(request):
         'security_group_ids': '["s12345"]',
         'host_tags': '[{"Key": "Name", "Value": "myname"}]',
         'image_tags': '[{"Key": "Name", "Value": "myimage"}]',
+        'log_file': '',
+        'log_tail_lines': '20',
+        'archive_format': 'tar.gz',
+        'cache_volume': '',
+        'cache_volume_size': '20',
+        'cache_dirs': '["/var/cache/apt/archives"]',
+        'cache_snapshots_kept': '3',
+        'max_pool_connections': '10',
+        'retry_mode': 'standard',
+        'api_rate_limit': '20',
+        'reuse_image': 'false',
+        'ssh_keepalive': '30',
+        'ssh_retries': '5',
+        'cloud_init_ready': 'false',
+        'step_timeout': '0',
+        'idle_timeout': '0',
+        'history_file': '~/.docker-build-ami/history.db',
+        'regression_threshold': '50',
+        'root_volume_size': '0',
+        'root_volume_type': '',
+        'root_volume_iops': '0',
+        'root_volume_throughput': '0',
+        'instance_store_scratch': 'false',
+        'prewarm_root_volume': 'false',
     }
     request.cls.config.add_section(request.cls.section_name)
     for key, val in request.cls.defaults.items():
@@ -80,6 +110,30 @@ def config_test_fixtures(request):
         'security_group_ids': '[s123452]',
         'host_tags': '[{"Key": "Name2", "Value": "myname2"}]',
         'image_tags': '[{"Key": "Name2", "Value": "myimage2"}]',
+        'log_file': '/tmp2/build.log',
+        'log_tail_lines': '10',
+        'archive_format': 'indexed',
+        'cache_volume': 'ubuntu-cache',
+        'cache_volume_size': '50',
+        'cache_dirs': '["/root/.cache/pip"]',
+        'cache_snapshots_kept': '1',
+        'max_pool_connections': '50',
+        'retry_mode': 'adaptive',
+        'api_rate_limit': '5',
+        'reuse_image': 'true',
+        'ssh_keepalive': '0',
+        'ssh_retries': '2',
+        'cloud_init_ready': 'true',
+        'step_timeout': '2h',
+        'idle_timeout': '10m',
+        'history_file': '/tmp2/history.db',
+        'regression_threshold': '20',
+        'root_volume_size': '100',
+        'root_volume_type': 'gp3',
+        'root_volume_iops': '6000',
+        'root_volume_throughput': '500',
+        'instance_store_scratch': 'true',
+        'prewarm_root_volume': 'true',
     }
     request.cls.overrideobj = EmptyObj()
     for key, val in request.cls.overrides.items():
@@ -127,6 +181,30 @@ def config_fixtures(request):
         'security_group_ids': '["s123452"]',
         'host_tags': '[{"Key": "Name2", "Value": "myname2"}]',
         'image_tags': '[{"Key": "Name2", "Value": "myimage2"}]',
+        'log_file': '',
+        'log_tail_lines': '2',
+        'archive_format': 'tar.gz',
+        'cache_volume': '',
+        'cache_volume_size': '20',
+        'cache_dirs': '["/var/cache/apt/archives"]',
+        'cache_snapshots_kept': '3',
+        'max_pool_connections': '10',
+        'retry_mode': 'standard',
+        'api_rate_limit': '20',
+        'reuse_image': 'false',
+        'ssh_keepalive': '30',
+        'ssh_retries': '5',
+        'cloud_init_ready': 'false',
+        'step_timeout': '0',
+        'idle_timeout': '0',
+        'history_file': '~/.docker-build-ami/history.db',
+        'regression_threshold': '50',
+        'root_volume_size': '0',
+        'root_volume_type': '',
+        'root_volume_iops': '0',
+        'root_volume_throughput': '0',
+        'instance_store_scratch': 'false',
+        'prewarm_root_volume': 'false',
     }
     overrideobj = EmptyObj()
     for key, val in overrides.items():
@@ -154,10 +232,11 @@ class TestAmiBuilder(object):
     @patch('builtins.print')
     @patch('docker2ami.ami_builder.paramiko')
     @patch('docker2ami.ami_builder._check_port')
-    @patch('docker2ami.ami_builder.boto3')
-    def test_start(self, boto3, check_port, paramiko, print, sleep):
-        ec2 = boto3.client.return_value = MagicMock()
-        ec2_resource = boto3.resource.return_value = MagicMock()
+    @patch('docker2ami.ami_builder.default_factory')
+    def test_start(self, factory, check_port, paramiko, print, sleep):
+        session = factory.session.return_value
+        ec2 = session.client.return_value = MagicMock()
+        ec2_resource = session.resource.return_value = MagicMock()
         ec2.create_key_pair.return_value = {'KeyMaterial': 'abcdefg'}
         ec2.run_instances.return_value = {
             'ReservationId': '12345',
@@ -186,10 +265,9 @@ class TestAmiBuilder(object):
         check_port.side_effect = [False, True]
         self._target.start()
 
-        assert boto3.client.called_with(
-          'ec2', region_name=self._target._config.region,
-          aws_access_key_id=self._target._config.aws_access_key_id,
-          aws_secret_access_key=self._target._config.aws_secret_access_key)
+        factory.session.assert_called_with(self._target._config)
+        session.client.assert_called_with('ec2')
+        session.resource.assert_called_with('ec2')
 
         tags = [
             {"Key": "Name2", "Value": "myname2"},
@@ -229,26 +307,261 @@ class TestAmiBuilder(object):
         assert self._target._instance_obj == instance_obj
         assert self._target._ssh == paramiko.SSHClient.return_value
 
-    @patch('docker2ami.ami_builder.boto3')
-    def test_start_throws_when_cant_find_ec2(self, boto3):
-        ec2 = boto3.client.return_value = MagicMock()
+    @patch('time.sleep')
+    @patch('builtins.print')
+    @patch('docker2ami.ami_builder.paramiko')
+    @patch('docker2ami.ami_builder._check_port')
+    @patch('docker2ami.ami_builder.default_factory')
+    def test_start_waits_for_cloud_init(self, factory, check_port, paramiko,
+                                        print, sleep):
+        self._target._config.cloud_init_ready = 'true'
+        self._target.events = MagicMock()
+        ec2 = factory.session.return_value.client.return_value
+        ec2.create_key_pair.return_value = {'KeyMaterial': 'abcdefg'}
+        ec2.run_instances.return_value = {'ReservationId': '12345'}
+        ec2.describe_instances.return_value = {'Reservations': [
+            {'ReservationId': '12345',
+             'Instances': [{'InstanceId': 'i12345',
+                            'PrivateIpAddress': '10.0.0.1'}]}]}
+        ssh = paramiko.SSHClient.return_value
+        # The key is not installed yet on the first connection
+        ssh.connect.side_effect = [
+            AuthenticationException('key'), None]
+        output = MagicMock()
+        output.channel.recv_exit_status.return_value = 0
+        ssh.exec_command.return_value = (MagicMock(), output, MagicMock())
+        check_port.side_effect = [False, True, True]
+        self._target.start()
+
+        assert ec2.run_instances.call_args[1]['UserData'] == \
+            ami_builder.READY_USER_DATA
+        assert check_port.call_args_list == [call('10.0.0.1', 22)] * 3
+        assert sleep.call_args_list == [call(1), call(1)]
+        command = ssh.exec_command.call_args[0][0]
+        assert command.startswith('timeout 600 ')
+        assert ami_builder.READY_MARKER in command
+        events = [(c[0][0], c[1].get('until'))
+                  for c in self._target.events.emit.call_args_list]
+        assert events[1:] == [('waiting', 'ssh_ready'),
+                              ('waiting', 'ssh_ready'),
+                              ('waiting', 'cloud_init'),
+                              ('instance_ready', None)]
+        # The state of the builder is not polled
+        instance_obj = factory.session.return_value.resource.return_value \
+            .Instance.return_value
+        assert not instance_obj.reload.called
+
+    @patch('docker2ami.ami_builder.default_factory')
+    def test_start_throws_when_cant_find_ec2(self, factory):
+        session = factory.session.return_value
+        ec2 = session.client.return_value = MagicMock()
         ec2.create_key_pair.return_value = {'KeyMaterial': 'abcdefg'}
         with pytest.raises(RuntimeError):
             self._target.start()
 
+    @patch('time.sleep')
+    @patch('builtins.print')
+    @patch('docker2ami.ami_builder.CacheVolume')
+    @patch('docker2ami.ami_builder.paramiko')
+    @patch('docker2ami.ami_builder._check_port')
+    @patch('docker2ami.ami_builder.default_factory')
+    def test_start_mounts_cache_volume(self, factory, check_port, paramiko,
+                                       cache_volume, print, sleep):
+        session = factory.session.return_value
+        self.config.cache_volume = 'ubuntu'
+        self.config.cache_dirs = '["/root/.cache/pip"]'
+        ec2 = session.client.return_value
+        ec2.create_key_pair.return_value = {'KeyMaterial': 'abcdefg'}
+        ec2.run_instances.return_value = {'ReservationId': '12345'}
+        ec2.describe_instances.return_value = {'Reservations': [
+            {'ReservationId': '12345',
+             'Instances': [{
+                'InstanceId': 'i12345',
+                'PrivateIpAddress': '10.0.0.1',
+                'Placement': {'AvailabilityZone': 'us-west-1b'},
+             }]},
+        ]}
+        instance_obj = session.resource.return_value.Instance.return_value
+        instance_obj.state = {'Name': 'running'}
+        instance_obj.instance_id = 'i12345'
+        check_port.return_value = True
+        run_cmd = self._target.run_cmd = MagicMock()
+        try:
+            self._target.start()
+        finally:
+            self.config.cache_volume = ''
+        cache_volume.assert_called_with(
+            ec2, 'ubuntu', 20, ['/root/.cache/pip'], 3,
+            [{'Key': 'Name2', 'Value': 'myname2'}])
+        volume = cache_volume.return_value
+        volume.create.assert_called_with('us-west-1b')
+        volume.attach.assert_called_with('i12345')
+        run_cmd.assert_called_with(volume.mount_cmd.return_value)
+
+    @patch('time.sleep')
+    @patch('builtins.print')
+    @patch('docker2ami.ami_builder.paramiko')
+    @patch('docker2ami.ami_builder._check_port')
+    @patch('docker2ami.ami_builder.default_factory')
+    def test_start_sets_up_storage(self, factory, check_port, paramiko,
+                                   print, sleep):
+        session = factory.session.return_value
+        self.config.root_volume_size = '100'
+        self.config.instance_store_scratch = 'true'
+        self.config.prewarm_root_volume = 'true'
+        ec2 = session.client.return_value
+        ec2.describe_images.return_value = {
+            'Images': [{'RootDeviceName': '/dev/sda1'}]}
+        ec2.create_key_pair.return_value = {'KeyMaterial': 'abcdefg'}
+        ec2.run_instances.return_value = {'ReservationId': '12345'}
+        ec2.describe_instances.return_value = {'Reservations': [
+            {'ReservationId': '12345',
+             'Instances': [{'InstanceId': 'i12345',
+                            'PrivateIpAddress': '10.0.0.1'}]}]}
+        instance_obj = session.resource.return_value.Instance.return_value
+        instance_obj.state = {'Name': 'running'}
+        check_port.return_value = True
+        run_cmd = self._target.run_cmd = MagicMock()
+        try:
+            self._target.start()
+        finally:
+            self.config.root_volume_size = '0'
+            self.config.instance_store_scratch = 'false'
+            self.config.prewarm_root_volume = 'false'
+        assert ec2.run_instances.call_args[1]['BlockDeviceMappings'] == [
+            {'DeviceName': '/dev/sda1',
+             'Ebs': {'VolumeSize': 100, 'DeleteOnTermination': True}}]
+        assert run_cmd.call_args_list == [
+            call(storage.prewarm_cmd()),
+            call(storage.scratch_mount_cmd())]
+        assert self._target.context_dir == '/mnt/docker-build-ami/context'
+        assert self._target._env_statements == [
+            'export TMPDIR=/mnt/docker-build-ami/tmp']
+
+    @patch('builtins.print')
+    def test_steps_wait_for_prewarm(self, print):
+        ssh = self._mock_exec_command()
+        self._target._prewarming = True
+        self._target.run_cmd('true')
+        assert storage.PREWARM_MARKER not in \
+            ssh.exec_command.call_args[0][0]
+        self._target.run_cmd('make', 1)
+        assert storage.PREWARM_MARKER in ssh.exec_command.call_args[0][0]
+        self._target.run_cmd('make', 2)
+        assert storage.PREWARM_MARKER not in \
+            ssh.exec_command.call_args[0][0]
+
+    @patch('builtins.print')
+    def test_save_image_unmounts_scratch(self, print):
+        self._target._scratch = True
+        self._target.run_cmd = MagicMock()
+        self._target._remove_build_files = MagicMock()
+        self._target.save_ami = MagicMock(return_value='ami-1')
+        assert self._target.save_image() == 'ami-1'
+        self._target.run_cmd.assert_called_with(
+            storage.scratch_unmount_cmd())
+
+    @patch('builtins.print')
+    def test_save_image_saves_cache_volume(self, print):
+        volume = self._target._cache_volume = MagicMock()
+        calls = MagicMock()
+        calls.attach_mock(volume, 'volume')
+        calls.attach_mock(MagicMock(), 'run_cmd')
+        calls.attach_mock(MagicMock(), 'remove_build_files')
+        calls.attach_mock(MagicMock(return_value='ami-1'), 'save_ami')
+        self._target.run_cmd = calls.run_cmd
+        self._target._remove_build_files = calls.remove_build_files
+        self._target.save_ami = calls.save_ami
+        assert self._target.save_image() == 'ami-1'
+        assert [c for c in calls.mock_calls if c[0] != 'volume.__bool__'] == [
+            call.volume.unmount_cmd(),
+            call.run_cmd(volume.unmount_cmd.return_value),
+            call.volume.detach(),
+            call.volume.save(),
+            call.remove_build_files(),
+            call.save_ami()]
+
+    @patch('builtins.print')
+    def test_save_image_removes_build_files(self, print):
+        ssh = self._mock_exec_command()
+        self._target.save_ami = MagicMock(return_value='ami-1')
+        assert self._target.save_image() == 'ami-1'
+        ssh.exec_command.assert_called_once_with(
+            "set -ex; echo 'rm -rf /tmp/docker-build-ami-steps "
+            "/tmp/docker-build-ami.env' | sudo -i --",
+            get_pty=True)
+
+    def test_finish_deletes_cache_volume(self):
+        instance_obj = self._target._instance_obj = MagicMock()
+        volume = self._target._cache_volume = MagicMock()
+        self._target.finish()
+        assert instance_obj.terminate.called
+        assert volume.delete.called
+
     def test_finish_terminates(self):
         instance_obj = self._target._instance_obj = MagicMock()
         self._target.finish()
         assert instance_obj.terminate.called
         assert self._target._instance_obj is None
 
+    def test_finish_releases_everything(self, tmp_path):
+        self._target._key_path = str(tmp_path / 'key.pem')
+        with open(self._target._key_path, 'w') as f:
+            f.write('key')
+        ssh = self._target._ssh = MagicMock()
+        instance_obj = self._target._instance_obj = MagicMock()
+        ec2 = self._target._ec2 = MagicMock()
+        self._target._key_pair = {'KeyMaterial': 'key'}
+        self._target.finish()
+        assert ssh.close.called
+        assert instance_obj.terminate.called
+        ec2.delete_key_pair.assert_called_with(KeyName=self._target._key_name)
+        assert not os.path.exists(self._target._key_path)
+        assert self._target._key_pair is None
+
+    @patch('builtins.print')
+    def test_finish_reports_api_calls(self, print):
+        self._target.events = MagicMock()
+        self._target.finish()
+        assert not self._target.events.emit.called
+
+        instance_obj = self._target._instance_obj = MagicMock()
+
+        def terminate():
+            # Calls of the release threads count as calls of the build
+            for metrics in api_calls._tracked.metrics:
+                metrics.record('ec2.TerminateInstances', 0.2)
+        instance_obj.terminate.side_effect = terminate
+        ami_builder.track(self._target._api_metrics)
+        self._target.finish()
+        print.assert_called_with(
+            '\nAWS API: 1 calls taking 0.2s, 0 throttled, 0.0s waiting for '
+            'the rate limit')
+        operations = self._target.events.emit.call_args[1]['operations']
+        assert operations['ec2.TerminateInstances']['latency']['0.25'] == 1
+        assert not api_calls._tracked.metrics
+
+    @patch('docker2ami.ami_builder.logger')
+    def test_finish_logs_what_it_cannot_release(self, logger):
+        instance_obj = self._target._instance_obj = MagicMock()
+        instance_obj.terminate.side_effect = RuntimeError('Throttled')
+        ec2 = self._target._ec2 = MagicMock()
+        self._target._key_pair = {'KeyMaterial': 'key'}
+        self._target.finish()
+        # The key pair is deleted all the same
+        assert ec2.delete_key_pair.called
+        logger.error.assert_called_with(
+            'Unable to release the instance: Throttled')
+        assert self._target._instance_obj is None
+
     @patch('time.sleep')
     @patch('docker2ami.ami_builder.paramiko')
     @patch('docker2ami.ami_builder._check_port')
-    @patch('docker2ami.ami_builder.boto3')
-    def test_with(self, boto3, check_port, paramiko, sleep):
-        ec2 = boto3.client.return_value = MagicMock()
-        ec2_resource = boto3.resource.return_value = MagicMock()
+    @patch('docker2ami.ami_builder.default_factory')
+    def test_with(self, factory, check_port, paramiko, sleep):
+        session = factory.session.return_value
+        ec2 = session.client.return_value = MagicMock()
+        ec2_resource = session.resource.return_value = MagicMock()
         ec2.create_key_pair.return_value = {'KeyMaterial': 'abcdefg'}
         ec2.run_instances.return_value = {
             'ReservationId': '12345',
@@ -294,73 +607,425 @@ class TestAmiBuilder(object):
         assert sftp.put.called_with(
             '/tmp/docker-build-ami.tar.gz', '/tmp/docker-build-ami.tar.gz')
         assert sftp.close.called
-        assert run_cmd.called_with(
-            '',
-            'mkdir /tmp/docker-build-ami; '
+        run_cmd.assert_called_with(
+            'mkdir -p /tmp/docker-build-ami; '
             'tar -xzf /tmp/docker-build-ami.tar.gz'
             ' -C /tmp/docker-build-ami')
 
     @patch('builtins.print')
-    def test_run_cmd(self, print):
+    def test_send_archive_places_files(self, print, tmp_path):
+        os.chdir(os.path.join(os.path.dirname(__file__), 'fixtures/archive'))
+        self._target._config.tmp_dir = str(tmp_path)
         ssh = self._target._ssh = MagicMock()
-        stdin, stdout, stderr = (MagicMock(), MagicMock(), MagicMock())
-        stdout.read.return_value = b'Hello world'
-        stderr.read.return_value = b'Error: something bad happened'
-        self._target._ssh.exec_command.return_value = (stdin, stdout, stderr)
+        stdout = MagicMock()
+        ssh.exec_command.return_value = (MagicMock(), stdout, MagicMock())
+        stdout.read.return_value = b'd\n-\n'
         stdout.channel.recv_exit_status.return_value = 0
-        self._target.run_cmd(
-            'FOO=BAR; BAR=BAZ;',
-            'echo "hello world" && echo goodbye')
-        assert ssh.exec_command.called_with(
-          'FOO=BAR; BAR=BAZ; set -ex; echo \'echo "hello world" '
-          '&& echo goodbye\' | sudo -i --',
-          get_pty=True)
-        print.has_calls(
-            f'{Color.YELLOW}HelloWorld{Color.CLEAR}',
-            f'{Color.RED}Error: something bad happened{Color.CLEAR}',
-        )
+        run_cmd = self._target.run_cmd = MagicMock()
+        planner = MagicMock()
+        planner.placements = {2: ('hello.c', '/opt', False),
+                              3: ('images/docker.png', '/srv/docker.png',
+                                  False)}
+        planner.sources = {'images/apple.jpg'}
+
+        assert self._target.send_archive(planner) == {2, 3}
+        assert "/opt /srv/docker.png" in ssh.exec_command.call_args[0][0]
+        with tarfile.open(str(tmp_path / 'docker-build-ami.tar.gz')) as tar:
+            names = sorted(tar.getnames())
+        assert names == ['opt/hello.c', 'srv/docker.png',
+                         'tmp/docker-build-ami/images',
+                         'tmp/docker-build-ami/images/apple.jpg']
+        run_cmd.assert_called_with(
+            'mkdir -p /tmp/docker-build-ami; '
+            'tar -xzpf /tmp/docker-build-ami.tar.gz -C / --no-overwrite-dir')
+
+    @patch('builtins.print')
+    def test_send_archive_copies_when_probe_fails(self, print, tmp_path):
+        os.chdir(os.path.join(os.path.dirname(__file__), 'fixtures/archive'))
+        self._target._config.tmp_dir = str(tmp_path)
+        ssh = self._target._ssh = MagicMock()
+        stdout = MagicMock()
+        ssh.exec_command.return_value = (MagicMock(), stdout, MagicMock())
+        stdout.read.return_value = b''
+        stdout.channel.recv_exit_status.return_value = 1
+        run_cmd = self._target.run_cmd = MagicMock()
+        planner = MagicMock()
+        planner.placements = {2: ('hello.c', '/opt', False)}
 
+        assert self._target.send_archive(planner) == set()
+        with tarfile.open(str(tmp_path / 'docker-build-ami.tar.gz')) as tar:
+            assert 'hello.c' in tar.getnames()
+        run_cmd.assert_called_with(
+            'mkdir -p /tmp/docker-build-ami; '
+            'tar -xzf /tmp/docker-build-ami.tar.gz -C /tmp/docker-build-ami')
+
+    @patch.object(IndexedArchive, 'CHUNK_SIZE', 1)
     @patch('builtins.print')
-    def test_run_cmd2(self, print):
+    def test_send_indexed_archive(self, print, tmp_path):
+        os.chdir(os.path.join(os.path.dirname(__file__), 'fixtures/archive'))
+        self._target._config.tmp_dir = str(tmp_path)
+        self._target._config.archive_format = 'indexed'
+        ssh = self._target._ssh = MagicMock()
+        run_cmd = self._target.run_cmd = MagicMock()
+        assert self._target.send_archive() == set()
+        self._target._upload_thread.join()
+        path = str(tmp_path / 'docker-build-ami.tar.gz')
+        ssh.open_sftp.return_value.put.assert_called_with(
+            path, '/tmp/docker-build-ami.tar.gz',
+            callback=self._target._upload_progress)
+        assert not run_cmd.called
+
+        chunks = IndexedArchive(path).chunks(['images/docker.png'])
+        ((offset, length),) = chunks
+        assert self._target.fetch_context('./images/docker.png') == (
+            'mkdir -p /tmp/docker-build-ami; '
+            f'tail -c +{offset + 1} /tmp/docker-build-ami.tar.gz | '
+            f'head -c {length} | tar -xzi -C /tmp/docker-build-ami')
+        assert self._target.fetch_context('images/docker.png') == ''
+        assert '| head -c ' in self._target.fetch_context('images/*')
+        assert self._target.fetch_context('hello.c') == ''
+
+    def test_wait_for_upload(self):
+        self._target._upload_progress(100, 200)
+        assert self._target._wait_for_upload({(50, 50)}) == (
+            'until [ "$(stat -c %s /tmp/docker-build-ami.tar.gz)" -ge 100 ] '
+            '2> /dev/null; do sleep 0.1; done; ')
+        self._target._upload_done = True
+        assert self._target._wait_for_upload({(100, 100)}) == ''
+        self._target._upload_error = IOError('Connection lost')
+        with pytest.raises(RuntimeError):
+            self._target._wait_for_upload({(100, 100)})
+
+    def test_unknown_archive_format(self):
+        self.config.archive_format = 'zip'
+        with pytest.raises(ValueError):
+            ami_builder.AmiBuilder(self.config)
+        self.config.archive_format = 'tar.gz'
+
+    def test_unknown_retry_mode(self):
+        self.config.retry_mode = 'never'
+        with pytest.raises(ValueError):
+            ami_builder.AmiBuilder(self.config)
+        self.config.retry_mode = 'standard'
+
+    @patch('docker2ami.ami_builder.default_factory')
+    def test_start_uses_given_session(self, factory):
+        session = MagicMock()
+        ec2 = session.client.return_value
+        ec2.create_key_pair.return_value = {'KeyMaterial': 'abcdefg'}
+        target = ami_builder.AmiBuilder(self.config, session=session)
+        with pytest.raises(RuntimeError):
+            target.start()
+        session.client.assert_called_with('ec2')
+        assert not factory.session.called
+
+    def _mock_exec_command(self, ecode=0):
         ssh = self._target._ssh = MagicMock()
         stdin, stdout, stderr = (MagicMock(), MagicMock(), MagicMock())
-        stdout.read.return_value = b'Hello world'
+        stdout.channel.recv.side_effect = [b'Hello ', b'world', b'']
         stderr.read.return_value = b'Error: something bad happened'
-        self._target._ssh.exec_command.return_value = (stdin, stdout, stderr)
-        stdout.channel.recv_exit_status.return_value = 0
-        self._target.run_cmd(
-            'FOO=BAR; BAR=BAZ;',
-            'echo "hello world" && echo goodbye')
-        assert ssh.exec_command.called_with(
-          'FOO=BAR; BAR=BAZ; set -ex; echo \'echo "hello world" '
-          '&& echo goodbye\' | sudo -i --',
+        ssh.exec_command.return_value = (stdin, stdout, stderr)
+        stdout.channel.recv_exit_status.return_value = ecode
+        return ssh
+
+    @patch('docker2ami.build_log.stdout')
+    @patch('builtins.print')
+    def test_run_cmd(self, print, stdout):
+        steps = self._target._steps_dir
+        ssh = self._mock_exec_command()
+        self._target.run_cmd('echo "hello world" && echo goodbye')
+        ssh.exec_command.assert_called_with(
+          f'set -ex; echo \'mkdir -p {steps}; '
+          f'echo $$ > {steps}/0.1.pid; '
+          'trap \'"\'"\'exit 129\'"\'"\' HUP INT TERM; '
+          'trap \'"\'"\'test $? -ne 0 || '
+          f'touch {steps}/0.1.done\'"\'"\' EXIT\n'
+          ': > /tmp/docker-build-ami.env\n'
+          '. /tmp/docker-build-ami.env\n'
+          'echo "hello world" && echo goodbye\' | sudo -i --',
           get_pty=True)
-        print.has_calls(
-            f'{Color.YELLOW}HelloWorld{Color.CLEAR}',
-            f'{Color.RED}Error: something bad happened{Color.CLEAR}',
-        )
+        stdout.write.assert_has_calls([
+            call(f'{Color.YELLOW}Hello {Color.CLEAR}'),
+            call(f'{Color.YELLOW}world{Color.CLEAR}'),
+        ])
+        print.assert_called_with(
+            f'{Color.RED}Error: something bad happened{Color.CLEAR}')
+
+    @patch('docker2ami.build_log.stdout')
+    @patch('builtins.print')
+    def test_run_cmd_writes_build_log(self, print, stdout, tmp_path):
+        log_path = str(tmp_path / 'build.log')
+        self._target._build_log = BuildLog(log_path, 'w')
+        ssh = self._mock_exec_command()
+        stdout_file = ssh.exec_command.return_value[1]
+        stdout_file.channel.recv.side_effect = [
+            b'one\r\ntwo\r\n', b'three\r\nfour', b'']
+        self._target.run_cmd('true', 7)
+        self._target.finish()
+        assert b''.join(BuildLog(log_path).read(7)) == \
+            b'one\r\ntwo\r\nthree\r\nfour'
+        written = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        assert 'one' not in written
+        assert 'two' not in written
+        assert 'three\r\nfour' in written
+
+    @patch('builtins.print')
+    def test_run_cmd_sends_env_statements_once(self, print):
+        steps = self._target._steps_dir
+        ssh = self._mock_exec_command()
+        self._target.run_cmd('true')
+        self._target.update_env('FOO=BAR')
+        self._target.update_env('cd /foo/bar')
+        self._target.run_cmd('echo $FOO')
+        ssh.exec_command.assert_called_with(
+          f'set -ex; echo \'mkdir -p {steps}; '
+          f'echo $$ > {steps}/0.2.pid; '
+          'trap \'"\'"\'exit 129\'"\'"\' HUP INT TERM; '
+          'trap \'"\'"\'test $? -ne 0 || '
+          f'touch {steps}/0.2.done\'"\'"\' EXIT\n'
+          'cat > /tmp/docker-build-ami.env '
+          '<<\'"\'"\'DOCKER_BUILD_AMI_ENV\'"\'"\'\n'
+          'FOO=BAR\ncd /foo/bar\nDOCKER_BUILD_AMI_ENV\n'
+          '. /tmp/docker-build-ami.env\n'
+          'echo $FOO\' | sudo -i --',
+          get_pty=True)
+        self._target.run_cmd('echo $FOO')
+        ssh.exec_command.assert_called_with(
+          f'set -ex; echo \'mkdir -p {steps}; '
+          f'echo $$ > {steps}/0.3.pid; '
+          'trap \'"\'"\'exit 129\'"\'"\' HUP INT TERM; '
+          'trap \'"\'"\'test $? -ne 0 || '
+          f'touch {steps}/0.3.done\'"\'"\' EXIT\n'
+          '. /tmp/docker-build-ami.env\n'
+          'echo $FOO\' | sudo -i --',
+          get_pty=True)
+
+    @patch('docker2ami.build_log.stdout')
+    @patch('builtins.print')
+    def test_run_parallel_uses_one_channel_per_cmd(self, print, stdout):
+        ssh = self._target._ssh = MagicMock()
+
+        def exec_command(command, get_pty):
+            out = MagicMock()
+            out.channel.recv.side_effect = [
+                command.split('\n')[-1].split("'")[0].encode('utf8')
+                + b' done\n', b'']
+            out.channel.recv_exit_status.return_value = 0
+            err = MagicMock()
+            err.read.return_value = b''
+            return MagicMock(), out, err
+        ssh.exec_command.side_effect = exec_command
+        self._target.update_env('FOO=BAR')
+        self._target.run_parallel([('make a', 2), ('make b', 3)])
+
+        # The env file is brought up to date before the group starts
+        assert 'FOO=BAR' in ssh.exec_command.call_args_list[0][0][0]
+        assert ssh.exec_command.call_count == 3
+        for c in ssh.exec_command.call_args_list[1:]:
+            assert 'FOO=BAR' not in c[0][0]
+        written = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        assert f'{Color.YELLOW}[step 2] make a done{Color.CLEAR}' in written
+        assert f'{Color.YELLOW}[step 3] make b done{Color.CLEAR}' in written
+
+    def _mock_reconnect(self, check_output, ecode=0):
+        """
+        Makes the connection drop at the first command and the new one
+        report check_output as the state of the command
+        """
+        lost_ssh = self._target._ssh = MagicMock()
+        lost_ssh.exec_command.side_effect = EOFError()
+        ssh = MagicMock()
+        check_stdout, stdout, stderr = MagicMock(), MagicMock(), MagicMock()
+        check_stdout.read.return_value = check_output
+        stdout.channel.recv.side_effect = [b'Hello', b'']
+        stdout.channel.recv_exit_status.return_value = ecode
+        stderr.read.return_value = b''
+        ssh.exec_command.side_effect = [
+            (MagicMock(), check_stdout, MagicMock()),
+            (MagicMock(), stdout, stderr)]
+        self._target._connect = MagicMock(
+            side_effect=lambda: setattr(self._target, '_ssh', ssh))
+        return lost_ssh, ssh
+
+    @patch('docker2ami.build_log.stdout')
+    @patch('time.sleep')
+    @patch('builtins.print')
+    def test_run_cmd_skips_done_cmd_after_reconnect(self, print, sleep,
+                                                    stdout):
+        lost_ssh, ssh = self._mock_reconnect(b'done\n')
+        self._target.run_cmd('make', 4)
+        assert lost_ssh.close.called
+        sleep.assert_called_once_with(1)
+        assert ssh.exec_command.call_count == 1
+        check = ssh.exec_command.call_args[0][0]
+        steps = self._target._steps_dir
+        assert f'if [ -e {steps}/4.1.done ]' in check
+        assert f'kill -0 $(cat {steps}/4.1.pid)' in check
+        print.assert_called_with(
+            'Step 4 finished while the connection was lost')
+
+    @patch('docker2ami.build_log.stdout')
+    @patch('time.sleep')
+    @patch('builtins.print')
+    def test_reconnect_ignores_markers_of_source_image(self, print, sleep,
+                                                       stdout, tmp_path):
+        # The source AMI holds the markers its own build left behind
+        steps_dir = tmp_path / 'steps'
+        for build_dir in (steps_dir, steps_dir / 'source-build'):
+            build_dir.mkdir(exist_ok=True)
+            (build_dir / '4.1.done').touch()
+        self._target._steps_dir = str(steps_dir / self._target._key_name)
+        lost_ssh, ssh = self._mock_reconnect(b'')
+        _, run_results = ssh.exec_command.side_effect
+
+        def exec_command(command, **kwargs):
+            if 'kill -0' not in command:
+                return run_results
+            # Runs the check on this machine instead of the builder
+            out = MagicMock()
+            out.read.return_value = subprocess.run(
+                command.replace('| sudo -i --', '| sh'), shell=True,
+                stdout=subprocess.PIPE).stdout
+            return MagicMock(), out, MagicMock()
+        ssh.exec_command.side_effect = exec_command
+        self._target.run_cmd('make', 4)
+        # The step was never started by this build, so it runs again
+        assert ssh.exec_command.call_count == 2
+        assert ssh.exec_command.call_args[0][0] == \
+            lost_ssh.exec_command.call_args[0][0]
+        assert call('Step 4 finished while the connection was lost') \
+            not in print.call_args_list
+
+    @patch('docker2ami.build_log.stdout')
+    @patch('time.sleep')
+    @patch('builtins.print')
+    def test_run_cmd_reruns_interrupted_cmd(self, print, sleep, stdout):
+        lost_ssh, ssh = self._mock_reconnect(b'interrupted\n')
+        self._target.run_cmd('make', 4)
+        assert ssh.exec_command.call_count == 2
+        assert ssh.exec_command.call_args[0][0] == \
+            lost_ssh.exec_command.call_args[0][0]
+        print.assert_called_with(
+            f'{Color.RED}Step 4 was interrupted by the lost connection, '
+            f'running it again{Color.CLEAR}')
+        assert self._target._env_file_created
+
+    def test_cancel_stops_the_next_commands(self):
+        ssh = self._mock_exec_command()
+        self._target.cancel()
+        assert ssh.close.called
+        with pytest.raises(RuntimeError, match='The build was cancelled'):
+            self._target.run_cmd('make', 4)
+        assert not ssh.exec_command.called
+
+    @patch('docker2ami.build_log.stdout')
+    @patch('time.sleep')
+    @patch('builtins.print')
+    def test_rerun_after_reconnect_writes_env_once(self, print, sleep,
+                                                   stdout, tmp_path):
+        (tmp_path / 'build').mkdir()
+        env_file = tmp_path / 'env'
+        self._target.env_file = str(env_file)
+        self._target._steps_dir = str(tmp_path / 'steps')
+
+        def run_locally(command):
+            # Runs the script on this machine instead of the builder
+            subprocess.run(command.replace('| sudo -i --', '| sh'),
+                           shell=True, cwd=str(tmp_path), check=True)
+        ssh = self._mock_exec_command()
+        ssh.exec_command.side_effect = lambda command, **kwargs: (
+            run_locally(command) or ssh.exec_command.return_value)
+        self._target.run_cmd('true', 1)
+        self._target.update_env('cd build')
+        lost_ssh, ssh = self._mock_reconnect(b'interrupted\n')
+        check_results, run_results = ssh.exec_command.side_effect
+
+        def lose_connection(command, **kwargs):
+            # The connection drops once the script updated the env file
+            run_locally(command)
+            raise EOFError()
+        lost_ssh.exec_command.side_effect = lose_connection
+
+        def exec_command(command, **kwargs):
+            if 'kill -0' in command:
+                return check_results
+            run_locally(command)
+            return run_results
+        ssh.exec_command.side_effect = exec_command
+        self._target.run_cmd('true', 2)
+        assert ssh.exec_command.call_count == 2
+        assert env_file.read_text() == 'cd build\n'
+
+    @patch('docker2ami.build_log.stdout')
+    @patch('time.sleep')
+    @patch('builtins.print')
+    def test_closed_channel_of_inactive_transport_is_lost(self, print,
+                                                          sleep, stdout):
+        lost_ssh, ssh = self._mock_reconnect(b'missing\n')
+        stdout_file = MagicMock()
+        stdout_file.channel.recv.return_value = b''
+        stdout_file.channel.recv_exit_status.return_value = -1
+        stderr = MagicMock()
+        stderr.read.return_value = b''
+        lost_ssh.exec_command.side_effect = None
+        lost_ssh.exec_command.return_value = (MagicMock(), stdout_file,
+                                              stderr)
+        lost_ssh.get_transport.return_value.is_active.return_value = False
+        self._target.run_cmd('make', 4)
+        assert ssh.exec_command.call_count == 2
+
+    @patch('time.sleep')
+    @patch('builtins.print')
+    def test_reconnect_gives_up(self, print, sleep):
+        lost_ssh = self._target._ssh = MagicMock()
+        self._target._connect = MagicMock(side_effect=socket.error())
+        with pytest.raises(RuntimeError):
+            self._target._reconnect(lost_ssh)
+        assert sleep.call_args_list == [call(1), call(2), call(4), call(8),
+                                        call(16)]
+        # Another thread already replaced the lost connection
+        self._target._connect.reset_mock()
+        self._target._reconnect(MagicMock())
+        assert not self._target._connect.called
+
+    @patch('docker2ami.ami_builder.paramiko')
+    def test_connect_sets_keepalive(self, paramiko):
+        self._target._instance_obj = MagicMock()
+        self._target._connect()
+        ssh = paramiko.SSHClient.return_value
+        assert self._target._ssh == ssh
+        ssh.get_transport.return_value.set_keepalive.assert_called_with(30)
+        self.config.ssh_keepalive = '0'
+        ssh.reset_mock()
+        self._target._connect()
+        assert not ssh.get_transport.called
+        self.config.ssh_keepalive = '30'
+        self._target._instance_obj = None
+
+    @patch('builtins.exit')
+    @patch('builtins.print')
+    def test_run_cmd_stops_idle_cmd(self, print, exit):
+        ssh = self._mock_exec_command()
+        stdout = ssh.exec_command.return_value[1]
+        stdout.channel.recv.side_effect = socket.timeout()
+        self._target.set_timeouts(5, 0, 0.01)
+        self._target.run_cmd('apt-get install foo', 5)
+        stdout.channel.settimeout.assert_called_with(1.0)
+        assert stdout.channel.close.called
+        print.assert_called_with(f'{Color.RED}Step 5 printed nothing for '
+                                 f'0.01s, stopped it{Color.CLEAR}')
+        exit.assert_called_with(124)
 
     @patch('builtins.exit')
     @patch('builtins.print')
     def test_run_cmd_error(self, print, exit):
-        ssh = self._target._ssh = MagicMock()
-        stdin, stdout, stderr = (MagicMock(), MagicMock(), MagicMock())
-        stdout.read.return_value = b'Hello world'
-        stderr.read.return_value = b'Error: something bad happened'
-        self._target._ssh.exec_command.return_value = (stdin, stdout, stderr)
-        stdout.channel.recv_exit_status.return_value = 123
-        self._target.run_cmd(
-            'FOO=BAR; BAR=BAZ;',
-            'echo "hello world" && echo goodbye')
-        assert ssh.exec_command.called_with(
-          'FOO=BAR; BAR=BAZ; set -ex; echo \'echo "hello world" '
-          '&& echo goodbye\' | sudo -i --',
-          get_pty=True)
+        self._mock_exec_command(ecode=123)
+        self._target.run_cmd('echo "hello world" && echo goodbye')
         assert print.has_calls(
             f'{Color.YELLOW}HelloWorld{Color.CLEAR}',
             f'{Color.RED}Error: something bad happened{Color.CLEAR}',
         )
-        assert exit.called_with(123)
+        exit.assert_called_with(123)
 
     @patch('builtins.print')
     @patch('docker2ami.ami_builder.datetime')
@@ -394,3 +1059,40 @@ class TestAmiBuilder(object):
                 {'Key': 'Name', 'Value': self.config.image_name}
             ]
         )
+
+    @patch('builtins.print')
+    def test_save_ami_tags_fingerprint(self, print):
+        target = ami_builder.AmiBuilder(self.config, fingerprint='abc123')
+        instance_obj = target._instance_obj = MagicMock()
+        instance_obj.create_image.return_value.image_id = 'ami-1'
+        instance_obj.create_image.return_value.state = 'available'
+        ec2 = target._ec2 = MagicMock()
+        assert target.save_ami() == 'ami-1'
+        ec2.create_tags.assert_called_with(Resources=['ami-1'], Tags=[
+            {'Key': 'Name2', 'Value': 'myimage2'},
+            {'Key': 'Name', 'Value': 'docker-build-ami-image2'},
+            {'Key': 'docker-build-ami-fingerprint', 'Value': 'abc123'}])
+        target._instance_obj = None
+
+    @patch('builtins.print')
+    @patch('docker2ami.ami_builder.stdout')
+    @patch('time.sleep')
+    def test_save_ami_emits_events(self, sleep, stdout, print):
+        events = MagicMock()
+        target = ami_builder.AmiBuilder(self.config, events=events)
+        instance_obj = target._instance_obj = MagicMock()
+        image_obj = instance_obj.create_image.return_value
+        image_obj.image_id = 'ami-1'
+        image_obj.state = 'pending'
+
+        def reload():
+            image_obj.state = 'available'
+        image_obj.reload.side_effect = reload
+        target._ec2 = MagicMock()
+        target.save_ami()
+        name = instance_obj.create_image.call_args[1]['Name']
+        waiting, created = events.emit.call_args_list
+        assert waiting[0] == ('waiting',)
+        assert waiting[1]['until'] == 'image_available'
+        assert created == call('image_created', image='ami-1', name=name)
+        target._instance_obj = None
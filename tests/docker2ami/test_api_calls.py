@@ -0,0 +1,88 @@
+import pytest
+import threading
+
+from botocore.hooks import HierarchicalEmitter
+from unittest.mock import MagicMock, patch
+
+from docker2ami import api_calls
+
+
+def _call(events, operation='ec2.DescribeInstances', code=None,
+          exception=None):
+    events.emit(f'before-send.{operation}', request=MagicMock())
+    response = None
+    if not exception:
+        response = (MagicMock(), {'Error': {'Code': code}} if code else {})
+    events.emit(f'needs-retry.{operation}', response=response,
+                caught_exception=exception, attempts=1)
+
+
+@patch('docker2ami.api_calls.time')
+def test_rate_limiter(time):
+    time.monotonic.return_value = 100.0
+    limiter = api_calls.RateLimiter(10)
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == pytest.approx(0.1)
+    assert time.sleep.call_args[0][0] == pytest.approx(0.1)
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.rate == 2.5
+    for _ in range(3):
+        limiter.succeeded()
+    assert limiter.rate == 4.0
+    for _ in range(100):
+        limiter.throttled()
+    assert limiter.rate == api_calls.MIN_RATE
+    for _ in range(100):
+        limiter.succeeded()
+    assert limiter.rate == 10
+
+
+def test_instrument_records_calls():
+    events = HierarchicalEmitter()
+    metrics = api_calls.ApiMetrics()
+    limiter = MagicMock()
+    limiter.acquire.return_value = 0.5
+    api_calls.instrument(events, metrics, limiter)
+    _call(events)
+    _call(events, code='RequestLimitExceeded')
+    _call(events, code='InvalidAMIID.NotFound')
+    _call(events, 'ec2.RunInstances', exception=ConnectionError())
+    assert limiter.acquire.call_count == 4
+    assert limiter.succeeded.call_count == 1
+    assert limiter.throttled.call_count == 1
+    result = metrics.to_dict()
+    assert list(result) == ['ec2.DescribeInstances', 'ec2.RunInstances']
+    describe = result['ec2.DescribeInstances']
+    assert (describe['calls'], describe['errors'], describe['throttles'],
+            describe['waited']) == (3, 2, 1, 1.5)
+    assert describe['latency']['0.05'] == 3
+    assert sum(describe['latency'].values()) == 3
+    assert list(describe['latency'])[-1] == '+Inf'
+    assert result['ec2.RunInstances']['errors'] == 1
+    assert metrics.summary().startswith(
+        'AWS API: 4 calls taking 0.0s, 1 throttled, 2.0s waiting')
+
+
+def test_tracked_metrics():
+    events = HierarchicalEmitter()
+    session_metrics = api_calls.ApiMetrics()
+    api_calls.instrument(events, session_metrics)
+    build_metrics = api_calls.ApiMetrics()
+    _call(events)
+    api_calls.track(build_metrics)
+    try:
+        _call(events)
+        thread = threading.Thread(target=_call, args=(events,))
+        thread.start()
+        thread.join()
+        thread = threading.Thread(target=api_calls.tracked(_call),
+                                  args=(events,))
+        thread.start()
+        thread.join()
+    finally:
+        api_calls.untrack(build_metrics)
+    _call(events)
+    assert session_metrics.to_dict()['ec2.DescribeInstances']['calls'] == 5
+    assert build_metrics.to_dict()['ec2.DescribeInstances']['calls'] == 2
+    assert api_calls.ApiMetrics().summary() is None
@@ -0,0 +1,132 @@
+import os
+import pytest
+import signal
+import threading
+import time
+
+from docker2ami import build_graph
+
+
+KEYS = ('image_name', 'image_id', 'instance_type')
+
+
+def _write_manifest(tmp_path, manifest, dockerfiles):
+    for name, dockerfile in dockerfiles.items():
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'Dockerfile').write_text(dockerfile)
+    (tmp_path / 'manifest.ini').write_text(manifest)
+    return str(tmp_path / 'manifest.ini')
+
+
+def _targets(*pairs):
+    return [build_graph.GraphTarget(name, name, {}, upstream)
+            for name, upstream in pairs]
+
+
+def _graph(roots):
+    return [(depth, target.name)
+            for depth, target in build_graph.iter_graph(roots)]
+
+
+def test_read_manifest(tmp_path):
+    path = _write_manifest(
+        tmp_path,
+        '[DEFAULT]\ninstance_type = c5.large\n'
+        '[base]\nimage_id = ami-0\n'
+        '[runtime]\nfrom = base\ncontext = rt\nimage_name = rt-image\n'
+        '[app]\n',
+        {'base': 'FROM centos\nRUN base\n', 'rt': 'RUN runtime\n',
+         'app': '# AWS-PARALLEL\nFROM runtime\nRUN app\n'})
+    base, runtime, app = build_graph.read_manifest(path, KEYS)
+    assert (base.name, base.source_dir, base.upstream) == \
+        ('base', str(tmp_path / 'base'), None)
+    assert base.overrides == {'image_name': 'base', 'image_id': 'ami-0',
+                              'instance_type': 'c5.large'}
+    assert (runtime.source_dir, runtime.upstream) == \
+        (str(tmp_path / 'rt'), 'base')
+    assert runtime.overrides['image_name'] == 'rt-image'
+    assert 'from' not in runtime.overrides
+    assert app.upstream == 'runtime'
+
+
+@pytest.mark.parametrize('manifest, error', [
+    ('', 'The manifest has no targets'),
+    ('[a]\nfoo = 1\n', 'Unknown configuration keys of a: foo'),
+    ('[a]\nfrom = b\n', 'a starts from an unknown target: b'),
+    ('[b]\n', 'Dockerfile of b doesn\'t exist'),
+])
+def test_read_manifest_fails(tmp_path, manifest, error):
+    path = _write_manifest(tmp_path, manifest, {'a': 'RUN a\n'})
+    with pytest.raises(ValueError, match=error):
+        build_graph.read_manifest(path, KEYS)
+
+
+def test_plan_build_graph():
+    targets = _targets(('app', 'runtime'), ('base', None),
+                       ('runtime', 'base'), ('tools', 'base'),
+                       ('other', None))
+    assert _graph(build_graph.plan_build_graph(targets)) == [
+        (0, 'base'), (1, 'runtime'), (2, 'app'), (1, 'tools'), (0, 'other')]
+    assert _graph(build_graph.plan_build_graph(targets, ['app'])) == [
+        (0, 'base'), (1, 'runtime'), (2, 'app')]
+    with pytest.raises(ValueError, match='Unknown target: x'):
+        build_graph.plan_build_graph(targets, ['x'])
+
+
+def test_plan_build_graph_fails_on_cycles():
+    targets = _targets(('a', 'b'), ('b', 'c'), ('c', 'b'))
+    with pytest.raises(ValueError, match='a <- b <- c <- b'):
+        build_graph.plan_build_graph(targets)
+
+
+def test_run_build_graph():
+    roots = build_graph.plan_build_graph(_targets(
+        ('base', None), ('runtime', 'base'), ('app', 'runtime'),
+        ('tools', 'base'), ('other', None)))
+    started = []
+    lock = threading.Lock()
+
+    def build(target, image_id):
+        with lock:
+            started.append((target.name, image_id))
+        if target.name == 'runtime':
+            raise RuntimeError('failed')
+        return f'ami-{target.name}'
+
+    results = build_graph.run_build_graph(roots, build, 2)
+    assert sorted(started) == [('base', None), ('other', None),
+                               ('runtime', 'ami-base'),
+                               ('tools', 'ami-base')]
+    assert {target.name: result for target, result in results.items()
+            if not isinstance(result, Exception)} == {
+        'base': 'ami-base', 'tools': 'ami-tools', 'other': 'ami-other'}
+    runtime, app = (next(result for target, result in results.items()
+                         if target.name == name)
+                    for name in ('runtime', 'app'))
+    assert str(runtime) == 'failed'
+    assert app is runtime
+
+
+@pytest.mark.parametrize('signum', [signal.SIGINT, signal.SIGTERM])
+def test_run_build_graph_stops_builds_on_interrupt(signum):
+    roots = build_graph.plan_build_graph(_targets(
+        ('base', None), ('app', 'base'), ('other', None)))
+    started = []
+    cancelled = threading.Event()
+
+    def build(target, image_id):
+        started.append(target.name)
+        # Until the interrupt cancels it
+        cancelled.wait(10)
+        raise RuntimeError('The build was cancelled')
+
+    handler = signal.getsignal(signal.SIGTERM)
+    timer = threading.Timer(0.1, os.kill, (os.getpid(), signum))
+    timer.start()
+    start = time.monotonic()
+    with pytest.raises(KeyboardInterrupt):
+        build_graph.run_build_graph(roots, build, 1, cancelled.set)
+    timer.join()
+    assert time.monotonic() - start < 5
+    assert started == ['base']
+    assert signal.getsignal(signal.SIGTERM) == handler
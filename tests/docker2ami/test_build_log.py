@@ -0,0 +1,84 @@
+import gzip
+import pytest
+from unittest.mock import patch
+
+from docker2ami.build_log import BuildLog, StepOutput
+from docker2ami.color import Color
+
+
+@pytest.fixture(scope='function')
+def log_path(tmp_path):
+    return str(tmp_path / 'logs' / 'build.log')
+
+
+def test_build_log_reads_back_steps(log_path):
+    with BuildLog(log_path, 'w') as target:
+        target.write(1, b'hello\n')
+        target.write(2, b'goodbye\n')
+        target.write(1, b'world\n')
+    target = BuildLog(log_path)
+    assert target.steps() == [1, 2]
+    assert b''.join(target.read(1)) == b'hello\nworld\n'
+    assert b''.join(target.read(2)) == b'goodbye\n'
+    assert b''.join(target.read(3)) == b''
+
+
+def test_build_log_is_a_gzip_file(log_path):
+    with BuildLog(log_path, 'w') as target:
+        target.write(1, b'hello\n')
+        target.flush(1)
+        target.write(2, b'goodbye\n')
+    with gzip.open(log_path) as f:
+        assert f.read() == b'hello\ngoodbye\n'
+
+
+@patch.object(BuildLog, 'CHUNK_SIZE', 10)
+def test_build_log_splits_large_output_into_chunks(log_path):
+    with BuildLog(log_path, 'w') as target:
+        for ii in range(10):
+            target.write(1, f'line {ii}\n'.encode('utf8'))
+    target = BuildLog(log_path)
+    assert len(target.chunks(1)) == 5
+    assert b''.join(target.read(1)) == b''.join(
+        f'line {ii}\n'.encode('utf8') for ii in range(10))
+
+
+@patch.object(BuildLog, 'CHUNK_SIZE', 10)
+@patch('docker2ami.build_log.gzip.decompress', wraps=gzip.decompress)
+def test_build_log_tail_reads_only_last_chunks(decompress, log_path):
+    with BuildLog(log_path, 'w') as target:
+        for ii in range(10):
+            target.write(1, f'line {ii}\n'.encode('utf8'))
+    target = BuildLog(log_path)
+    assert target.tail(1, 3) == b'line 7\nline 8\nline 9\n'
+    assert decompress.call_count == 2
+    assert target.tail(1, 0) == b''
+    assert target.tail(1, 100).count(b'\n') == 10
+
+
+@patch('docker2ami.build_log.stdout')
+def test_step_output_without_log_echoes_everything(stdout):
+    target = StepOutput(1)
+    target.write(b'hello \xe2\x82')
+    target.write(b'\xac\n')
+    target.close()
+    written = ''.join(c[0][0] for c in stdout.write.call_args_list)
+    assert written == (f'{Color.YELLOW}hello {Color.CLEAR}'
+                       f'{Color.YELLOW}€\n{Color.CLEAR}'
+                       f'{Color.YELLOW}{Color.CLEAR}')
+
+
+@patch('docker2ami.build_log.stdout')
+def test_step_output_with_log_keeps_last_lines(stdout, log_path):
+    with BuildLog(log_path, 'w') as build_log:
+        target = StepOutput(4, build_log, tail_lines=2)
+        target.write(b'one\ntwo\nthr')
+        target.write(b'ee\nfour')
+        assert not stdout.write.called
+        target.close()
+        assert len(target._tail) == 2
+    written = ''.join(c[0][0] for c in stdout.write.call_args_list)
+    assert '2 more lines' in written
+    assert f'{Color.YELLOW}three\nfour{Color.CLEAR}\n' in written
+    assert b''.join(BuildLog(log_path).read(4)) == \
+        b'one\ntwo\nthree\nfour'
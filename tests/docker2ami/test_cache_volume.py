@@ -0,0 +1,141 @@
+import datetime
+from unittest.mock import call, MagicMock, patch
+
+from docker2ami.cache_volume import CACHE_TAG, CacheVolume
+
+
+def _snapshot(snapshot_id, day, size=20):
+    return {'SnapshotId': snapshot_id, 'VolumeSize': size,
+            'StartTime': datetime.datetime(2020, 1, day)}
+
+
+def _target(ec2, kept=3):
+    return CacheVolume(ec2, 'ubuntu', 20, ['/var/cache/apt/archives',
+                                           '/root/.cache/pip'], kept,
+                       [{'Key': 'team', 'Value': 'build'}])
+
+
+@patch('builtins.print')
+def test_create_from_latest_snapshot(print):
+    ec2 = MagicMock()
+    ec2.describe_snapshots.return_value = {'Snapshots': [
+        _snapshot('snap-1', 1), _snapshot('snap-3', 3, 30),
+        _snapshot('snap-2', 2)]}
+    ec2.create_volume.return_value = {'VolumeId': 'vol-1'}
+    target = _target(ec2)
+    target.create('us-west-1a')
+    assert target.volume_id == 'vol-1'
+    ec2.describe_snapshots.assert_called_with(
+        OwnerIds=['self'],
+        Filters=[{'Name': f'tag:{CACHE_TAG}', 'Values': ['ubuntu']},
+                 {'Name': 'status', 'Values': ['completed']}])
+    kwargs = ec2.create_volume.call_args[1]
+    assert kwargs['AvailabilityZone'] == 'us-west-1a'
+    assert kwargs['SnapshotId'] == 'snap-3'
+    assert kwargs['Size'] == 30
+    assert kwargs['TagSpecifications'] == [{
+        'ResourceType': 'volume',
+        'Tags': [{'Key': 'team', 'Value': 'build'},
+                 {'Key': 'Name', 'Value': 'ubuntu'},
+                 {'Key': CACHE_TAG, 'Value': 'ubuntu'}]}]
+
+
+@patch('builtins.print')
+def test_create_from_scratch(print):
+    ec2 = MagicMock()
+    ec2.describe_snapshots.return_value = {'Snapshots': []}
+    _target(ec2).create('us-west-1a')
+    kwargs = ec2.create_volume.call_args[1]
+    assert 'SnapshotId' not in kwargs
+    assert kwargs['Size'] == 20
+
+
+def test_attach_and_detach():
+    ec2 = MagicMock()
+    target = _target(ec2)
+    target.volume_id = 'vol-1'
+    target.attach('i-1')
+    ec2.attach_volume.assert_called_with(
+        Device='/dev/sdf', InstanceId='i-1', VolumeId='vol-1')
+    assert ec2.get_waiter.call_args_list == [
+        call('volume_available'), call('volume_in_use')]
+    target.detach()
+    ec2.detach_volume.assert_called_with(VolumeId='vol-1')
+    assert ec2.get_waiter.call_args == call('volume_available')
+
+
+def test_mount_and_unmount_cmds():
+    target = _target(MagicMock())
+    target.volume_id = 'vol-0123'
+    mount = target.mount_cmd()
+    assert 'nvme-Amazon_Elastic_Block_Store_vol0123 ' in mount
+    assert 'blkid $dev > /dev/null || mkfs -t ext4 -q $dev' in mount
+    assert ('mount --bind /mnt/docker-build-ami-cache/var_cache_apt_archives'
+            ' /var/cache/apt/archives') in mount
+    assert ('mount --bind /mnt/docker-build-ami-cache/root_.cache_pip'
+            ' /root/.cache/pip') in mount
+    assert target.unmount_cmd() == (
+        'set -e; sync; umount /root/.cache/pip; '
+        'umount /var/cache/apt/archives; umount /mnt/docker-build-ami-cache')
+
+
+@patch('builtins.print')
+def test_save_keeps_newest_snapshots(print):
+    ec2 = MagicMock()
+    ec2.create_snapshot.return_value = {'SnapshotId': 'snap-4'}
+    ec2.describe_snapshots.return_value = {'Snapshots': [
+        _snapshot('snap-1', 1), _snapshot('snap-3', 3),
+        _snapshot('snap-2', 2)]}
+    target = _target(ec2, kept=2)
+    target.volume_id = 'vol-1'
+    target.save()
+    assert ec2.create_snapshot.call_args[1]['VolumeId'] == 'vol-1'
+    ec2.get_waiter.assert_called_with('snapshot_completed')
+    assert ec2.get_waiter.return_value.wait.call_args[1]['SnapshotIds'] == \
+        ['snap-4']
+    assert ec2.delete_snapshot.call_args_list == [
+        call(SnapshotId='snap-2'), call(SnapshotId='snap-1')]
+
+
+@patch('builtins.print')
+@patch('docker2ami.cache_volume.logger')
+def test_save_keeps_snapshots_when_new_one_fails(logger, print):
+    ec2 = MagicMock()
+    ec2.create_snapshot.return_value = {'SnapshotId': 'snap-4'}
+    ec2.describe_snapshots.return_value = {'Snapshots': [
+        _snapshot('snap-1', 1), _snapshot('snap-3', 3),
+        _snapshot('snap-2', 2)]}
+    waiter = ec2.get_waiter.return_value
+    waiter.wait.side_effect = RuntimeError(
+        'Waiter SnapshotCompleted failed: snap-4 is in the error state')
+    target = _target(ec2, kept=1)
+    target.volume_id = 'vol-1'
+    target.save()
+    assert waiter.wait.called
+    assert not ec2.delete_snapshot.called
+    logger.warning.assert_called_with(
+        'Cache snapshot snap-4 did not complete, keeping the older '
+        'snapshots: Waiter SnapshotCompleted failed: snap-4 is in the error '
+        'state')
+
+
+def test_delete():
+    ec2 = MagicMock()
+    target = _target(ec2)
+    target.delete()
+    assert not ec2.delete_volume.called
+    target.volume_id = 'vol-1'
+    target.delete()
+    ec2.delete_volume.assert_called_with(VolumeId='vol-1')
+    assert target.volume_id is None
+
+
+@patch('docker2ami.cache_volume.logger')
+def test_delete_error_is_logged(logger):
+    ec2 = MagicMock()
+    ec2.delete_volume.side_effect = RuntimeError('VolumeInUse')
+    target = _target(ec2)
+    target.volume_id = 'vol-1'
+    target.delete()
+    assert logger.warning.called
+    assert target.volume_id is None
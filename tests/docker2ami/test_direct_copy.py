@@ -0,0 +1,122 @@
+import io
+import os
+import pytest
+import tarfile
+
+from docker2ami import direct_copy
+
+
+DOCKERFILE = '''FROM ubuntu:18.04
+ENV FOO=bar
+COPY hello.c /opt/
+# AWS-SKIP
+COPY hello.c /skipped
+COPY images/docker.png images
+WORKDIR /app
+COPY images data
+ADD hello.c $FOO/hello.c
+ADD archive.tar.gz /srv
+ADD https://example.com/tool.sh /usr/bin/tool.sh
+RUN make
+COPY images/apple.jpg /opt/apple.jpg
+'''
+
+
+@pytest.fixture(scope='function')
+def context_dir(tmp_path):
+    start_dir = os.getcwd()
+    os.chdir(os.path.join(os.path.dirname(__file__), 'fixtures/archive'))
+    yield
+    os.chdir(start_dir)
+
+
+@pytest.mark.usefixtures('context_dir')
+class TestDirectCopyPlanner(object):
+    def test_plans_copies_before_first_run(self):
+        planner = direct_copy.plan_direct_copies(io.StringIO(DOCKERFILE))
+        assert planner.placements == {
+            2: ('hello.c', '/opt', True),
+            5: ('images', '/app/data', False),
+        }
+        assert planner.sources == {'images/docker.png', 'hello.c',
+                                   'archive.tar.gz', 'images/apple.jpg'}
+
+    def test_unknown_sources(self):
+        planner = direct_copy.plan_direct_copies(io.StringIO(
+            'COPY hello.c /opt/hello.c\nCOPY *.c /src\n'))
+        assert planner.placements == {1: ('hello.c', '/opt/hello.c', False)}
+        assert planner.sources is None
+
+    def test_archives_are_sources(self):
+        planner = direct_copy.plan_direct_copies(io.StringIO(
+            'ADD images/../hello.c /opt/\nADD pkg.tar.gz /srv\n'))
+        assert planner.placements == {1: ('hello.c', '/opt', True)}
+        assert planner.sources == {'pkg.tar.gz'}
+
+    def test_relative_workdir(self):
+        planner = direct_copy.plan_direct_copies(io.StringIO(
+            'WORKDIR app\nCOPY hello.c .\nWORKDIR /srv\nWORKDIR www\n'
+            'COPY hello.c .\n'))
+        assert planner.placements == {5: ('hello.c', '/srv/www', False)}
+
+    def test_only_places_steps_in_range(self):
+        dockerfile = 'COPY hello.c /opt/\nCOPY images /srv/images\nRUN make\n'
+        planner = direct_copy.plan_direct_copies(io.StringIO(dockerfile),
+                                                 steps=range(2, 4))
+        assert planner.placements == {2: ('images', '/srv/images', False)}
+        planner = direct_copy.plan_direct_copies(io.StringIO(dockerfile),
+                                                 steps=range(3, 4))
+        assert planner.placements == {}
+
+
+@pytest.mark.usefixtures('context_dir')
+def test_resolve_targets():
+    placements = {
+        1: ('hello.c', '/opt', True),
+        2: ('images', '/srv/images', False),
+        3: ('hello.c', '/srv/images', False),
+        4: ('hello.c', '/etc/hello', False),
+        5: ('hello.c', '/usr/local', False),
+        6: ('.', '/app', False),
+        7: ('hello.c', '/srv', False),
+    }
+    kinds = {'/etc/hello': 'l', '/usr/local': 'd', '/app': 'd'}
+    assert direct_copy.resolve_targets(placements, kinds) == {
+        1: '/opt/hello.c',
+        2: '/srv/images',
+        3: '/srv/images/hello.c',
+        5: '/usr/local/hello.c',
+        6: '/app',
+        7: '/srv/hello.c',
+    }
+
+
+@pytest.mark.usefixtures('context_dir')
+def test_archive_places_files_and_leaves_them_out_of_context(tmp_path):
+    placements = {
+        1: ('hello.c', '/opt', True),
+        2: ('images', '/srv/images', False),
+    }
+    targets = direct_copy.resolve_targets(placements, {})
+    path = str(tmp_path / 'context.tar.gz')
+    with tarfile.open(path, 'w:gz') as tar:
+        for fn in ('hello.c', 'images'):
+            tar.add(fn, arcname=f'tmp/ctx/{fn}',
+                    filter=direct_copy.context_filter(
+                        placements, targets, {'images/apple.jpg'},
+                        'tmp/ctx'))
+        direct_copy.add_placed_files(tar, placements, targets)
+
+    with tarfile.open(path) as tar:
+        members = {m.name: m for m in tar.getmembers()}
+    assert sorted(members) == [
+        'opt/hello.c', 'srv/images', 'srv/images/apple.jpg',
+        'srv/images/docker.png', 'tmp/ctx/images', 'tmp/ctx/images/apple.jpg']
+    assert members['srv/images/docker.png'].uid == 0
+    assert members['opt/hello.c'].gname == 'root'
+
+
+def test_context_filter_keeps_everything_for_unknown_sources():
+    assert direct_copy.context_filter(
+        {1: ('hello.c', '/opt', True)}, {1: '/opt/hello.c'}, None,
+        'tmp/ctx') is None
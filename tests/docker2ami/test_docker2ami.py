@@ -1,18 +1,28 @@
+import argparse
+import json
 import logging
 import os
 import pytest
+import subprocess
+import sys
 
 from unittest import mock
 
-from docker2ami.ami_builder import Color
+from docker2ami.color import Color
 from docker2ami import docker2ami, parser
+from docker2ami.build_log import BuildLog
+from docker2ami.direct_copy import DirectCopyPlanner
+from docker2ami.history import History
 
 
 @pytest.fixture(scope='function')
 def docker2ami_fixtures(request):
     request.cls.ami_builder_mock = mock.MagicMock()
+    request.cls.ami_builder_mock.context_dir = '/tmp/docker-build-ami'
+    request.cls.ami_builder_mock.fetch_context.return_value = ''
+    request.cls.ami_builder_mock.check_destination.return_value = None
     request.cls.parser_state = parser.ParserState()
-    request.cls.parser_state.env = "FOO=BAR;"
+    request.cls.parser_state.step = 3
     request.cls.target = docker2ami.Docker2AmiParserDelegate(
         request.cls.ami_builder_mock, request.cls.parser_state)
 
@@ -21,38 +31,146 @@ def docker2ami_fixtures(request):
 class TestDocker2Ami(object):
     def test_run_run_invokes_run_cmd(self):
         self.target.run_run('echo hello; echo goodbye')
-        assert self.ami_builder_mock.run_cmd.called_with(
-            self.parser_state.env,
-            'echo hello; echo goodbye')
+        self.ami_builder_mock.run_cmd.assert_called_with(
+            'echo hello; echo goodbye', self.parser_state.step)
 
     def test_run_copy_would_copy(self):
         self.target.run_copy('foo/src', '/dst/place')
-        assert self.ami_builder_mock.run_cmd.called_with(
-            self.parser_state.env,
-            f'cp -rf /tmp/docker-build-ami/foo/src /dst/place')
+        self.ami_builder_mock.run_cmd.assert_called_with(
+            'cp -rf /tmp/docker-build-ami/foo/src /dst/place',
+            self.parser_state.step)
+
+    def test_placed_steps_are_not_copied(self):
+        target = docker2ami.Docker2AmiParserDelegate(
+            self.ami_builder_mock, self.parser_state, {3})
+        target.run_copy('foo/src', '/dst/place')
+        target.run_add('docker/foo.json', '/dst/place')
+        target.run_add('http://example.com/foo.json', '/dst/place')
+        self.ami_builder_mock.run_cmd.assert_called_once_with(
+            'curl http://example.com/foo.json -o /dst/place', 3)
+
+    def test_steps_out_of_range_are_left_out(self):
+        target = docker2ami.Docker2AmiParserDelegate(
+            self.ami_builder_mock, self.parser_state, steps=range(4, 6))
+        target.run_run('make')
+        target.run_copy('foo/src', '/dst/place')
+        target.run_add('http://example.com/foo.json', '/dst/place')
+        target.run_env('FOO', 'BAR')
+        target.run_workdir('/opt')
+        assert not self.ami_builder_mock.run_cmd.called
+        self.ami_builder_mock.update_env.assert_has_calls(
+            [mock.call('FOO=BAR'), mock.call('cd /opt')])
+        self.parser_state.step = 4
+        target.run_run('make')
+        self.ami_builder_mock.run_cmd.assert_called_once_with('make', 4)
+
+    def test_run_copy_fetches_context(self):
+        self.ami_builder_mock.fetch_context.return_value = 'fetch foo/src'
+        self.target.run_copy('foo/src', '/dst/place')
+        self.ami_builder_mock.fetch_context.assert_called_with('foo/src')
+        self.ami_builder_mock.run_cmd.assert_called_with(
+            'fetch foo/src && cp -rf /tmp/docker-build-ami/foo/src /dst/place',
+            self.parser_state.step)
+
+    def test_parallel_group_fetches_context_first(self):
+        self.ami_builder_mock.fetch_context.side_effect = \
+            lambda src: f'fetch {src}'
+        self.target.run_parallel_start()
+        self.target.run_copy('a', '/a')
+        self.target.run_add('b', '/b')
+        self.target.run_parallel_end()
+        self.ami_builder_mock.run_cmd.assert_called_once_with(
+            'fetch a && fetch b', 3)
+        self.ami_builder_mock.run_parallel.assert_called_once_with([
+            ('cp -rf /tmp/docker-build-ami/a /a', 3),
+            ('cp -rf /tmp/docker-build-ami/b /b', 3)])
+
+    @mock.patch('docker2ami.docker2ami.logging')
+    @mock.patch('builtins.exit', side_effect=SystemExit(1))
+    def test_steps_to_unbuildable_destinations_fail(self, exit, logging):
+        self.ami_builder_mock.check_destination.side_effect = \
+            lambda path: 'outside' if path.startswith('/etc') else None
+        self.target.run_copy('foo/src', 'dst/place')
+        self.target.run_workdir('/opt/app')
+        for step in (lambda: self.target.run_copy('foo/src', '/etc/foo'),
+                     lambda: self.target.run_add('foo.tgz', '/etc/foo'),
+                     lambda: self.target.run_workdir('/etc')):
+            with pytest.raises(SystemExit):
+                step()
+        logging.critical.assert_called_with('Step 3: outside')
+        assert self.ami_builder_mock.run_cmd.call_count == 1
+        self.ami_builder_mock.update_env.assert_called_once_with(
+            'cd /opt/app')
 
     def test_run_add_with_file_path_src(self):
         self.target.run_add('docker/foo.json', '/dst/place')
-        assert self.ami_builder_mock.run_cmd.called_with(
-            self.parser_state.env,
-            f'cp -rf /tmp/docker-build-ami/docker/foo.json /dst/place')
+        self.ami_builder_mock.run_cmd.assert_called_with(
+            'cp -rf /tmp/docker-build-ami/docker/foo.json /dst/place',
+            self.parser_state.step)
 
     def test_run_add_with_tarball_file_path_src(self):
         for ext in ('tar', 'tar.gz', 'tgz', 'tar.bz', 'tar.xz'):
             self.target.run_add(f'docker/foo.{ext}', '/dst/place')
-            assert self.ami_builder_mock.run_cmd.called_with(
-                self.parser_state.env,
+            self.ami_builder_mock.run_cmd.assert_called_with(
                 f'tar -xpvf /tmp/docker-build-ami/docker/foo.{ext} '
-                '-C /dst/place')
+                '-C /dst/place', self.parser_state.step)
 
     def test_run_add_with_url_src(self):
         for url in (
           'http://www.ginkgobioworks.com/wp-content/uploads/2019/10/foo.png',
           'https://www.ginkgobioworks.com/wp-content/uploads/2019/10/foo.tgz'):
             self.target.run_add(f'{url}', '/dst/place')
-            assert self.ami_builder_mock.run_cmd.called_with(
-                self.parser_state.env,
-                f'curl {url} -o /dst/place')
+            self.ami_builder_mock.run_cmd.assert_called_with(
+                f'curl {url} -o /dst/place', self.parser_state.step)
+
+    def test_run_timeout_limits_next_step(self):
+        self.target.run_timeout(1800, None)
+        self.ami_builder_mock.set_timeouts.assert_called_with(4, 1800, None)
+
+    def test_run_env_updates_env(self):
+        self.target.run_env('FOO', '"b A r"')
+        self.ami_builder_mock.update_env.assert_called_with('FOO="b A r"')
+        assert not self.ami_builder_mock.run_cmd.called
+
+    def test_run_workdir_updates_env(self):
+        self.target.run_workdir('/foo/bar')
+        self.ami_builder_mock.update_env.assert_called_with('cd /foo/bar')
+        assert not self.ami_builder_mock.run_cmd.called
+
+    def test_parallel_group_runs_together(self):
+        self.target.run_parallel_start()
+        self.target.run_run('make a')
+        self.parser_state.step = 4
+        self.target.run_copy('src', '/dst')
+        assert not self.ami_builder_mock.run_cmd.called
+        assert not self.ami_builder_mock.run_parallel.called
+        self.target.run_parallel_end()
+        self.ami_builder_mock.run_parallel.assert_called_once_with([
+            ('make a', 3),
+            ('cp -rf /tmp/docker-build-ami/src /dst', 4)])
+        self.target.run_run('make c')
+        self.ami_builder_mock.run_cmd.assert_called_once_with('make c', 4)
+
+    def test_parallel_group_of_one_runs_cmd(self):
+        self.target.run_parallel_start()
+        self.target.run_run('make a')
+        self.target.run_parallel_end()
+        self.ami_builder_mock.run_cmd.assert_called_once_with('make a', 3)
+        assert not self.ami_builder_mock.run_parallel.called
+
+    def test_env_splits_parallel_group(self):
+        self.target.run_parallel_start()
+        self.target.run_run('make a')
+        self.target.run_run('make b')
+        self.target.run_env('FOO', 'BAR')
+        self.ami_builder_mock.run_parallel.assert_called_once_with(
+            [('make a', 3), ('make b', 3)])
+        self.ami_builder_mock.update_env.assert_called_once_with('FOO=BAR')
+        self.target.run_run('make c')
+        self.target.run_run('make d')
+        self.target.run_parallel_end()
+        self.ami_builder_mock.run_parallel.assert_called_with(
+            [('make c', 3), ('make d', 3)])
 
     @mock.patch('builtins.print')
     def test_run_unknown_prints_message(self, print_mock):
@@ -108,6 +226,18 @@ def test_accepts_image_user(argparser_fixture):
     assert_args_work(argparser_fixture, '-u', '--image-user', '12345678')
 
 
+def test_accepts_log_file(argparser_fixture):
+    assert_args_work(argparser_fixture, '-f', '--log-file', '/tmp/build.log')
+
+
+def test_accepts_local(argparser_fixture):
+    assert_args_work(argparser_fixture, '-l', '--local', '/tmp/root')
+    args = argparser_fixture.parse_args([])
+    assert args.chroot is False
+    args = argparser_fixture.parse_args(['--chroot'])
+    assert args.chroot is True
+
+
 @pytest.fixture(scope='function')
 def empty_config_fixture_path(request):
     fixture_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
@@ -141,6 +271,33 @@ def test_reads_empty_config_files(config_fixture, empty_config_fixture_path):
     assert conf.get('main', 'aws_access_key_id') == ''
     assert conf.get('main', 'aws_secret_access_key') == ''
     assert conf.get('main', 'tmp_dir') == '/tmp'
+    assert conf.get('main', 'log_file') == ''
+    assert conf.get('main', 'log_tail_lines') == '20'
+    assert conf.get('main', 'direct_copy') == 'false'
+    assert conf.get('main', 'archive_format') == 'tar.gz'
+    assert conf.get('main', 'cache_volume') == ''
+    assert conf.get('main', 'cache_volume_size') == '20'
+    assert json.loads(conf.get('main', 'cache_dirs')) == [
+        '/var/cache/apt/archives', '/var/cache/yum', '/root/.cache/pip']
+    assert conf.get('main', 'cache_snapshots_kept') == '3'
+    assert conf.get('main', 'max_pool_connections') == '10'
+    assert conf.get('main', 'retry_mode') == 'standard'
+    assert conf.get('main', 'api_rate_limit') == '20'
+    assert conf.get('main', 'reuse_image') == 'false'
+    assert conf.get('main', 'ssh_keepalive') == '30'
+    assert conf.get('main', 'ssh_retries') == '5'
+    assert conf.get('main', 'cloud_init_ready') == 'false'
+    assert conf.get('main', 'step_timeout') == '0'
+    assert conf.get('main', 'idle_timeout') == '0'
+    assert conf.get('main', 'history_file') == \
+        '~/.docker-build-ami/history.db'
+    assert conf.get('main', 'regression_threshold') == '50'
+    assert conf.get('main', 'root_volume_size') == '0'
+    assert conf.get('main', 'root_volume_type') == ''
+    assert conf.get('main', 'root_volume_iops') == '0'
+    assert conf.get('main', 'root_volume_throughput') == '0'
+    assert conf.get('main', 'instance_store_scratch') == 'false'
+    assert conf.get('main', 'prewarm_root_volume') == 'false'
 
 
 def test_reads_example_config_files(config_fixture,
@@ -260,7 +417,8 @@ class TestMain(object):
     @mock.patch('docker2ami.docker2ami.SimpleStateParserDelegate')
     @mock.patch('docker2ami.docker2ami.Docker2AmiParserDelegate')
     @mock.patch('docker2ami.docker2ami.ParserState')
-    @mock.patch('docker2ami.docker2ami.AmiBuilder')
+    @mock.patch('docker2ami.docker2ami.compute_fingerprint')
+    @mock.patch('docker2ami.ami_builder.AmiBuilder')
     @mock.patch('builtins.open')
     @mock.patch('docker2ami.docker2ami.AwsConfig')
     @mock.patch('docker2ami.docker2ami.create_config_parser')
@@ -269,12 +427,22 @@ class TestMain(object):
     @mock.patch('docker2ami.docker2ami.create_arg_parser')
     def test_main_with_args(self, create_arg_parser, setup_logger,
                             get_config_path, create_config_parser, aws_config,
-                            open_mock, ami_builder, parser_state,
-                            docker2ami_parser_delegate,
+                            open_mock, ami_builder, compute_fingerprint,
+                            parser_state, docker2ami_parser_delegate,
                             simple_state_parser_delegate,
                             parse_dockerfile_with_delegate):
         get_config_path.return_value = 'config_file.conf'
+        args = create_arg_parser.return_value.parse_args.return_value
+        args.local = None
+        args.direct_copy = False
+        create_config_parser.return_value.getboolean.return_value = False
+        aws_config.return_value.reuse_image = 'false'
+        aws_config.return_value.history_file = ''
         docker2ami.main_with_args(['-c', 'docker-build-ami.conf'])
+        ami_builder.assert_called_with(
+            aws_config.return_value, '.', None,
+            compute_fingerprint.return_value, None)
+        ami_builder.return_value.send_archive.assert_called_with(None)
         assert create_arg_parser.called_with(['-c', 'docker-build-ami.conf'])
         assert setup_logger.called_with(False)
         assert get_config_path.called_with('docker-build-ami.conf')
@@ -290,18 +458,496 @@ class TestMain(object):
             ami_builder.return_value, parser_state.return_value)
         assert simple_state_parser_delegate(ami_builder.return_value,
                                             parser_state.return_value)
-        assert ami_builder.return_value.__enter__.return_value \
-            .send_archive.called
+        assert ami_builder.return_value.__enter__.called
         assert parse_dockerfile_with_delegate.called_with(
             open_mock.return_value.__enter__.return_value,
             docker2ami_parser_delegate.return_value)
-        assert ami_builder.return_value.__enter__.return_value.save_ami.called
-        assert ami_builder.return_value.__exit__
+        assert ami_builder.return_value.send_archive.called
+        assert ami_builder.return_value.save_image.called
+        assert ami_builder.return_value.__exit__.called
         assert open_mock.return_value.__exit__
 
+    @mock.patch('docker2ami.docker2ami.parse_dockerfile_with_delegate')
+    @mock.patch('docker2ami.docker2ami.LocalExecutor')
+    @mock.patch('docker2ami.ami_builder.AmiBuilder')
+    @mock.patch('docker2ami.docker2ami.setup_logger')
+    @mock.patch('docker2ami.docker2ami.get_config_path')
+    def test_main_with_args_local(self, get_config_path, setup_logger,
+                                  ami_builder, local_executor,
+                                  parse_dockerfile_with_delegate):
+        get_config_path.return_value = None
+        local_executor.return_value.source_dir = '.'
+        docker2ami.main_with_args(['--local', '/tmp/root', '--chroot'])
+        assert not ami_builder.called
+        args = local_executor.call_args[0]
+        assert args[1:] == ('/tmp/root', True)
+        assert local_executor.return_value.__enter__.called
+        assert local_executor.return_value.send_archive.called
+        assert parse_dockerfile_with_delegate.called
+        assert local_executor.return_value.save_image.called
+        assert local_executor.return_value.__exit__.called
+
+    @mock.patch('docker2ami.docker2ami.parse_dockerfile_with_delegate')
+    @mock.patch('docker2ami.docker2ami.Docker2AmiParserDelegate')
+    @mock.patch('docker2ami.docker2ami.LocalExecutor')
+    @mock.patch('docker2ami.docker2ami.setup_logger')
+    @mock.patch('docker2ami.docker2ami.get_config_path')
+    def test_main_with_args_direct_copy(self, get_config_path, setup_logger,
+                                        local_executor,
+                                        docker2ami_parser_delegate,
+                                        parse_dockerfile_with_delegate):
+        get_config_path.return_value = None
+        positions = []
+        parse_dockerfile_with_delegate.side_effect = \
+            lambda fp, delegate: positions.append(fp.tell())
+        executor = local_executor.return_value
+        executor.source_dir = '.'
+        docker2ami.main_with_args(['--local', '/tmp/root', '--direct-copy'])
+        planner = executor.send_archive.call_args[0][0]
+        assert isinstance(planner, DirectCopyPlanner)
+        assert docker2ami_parser_delegate.call_args[0][2] == \
+            executor.send_archive.return_value
+        # The Dockerfile is parsed again from the start
+        assert positions == [0]
+
+    @mock.patch('docker2ami.docker2ami.log_with_args')
+    def test_main_with_args_dispatches_commands(self, log_with_args):
+        with mock.patch.dict(docker2ami.COMMANDS, log=log_with_args):
+            docker2ami.main_with_args(['log', '-n', '5', '3'])
+        log_with_args.assert_called_with(['-n', '5', '3'])
+
     @mock.patch('docker2ami.docker2ami.main_with_args')
     @mock.patch('docker2ami.docker2ami.sys')
     def test_main(self, sys, main_with_args):
         sys.argv = ['test_main', '-c', 'docker-build-ami.conf']
         docker2ami.main()
         assert main_with_args.called_with(['-c', 'docker-build-ami.conf'])
+
+
+@pytest.fixture(scope='function')
+def build_log_path(tmp_path):
+    path = str(tmp_path / 'build.log')
+    with BuildLog(path, 'w') as build_log:
+        build_log.write(0, b'prepare\n')
+        build_log.write(2, b'one\ntwo\nthree\n')
+    return path
+
+
+@mock.patch('docker2ami.docker2ami.setup_logger')
+def test_log_prints_step(setup_logger, build_log_path, capsysbinary):
+    docker2ami.main_with_args(['log', '-f', build_log_path, '2'])
+    assert capsysbinary.readouterr().out == b'one\ntwo\nthree\n'
+
+
+@mock.patch('docker2ami.docker2ami.setup_logger')
+def test_log_tails_step(setup_logger, build_log_path, capsysbinary):
+    docker2ami.main_with_args(['log', '-f', build_log_path, '-n', '2', '2'])
+    assert capsysbinary.readouterr().out == b'two\nthree\n'
+
+
+@mock.patch('docker2ami.docker2ami.setup_logger')
+def test_log_lists_steps(setup_logger, build_log_path, capsysbinary):
+    docker2ami.main_with_args(['log', '-f', build_log_path])
+    assert capsysbinary.readouterr().out == b'0\n2\n'
+
+
+@mock.patch('docker2ami.docker2ami.get_config_path')
+@mock.patch('docker2ami.docker2ami.setup_logger')
+def test_log_requires_log_file(setup_logger, get_config_path):
+    get_config_path.return_value = None
+    with pytest.raises(SystemExit):
+        docker2ami.main_with_args(['log', '2'])
+
+
+@mock.patch('docker2ami.docker2ami.setup_logger')
+def test_plan_prints_steps(setup_logger, tmp_path, capsys):
+    dockerfile = tmp_path / 'Dockerfile'
+    dockerfile.write_text(
+        'FROM ubuntu:18.04\n'
+        'COPY hello.c /opt/\n'
+        '# AWS-PARALLEL\n'
+        'RUN make a\n'
+        'RUN make b\n'
+        '# AWS-PARALLEL-END\n'
+        'COPY hello.c /srv/hello.c\n')
+    (tmp_path / 'hello.c').write_text('int main() {}\n')
+    docker2ami.main_with_args(['plan', '--direct-copy', str(dockerfile)])
+    assert capsys.readouterr().out.splitlines() == [
+        f'{Color.YELLOW}Unknown Command: FROM ubuntu:18.04{Color.CLEAR}',
+        'Step 1: COPY hello.c /opt/',
+        '  Placed at /opt/ with the build context',
+        'AWS-PARALLEL group 1:',
+        'Step 2: RUN make a',
+        'Step 3: RUN make b',
+        'End of AWS-PARALLEL group 1',
+        'Step 4: COPY hello.c /srv/hello.c',
+        '4 steps']
+
+
+@mock.patch('docker2ami.docker2ami.setup_logger')
+@mock.patch('docker2ami.docker2ami.get_config_path')
+def test_plan_prints_estimate(get_config_path, setup_logger, tmp_path,
+                              capsys):
+    get_config_path.return_value = None
+    dockerfile = tmp_path / 'Dockerfile'
+    dockerfile.write_text('RUN make\nRUN make test\n')
+    history_file = str(tmp_path / 'history.db')
+    History(history_file).add_build(
+        {'id': 'b1', 'image_name': 'app', 'config': '{}', 'started': 1,
+         'status': 'succeeded'},
+        [{'step': 0, 'duration': 4.0, 'exit_code': 0},
+         {'step': 1, 'instruction': 'RUN make', 'duration': 75.0,
+          'exit_code': 0}],
+        {'launch': 30.0, 'save': 120.0, 'teardown': 1.0})
+    docker2ami.main_with_args(['plan', '--estimate', '-f', history_file,
+                               '-n', 'app', str(dockerfile)])
+    assert capsys.readouterr().out.splitlines()[3:] == [
+        'Estimate for app:',
+        '  launch       30.0s  (1 run of app)',
+        '  steps        2m34s  (sum of the steps)',
+        '    step 0      4.0s  Prepare the builder (1 run of app)',
+        '    step 1     1m15s  RUN make (same instruction, 1 run)',
+        "    step 2     1m15s  RUN make test (similar to 'RUN make', 1 run)",
+        '  save         2m00s  (1 run of app)',
+        '  teardown      1.0s  (1 run of app)',
+        '  total        5m05s']
+    with pytest.raises(SystemExit):
+        docker2ami.main_with_args(['plan', '--estimate', '-f',
+                                   str(tmp_path / 'missing.db'),
+                                   str(dockerfile)])
+
+
+@mock.patch('docker2ami.docker2ami.setup_logger')
+@mock.patch('docker2ami.docker2ami.get_config_path')
+@mock.patch('docker2ami.docker2ami.build_ami')
+def test_multi(build_ami, get_config_path, setup_logger, tmp_path, capsys,
+               monkeypatch):
+    get_config_path.return_value = None
+    monkeypatch.chdir(tmp_path)
+    for name, dockerfile in (('a', 'RUN base\nRUN a\n'),
+                             ('b', 'RUN base\nRUN b\n'),
+                             ('c', 'RUN c\n')):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'Dockerfile').write_text(dockerfile)
+    docker2ami.main_with_args(['multi', '--dry-run', '-i', 'ami-0', 'a',
+                               'bee=b', 'c'])
+    shared = 'docker-build-ami-shared-'
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == 'Builds:'
+    assert lines[1].startswith(f'  step 1 of a -> {shared}')
+    assert lines[2:] == [
+        '    step 2 of a -> a',
+        '    step 2 of b -> bee',
+        '  step 1 of c -> c',
+        'Sharing runs 4 instead of 5 steps with 1 intermediate AMI']
+    assert not build_ami.called
+
+    build_ami.side_effect = lambda aws_config, *args, **kwargs: \
+        f'ami-{aws_config.image_name}'
+    with pytest.raises(SystemExit):
+        docker2ami.main_with_args(['multi', '-i', 'ami-0', 'a', 'bee=b',
+                                   'c'])
+    config = docker2ami.create_config_parser()
+    config.set('main', 'aws_access_key_id', 'key')
+    config.set('main', 'aws_secret_access_key', 'secret')
+    config.set('main', 'tmp_dir', str(tmp_path))
+    with mock.patch('docker2ami.docker2ami.create_config_parser',
+                    return_value=config):
+        docker2ami.main_with_args(['multi', '-i', 'ami-0', 'a', 'bee=b',
+                                   'c'])
+    configs = {call[0][0].image_name: call[0][0]
+               for call in build_ami.call_args_list}
+    intermediate = next(name for name in configs if name.startswith(shared))
+    assert configs[intermediate].image_id == 'ami-0'
+    assert configs['a'].image_id == f'ami-{intermediate}'
+    assert configs['bee'].image_id == f'ami-{intermediate}'
+    assert configs['c'].image_id == 'ami-0'
+    assert len({config.tmp_dir for config in configs.values()}) == 4
+    assert capsys.readouterr().out.splitlines()[-3:] == [
+        'a: ami-a', 'bee: ami-bee', 'c: ami-c']
+
+
+@mock.patch('docker2ami.docker2ami.setup_logger')
+@mock.patch('docker2ami.docker2ami.get_config_path')
+@mock.patch('docker2ami.docker2ami.build_ami')
+def test_graph(build_ami, get_config_path, setup_logger, tmp_path, capsys):
+    get_config_path.return_value = None
+    for name, dockerfile in (('base', 'RUN base\n'),
+                             ('app', 'FROM runtime\nRUN app\n'),
+                             ('runtime', 'RUN runtime\n'),
+                             ('tools', 'RUN tools\n')):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'Dockerfile').write_text(dockerfile)
+    manifest = tmp_path / 'manifest.ini'
+    manifest.write_text('[base]\nimage_id = ami-0\n'
+                        '[runtime]\nfrom = base\n'
+                        '[app]\ninstance_type = c5.large\n'
+                        '[tools]\nfrom = base\n')
+    docker2ami.main_with_args(['graph', '--dry-run', str(manifest), 'app'])
+    assert capsys.readouterr().out.splitlines() == [
+        'Builds:',
+        f'  base ({tmp_path / "base"})',
+        f'    runtime ({tmp_path / "runtime"})',
+        f'      app ({tmp_path / "app"})']
+
+    def build(aws_config, source_dir, direct_copy):
+        if aws_config.image_name == 'runtime':
+            raise SystemExit(2)
+        return f'ami-{aws_config.image_name}'
+
+    build_ami.side_effect = build
+    config = docker2ami.create_config_parser()
+    config.set('main', 'aws_access_key_id', 'key')
+    config.set('main', 'aws_secret_access_key', 'secret')
+    config.set('main', 'tmp_dir', str(tmp_path))
+    with mock.patch('docker2ami.docker2ami.create_config_parser',
+                    return_value=config), pytest.raises(SystemExit):
+        docker2ami.main_with_args(['graph', '--skip-preflight',
+                                   str(manifest)])
+    configs = {call[0][0].image_name: call[0][0]
+               for call in build_ami.call_args_list}
+    assert sorted(configs) == ['base', 'runtime', 'tools']
+    assert configs['runtime'].image_id == 'ami-base'
+    assert configs['tools'].image_id == 'ami-base'
+    assert configs['tools'].instance_type == 'm3.medium'
+    assert configs['tools'].log_file == str(
+        tmp_path / 'docker-build-ami-tools' / 'build.log')
+    assert capsys.readouterr().out.splitlines()[-4:] == [
+        'base: ami-base', 'runtime: failed, exit code 2',
+        'app: failed, exit code 2', 'tools: ami-tools']
+
+
+@mock.patch('docker2ami.docker2ami.setup_logger')
+def test_plan_requires_dockerfile(setup_logger, tmp_path):
+    with pytest.raises(SystemExit):
+        docker2ami.main_with_args(['plan', str(tmp_path / 'Dockerfile')])
+
+
+@mock.patch('docker2ami.docker2ami.LocalExecutor')
+@mock.patch('docker2ami.docker2ami.setup_logger')
+@mock.patch('docker2ami.docker2ami.get_config_path')
+@mock.patch('docker2ami.docker2ami.logging')
+def test_main_with_args_preflight_fails(logging, get_config_path,
+                                        setup_logger, local_executor,
+                                        tmp_path, monkeypatch):
+    get_config_path.return_value = None
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Dockerfile').write_text('COPY a /a\nCOPY b /b\n')
+    with pytest.raises(SystemExit):
+        docker2ami.main_with_args(['--local', '/tmp/root'])
+    assert logging.critical.call_args_list == [
+        mock.call('COPY/ADD source is missing from the build context: a'),
+        mock.call('COPY/ADD source is missing from the build context: b')]
+    assert not local_executor.called
+    local_executor.return_value.source_dir = '.'
+    local_executor.return_value.check_destination.return_value = None
+    docker2ami.main_with_args(['--local', '/tmp/root', '--skip-preflight'])
+    assert local_executor.called
+
+
+@mock.patch('builtins.print')
+def test_build_image_places_only_its_steps(print, tmp_path):
+    # Step 2 of the shared build changes the file step 1 copied, so the
+    # build of step 3 must not place it again
+    (tmp_path / 'app.conf').write_text('original\n')
+    (tmp_path / 'Dockerfile').write_text(
+        'COPY app.conf /etc/app.conf\n'
+        'RUN echo changed > /etc/app.conf\n'
+        'RUN cat /etc/app.conf\n')
+    executor = mock.MagicMock()
+    executor.source_dir = str(tmp_path)
+    executor.check_destination.return_value = None
+    placements = []
+    executor.send_archive.side_effect = lambda planner: \
+        placements.append(dict(planner.placements)) or set(planner.placements)
+    docker2ami.build_image(executor, True)
+    docker2ami.build_image(executor, True, range(3, 4))
+    assert placements == [{1: ('app.conf', '/etc/app.conf', False)}, {}]
+    assert [c[0][0] for c in executor.run_cmd.call_args_list] == [
+        'echo changed > /etc/app.conf', 'cat /etc/app.conf',
+        'cat /etc/app.conf',
+        f'rm -rf {executor.context_dir} {executor.env_file}']
+
+
+@mock.patch('docker2ami.ami_builder.AmiBuilder')
+@mock.patch('docker2ami.docker2ami.find_image')
+@mock.patch('builtins.print')
+def test_build_ami_reuses_image(print, find_image, ami_builder, tmp_path):
+    (tmp_path / 'Dockerfile').write_text('RUN make\n')
+    aws_config = mock.MagicMock(image_id='ami-0', region='us-west-1',
+                                instance_type='m5.large', image_name='app',
+                                image_tags='[]', reuse_image='true',
+                                history_file='', root_volume_size='0',
+                                root_volume_type='')
+    session = mock.MagicMock()
+    find_image.return_value = 'ami-1'
+    assert docker2ami.build_ami(aws_config, str(tmp_path),
+                                session=session) == 'ami-1'
+    assert find_image.call_args[0][0] == session.client.return_value
+    assert not ami_builder.called
+
+    find_image.return_value = None
+    with mock.patch('docker2ami.docker2ami.build_image') as build_image:
+        docker2ami.build_ami(aws_config, str(tmp_path), True, session)
+    fingerprint = find_image.call_args[0][1]
+    ami_builder.assert_called_with(aws_config, str(tmp_path), session,
+                                   fingerprint, None)
+    build_image.assert_called_with(ami_builder.return_value, True, None)
+
+
+@mock.patch('docker2ami.sessions.default_factory')
+@mock.patch('docker2ami.docker2ami.setup_logger')
+@mock.patch('docker2ami.docker2ami.get_config_path')
+def test_prune(get_config_path, setup_logger, default_factory, tmp_path,
+               capsys):
+    config_path = tmp_path / 'docker-build-ami.conf'
+    config_path.write_text('[main]\naws_access_key_id = key\n'
+                           'aws_secret_access_key = secret\n')
+    get_config_path.return_value = str(config_path)
+    ec2 = default_factory.session.return_value.client.return_value
+    ec2.describe_images.return_value = {'Images': [
+        {'ImageId': f'ami-{day}', 'Name': f'app-202001{day:02}000000',
+         'CreationDate': f'2020-01-{day:02}T00:00:00.000Z',
+         'BlockDeviceMappings': [
+             {'DeviceName': '/dev/sda1', 'Ebs': {'SnapshotId': f'snap-{day}'}}
+         ]} for day in (1, 2, 3)]}
+    docker2ami.main_with_args(['prune', '-n', 'app', '--keep', '2',
+                               '--dry-run'])
+    assert capsys.readouterr().out.splitlines() == [
+        'app: 2 kept, 1 to prune',
+        '  ami-3  app-20200103000000  2020-01-03  keep (newest 2)',
+        '  ami-2  app-20200102000000  2020-01-02  keep (newest 2)',
+        '  ami-1  app-20200101000000  2020-01-01  prune snap-1',
+        'Would prune 1 images and 1 snapshots']
+    assert not ec2.deregister_image.called
+
+    docker2ami.main_with_args(['prune', '-n', 'app', '--keep', '2'])
+    assert capsys.readouterr().out.splitlines()[-1] == \
+        'Pruned 1 images and 1 snapshots'
+    ec2.deregister_image.assert_called_once_with(ImageId='ami-1')
+    ec2.delete_snapshot.assert_called_once_with(SnapshotId='snap-1')
+    assert default_factory.session.call_args[0][0].aws_access_key_id == 'key'
+
+
+def test_main_with_args_json_progress(tmp_path):
+    (tmp_path / 'context').mkdir()
+    (tmp_path / 'context' / 'Dockerfile').write_text(
+        'RUN echo hello\nRUN exit 3\n')
+    proc = subprocess.run(
+        [sys.executable, '-c',
+         'from docker2ami.docker2ami import main; main()',
+         '--local', str(tmp_path / 'root'), '--progress', 'json',
+         '--build-id', 'b1', '--skip-preflight'],
+        cwd=tmp_path / 'context', env=dict(os.environ, HOME=str(tmp_path)),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    assert proc.returncode == 3
+    events = [json.loads(line) for line in proc.stdout.splitlines()]
+    assert {event['build'] for event in events} == {'b1'}
+    assert [event['event'] for event in events
+            if event['event'] != 'output'] == [
+        'build_started', 'step_started', 'step_finished', 'step_started',
+        'step_finished', 'teardown_started', 'teardown_finished',
+        'build_finished']
+    assert events[-1]['status'] == 'failed'
+    assert {'step': 1, 'text': 'hello\n'}.items() <= next(
+        event for event in events if event['event'] == 'output').items()
+    # The rest of the output goes to stderr
+    assert 'Local root' in proc.stderr
+
+
+def test_help_and_plan_skip_heavy_imports(tmp_path):
+    (tmp_path / 'Dockerfile').write_text('RUN echo hello\n')
+    heavy = ('boto3', 'botocore', 'paramiko', 'sqlite3', 'http.server',
+             'docker2ami.history', 'docker2ami.estimate',
+             'docker2ami.prefix_sharing', 'docker2ami.service')
+    for args in (['--help'], ['plan', str(tmp_path / 'Dockerfile')]):
+        proc = subprocess.run(
+            [sys.executable, '-c',
+             'import atexit, sys\n'
+             f'atexit.register(lambda: print([m for m in {heavy!r} '
+             'if m in sys.modules], file=sys.stderr))\n'
+             'from docker2ami.docker2ami import main; main()'] + args,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        assert proc.returncode == 0
+        assert proc.stderr.splitlines()[-1] == '[]'
+
+
+@mock.patch('docker2ami.docker2ami.sys')
+def test_progress_events_auto(sys):
+    sys.stdout.isatty.return_value = False
+    with docker2ami.progress_events('auto', 'b1', '/tmp') as events:
+        assert events is None
+
+
+@mock.patch('docker2ami.docker2ami.setup_logger')
+@mock.patch('docker2ami.docker2ami.get_config_path')
+def test_history(get_config_path, setup_logger, tmp_path, capsys):
+    get_config_path.return_value = None
+    history_file = str(tmp_path / 'history.db')
+    History(history_file).add_build(
+        {'id': 'abcdef0123456789', 'image_name': 'app', 'region': 'us-west-1',
+         'instance_type': 'm5.large', 'source_image': 'ami-0',
+         'config': '{}', 'started': 0, 'duration': 61.25,
+         'status': 'succeeded', 'image': 'ami-1'},
+        [{'step': 0, 'duration': 2, 'output_bytes': 0, 'exit_code': 0},
+         {'step': 1, 'instruction': 'RUN make', 'fingerprint': 'f' * 64,
+          'duration': 59.25, 'output_bytes': 1024, 'exit_code': 0}])
+    docker2ami.main_with_args(['history', '-f', history_file])
+    assert capsys.readouterr().out.split('  ')[2:] == [
+        'app', 'succeeded', '61.2s', 'ami-1\n']
+
+    docker2ami.main_with_args(['history', '-f', history_file, 'abc'])
+    assert capsys.readouterr().out.splitlines()[2:] == [
+        'STEP  DURATION  EXIT  OUTPUT  FINGERPRINT   INSTRUCTION',
+        '   0      2.0s     0       0  -             (preparation)',
+        '   1     59.2s     0    1024  ffffffffffff  RUN make']
+
+    docker2ami.main_with_args(['history', '-f', history_file, '-s', 'fff'])
+    assert capsys.readouterr().out.split('  ')[0::2] == [
+        'abcdef012345', 'app', '59.2s']
+
+    with pytest.raises(SystemExit):
+        docker2ami.main_with_args(['history', '-f', history_file, 'x'])
+
+
+@mock.patch('docker2ami.docker2ami.build_image')
+@mock.patch('docker2ami.ami_builder.AmiBuilder')
+def test_build_ami_records_history(ami_builder, build_image, tmp_path):
+    (tmp_path / 'Dockerfile').write_text('RUN make\nRUN test\n')
+    aws_config = argparse.Namespace(
+        image_id='ami-0', region='us-west-1', instance_type='m5.large',
+        image_name='app', image_tags='[]', reuse_image='false',
+        history_file=str(tmp_path / 'history.db'), regression_threshold='0',
+        root_volume_size='0', root_volume_type='')
+    docker2ami.build_ami(aws_config, str(tmp_path), build_id='b1')
+    recorder = ami_builder.call_args[0][4]
+    recorder.emit('build_finished', status='succeeded', image='ami-1',
+                  duration=1)
+    build, steps = History(str(tmp_path / 'history.db')).build('b1')
+    assert build['fingerprint'] == ami_builder.call_args[0][3]
+    assert [step['instruction'] for step in steps] == \
+        ['RUN make', 'RUN test']
+
+
+@mock.patch('docker2ami.docker2ami.build_image')
+@mock.patch('docker2ami.ami_builder.AmiBuilder')
+def test_build_ami_builds_part(ami_builder, build_image, tmp_path):
+    (tmp_path / 'Dockerfile').write_text('RUN make\nRUN test\n')
+    aws_config = argparse.Namespace(
+        image_id='ami-shared', region='us-west-1', instance_type='m5.large',
+        image_name='app', image_tags='[]', reuse_image='false',
+        history_file=str(tmp_path / 'history.db'), regression_threshold='0',
+        root_volume_size='0', root_volume_type='')
+    part = mock.MagicMock(fingerprint='fp', steps=range(2, 3),
+                          step_fingerprints=[('RUN make', 'f1'),
+                                             ('RUN test', 'f2')])
+    docker2ami.build_ami(aws_config, str(tmp_path), build_id='b1', part=part)
+    assert ami_builder.call_args[0][3] == 'fp'
+    build_image.assert_called_with(ami_builder.return_value, False,
+                                   range(2, 3))
+    ami_builder.call_args[0][4].emit('build_finished', status='succeeded',
+                                     image='ami-1', duration=1)
+    build, steps = History(str(tmp_path / 'history.db')).build('b1')
+    assert [step['fingerprint'] for step in steps] == ['f1', 'f2']
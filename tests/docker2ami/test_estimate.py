@@ -0,0 +1,96 @@
+import io
+
+from argparse import Namespace
+
+from docker2ami import estimate
+from docker2ami.fingerprint import step_fingerprints
+from docker2ami.history import History
+
+
+DOCKERFILE = ('RUN apt-get install -y gcc\n'
+              '# AWS-PARALLEL\n'
+              'RUN make a\n'
+              'RUN make b\n'
+              '# AWS-PARALLEL-END\n'
+              'RUN apt-get install -y gcc make\n'
+              'RUN ./configure\n')
+
+
+def _aws_config(**kwargs):
+    return Namespace(**dict({'image_name': 'app', 'region': 'us-west-1',
+                             'image_id': 'ami-0'}, **kwargs))
+
+
+def _add_build(history, build_id, started, steps, phases=None,
+               image_name='app', status='succeeded'):
+    history.add_build(
+        {'id': build_id, 'image_name': image_name, 'config': '{}',
+         'started': started, 'status': status},
+        [{'step': step, 'instruction': instruction, 'fingerprint': fingerprint,
+          'duration': duration, 'exit_code': 0}
+         for step, (instruction, fingerprint, duration) in enumerate(steps)],
+        phases)
+
+
+def test_format_seconds():
+    assert estimate.format_seconds(None) == '?'
+    assert estimate.format_seconds(12.34) == '12.3s'
+    assert estimate.format_seconds(245) == '4m05s'
+    assert estimate.format_seconds(3725) == '1h02m'
+
+
+def test_estimate_build(tmp_path):
+    history = History(str(tmp_path / 'history.db'))
+    fingerprints = step_fingerprints(io.StringIO(DOCKERFILE), _aws_config())
+    for build_id, started, scale in (('b1', 100, 1), ('b2', 200, 3)):
+        _add_build(history, build_id, started, [
+            (None, None, 5.0 * scale),
+            fingerprints[0] + (10.0 * scale,),
+            ('RUN make a', 'other', 20.0 * scale),
+            ('RUN make b', 'other', 30.0 * scale),
+            ('RUN apt-get install -y make', 'other', 40.0 * scale)],
+            {'launch': 60.0 * scale, 'save': 90.0 * scale})
+    _add_build(history, 'b3', 300, [], {'teardown': 2.0}, 'other')
+    target = estimate.estimate_build(history, io.StringIO(DOCKERFILE),
+                                     _aws_config())
+    assert target.steps == [
+        (0, 'Prepare the builder', 10.0, '2 runs of app'),
+        (1, 'RUN apt-get install -y gcc', 20.0, 'same step, 2 runs'),
+        (2, 'RUN make a', 40.0, 'same instruction, 2 runs'),
+        (3, 'RUN make b', 60.0, 'same instruction, 2 runs'),
+        (4, 'RUN apt-get install -y gcc make', 80.0,
+         "similar to 'RUN apt-get install -y make', 2 runs"),
+        (5, 'RUN ./configure', None, 'no history')]
+    assert target.phases == {
+        'launch': (120.0, '2 runs of app'),
+        # The parallel steps take as long as the longest of them
+        'steps': (10.0 + 20.0 + 60.0 + 80.0, 'sum of the steps'),
+        'save': (180.0, '2 runs of app'),
+        'teardown': (2.0, '1 run of other images')}
+    assert target.total == 120.0 + 170.0 + 180.0 + 2.0
+    assert target.unknown == [5]
+
+
+def test_estimate_build_without_history(tmp_path):
+    target = estimate.estimate_build(History(str(tmp_path / 'history.db')),
+                                     io.StringIO('RUN make\n'), _aws_config())
+    assert target.total == 0
+    assert target.unknown == [0, 1, 'launch', 'save', 'teardown']
+
+
+def test_find_regressions(tmp_path):
+    history = History(str(tmp_path / 'history.db'))
+    for build_id, started in (('b1', 100), ('b2', 200), ('b3', 300)):
+        _add_build(history, build_id, started, [
+            (None, None, 10.0), ('RUN make', 'f1', 100.0),
+            ('RUN test', 'f2', 2.0)], {'launch': 60.0, 'save': 60.0})
+    _add_build(history, 'b4', 400, [
+        (None, None, 15.0), ('RUN make', 'f1', 200.0),
+        ('RUN test', 'f2', 6.0)], {'launch': 120.0, 'save': 80.0})
+    assert estimate.find_regressions(history, 'b4', 50) == [
+        # The 5s of step 0 and 4s of step 2 are noise
+        ('step 1', 200.0, 100.0), ('launch', 120.0, 60.0)]
+    assert estimate.find_regressions(history, 'b4', 100) == []
+    # Builds without enough earlier builds have no baseline
+    assert estimate.find_regressions(history, 'b3', 0) == []
+    assert estimate.find_regressions(history, 'x', 50) == []
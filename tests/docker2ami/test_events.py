@@ -0,0 +1,81 @@
+import io
+import json
+import threading
+
+from unittest.mock import patch
+
+from docker2ami.events import EventWriter, JsonEvents
+
+
+class RecordingFile(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+
+class BlockingFile(RecordingFile):
+    def __init__(self):
+        super().__init__()
+        self.unblocked = threading.Event()
+
+    def write(self, data):
+        self.unblocked.wait()
+        return super().write(data)
+
+
+def _lines(fp):
+    return [json.loads(line) for line in fp.getvalue().splitlines()]
+
+
+def test_writer_writes_json_lines():
+    fp = RecordingFile()
+    writer = EventWriter(fp, flush_interval=0)
+    writer.write({'event': 'a', 'n': 1})
+    writer.write({'event': 'b', 'text': 'café\n'})
+    writer.close()
+    assert _lines(fp) == [{'event': 'a', 'n': 1},
+                          {'event': 'b', 'text': 'café\n'}]
+
+
+def test_writer_flushes_in_batches():
+    fp = RecordingFile()
+    writer = EventWriter(fp, flush_interval=10)
+    for i in range(100):
+        writer.write({'i': i})
+    writer.close()
+    assert [event['i'] for event in _lines(fp)] == list(range(100))
+    assert fp.flushes == 1
+
+
+def test_writer_does_not_block():
+    fp = BlockingFile()
+    writer = EventWriter(fp, flush_interval=0)
+    for i in range(1000):
+        writer.write({'i': i})
+    assert fp.getvalue() == ''
+    fp.unblocked.set()
+    writer.close()
+    assert len(_lines(fp)) == 1000
+
+
+def test_writer_survives_closed_file():
+    fp = RecordingFile()
+    fp.close()
+    writer = EventWriter(fp, flush_interval=0)
+    writer.write({'event': 'a'})
+    writer.close()
+
+
+@patch('docker2ami.events.time.time')
+def test_json_events(time):
+    time.return_value = 1600000000.12345
+    fp = RecordingFile()
+    writer = EventWriter(fp, flush_interval=0)
+    JsonEvents(writer, 'b1').emit('step_finished', step=3, exit_code=0)
+    writer.close()
+    assert _lines(fp) == [{'time': 1600000000.123, 'build': 'b1',
+                           'event': 'step_finished', 'step': 3,
+                           'exit_code': 0}]
@@ -0,0 +1,128 @@
+import io
+import os
+import pytest
+import shutil
+
+from argparse import Namespace
+from unittest.mock import MagicMock
+
+from docker2ami import fingerprint
+
+
+DOCKERFILE = '''FROM ubuntu:18.04
+COPY hello.c /opt/
+# AWS-SKIP
+COPY skipped /skipped
+COPY images /opt/images
+RUN make
+'''
+
+
+@pytest.fixture(scope='function')
+def context_dir(tmp_path):
+    path = str(tmp_path / 'context')
+    shutil.copytree(
+        os.path.join(os.path.dirname(__file__), 'fixtures/archive'), path)
+    return path
+
+
+def _aws_config(**kwargs):
+    config = {'image_id': 'ami-1', 'region': 'us-west-1',
+              'instance_type': 'm5.large', 'image_name': 'app',
+              'image_tags': '[]', 'subnet_id': 'subnet-1',
+              'root_volume_size': '0', 'root_volume_type': '',
+              'root_volume_iops': '0'}
+    config.update(kwargs)
+    return Namespace(**config)
+
+
+def _fingerprint(context_dir, dockerfile=DOCKERFILE, **kwargs):
+    return fingerprint.compute_fingerprint(
+        io.StringIO(dockerfile), _aws_config(**kwargs), context_dir)
+
+
+def test_delegate_collects_steps():
+    delegate = fingerprint.FingerprintDelegate()
+    fingerprint.parse_dockerfile_with_delegate(io.StringIO(
+        DOCKERFILE + '# AWS-PARALLEL\nADD http://example.com/a /a\n'
+        'ENV A=1\nWORKDIR /opt\n'), delegate)
+    assert delegate.instructions == [
+        'COPY hello.c /opt/', 'COPY images /opt/images', 'RUN make',
+        'AWS-PARALLEL', 'ADD http://example.com/a /a', 'ENV A=1',
+        'WORKDIR /opt', 'AWS-PARALLEL-END']
+    assert delegate.sources == ['hello.c', 'images']
+    assert delegate.steps[:3] == [('COPY hello.c /opt/', ['hello.c']),
+                                  ('COPY images /opt/images', ['images']),
+                                  ('RUN make', [])]
+    assert delegate.steps[3] == ('ADD http://example.com/a /a', [])
+
+
+def test_delegate_groups_parallel_steps():
+    delegate = fingerprint.FingerprintDelegate()
+    fingerprint.parse_dockerfile_with_delegate(io.StringIO(
+        'RUN a\n# AWS-PARALLEL\nRUN b\nRUN c\nENV A=1\nRUN d\nRUN e\n'
+        '# AWS-PARALLEL-END\nRUN f\n'), delegate)
+    assert delegate.groups == [None, 1, 1, None, 2, 2, None]
+
+
+def test_step_fingerprints_chain(context_dir):
+    def fingerprints(dockerfile=DOCKERFILE, **kwargs):
+        return fingerprint.step_fingerprints(
+            io.StringIO(dockerfile), _aws_config(**kwargs), context_dir)
+    first = fingerprints()
+    assert [instruction for instruction, _ in first] == [
+        'COPY hello.c /opt/', 'COPY images /opt/images', 'RUN make']
+    assert fingerprints(instance_type='m5.xlarge') == first
+    assert fingerprints(image_id='ami-2')[0][1] != first[0][1]
+
+    # A changed file changes its step and the ones after it
+    with open(os.path.join(context_dir, 'images/docker.png'), 'ab') as f:
+        f.write(b'changed')
+    changed = fingerprints()
+    assert changed[0] == first[0]
+    assert changed[1][1] != first[1][1]
+    assert changed[2][1] != first[2][1]
+
+
+def test_fingerprint_changes_with_inputs(context_dir):
+    first = _fingerprint(context_dir)
+    assert len(first) == 64
+    assert _fingerprint(context_dir) == first
+    assert _fingerprint(context_dir, DOCKERFILE + '# Comment\n\n') == first
+    assert _fingerprint(context_dir, subnet_id='subnet-2') == first
+    assert _fingerprint(context_dir, root_volume_iops='3000') == first
+    with open(os.path.join(context_dir, 'unused.txt'), 'w') as f:
+        f.write('unused')
+    assert _fingerprint(context_dir) == first
+
+    assert _fingerprint(context_dir, DOCKERFILE + 'RUN make install\n') \
+        != first
+    assert _fingerprint(context_dir, image_id='ami-2') != first
+    assert _fingerprint(context_dir, root_volume_size='100') != first
+    os.chmod(os.path.join(context_dir, 'hello.c'), 0o755)
+    second = _fingerprint(context_dir)
+    assert second != first
+    with open(os.path.join(context_dir, 'images', 'new.png'), 'w') as f:
+        f.write('png')
+    assert _fingerprint(context_dir) != second
+
+
+def test_sources_with_variables_hash_the_context(context_dir):
+    dockerfile = 'COPY $SRC /opt/\n'
+    first = _fingerprint(context_dir, dockerfile)
+    with open(os.path.join(context_dir, 'unused.txt'), 'w') as f:
+        f.write('unused')
+    assert _fingerprint(context_dir, dockerfile) != first
+
+
+def test_find_image():
+    ec2 = MagicMock()
+    ec2.describe_images.return_value = {'Images': [
+        {'ImageId': 'ami-1', 'CreationDate': '2020-01-01T00:00:00.000Z'},
+        {'ImageId': 'ami-2', 'CreationDate': '2020-02-01T00:00:00.000Z'}]}
+    assert fingerprint.find_image(ec2, 'abc') == 'ami-2'
+    ec2.describe_images.assert_called_with(Owners=['self'], Filters=[
+        {'Name': 'tag:docker-build-ami-fingerprint', 'Values': ['abc']},
+        {'Name': 'state', 'Values': ['available']}])
+    ec2.describe_images.return_value = {'Images': []}
+    assert fingerprint.find_image(ec2, 'abc') is None
@@ -0,0 +1,198 @@
+import json
+import sqlite3
+
+from argparse import Namespace
+from unittest.mock import MagicMock, call, patch
+
+from docker2ami.history import History, HistoryRecorder
+
+
+def _aws_config(**kwargs):
+    config = {'image_name': 'app', 'region': 'us-west-1',
+              'instance_type': 'm5.large', 'image_id': 'ami-0',
+              'aws_access_key_id': 'key', 'aws_secret_access_key': 'secret',
+              'regression_threshold': '0'}
+    config.update(kwargs)
+    return Namespace(**config)
+
+
+def _build(build_id, started, image_name='app', **kwargs):
+    return dict({'id': build_id, 'image_name': image_name, 'config': '{}',
+                 'started': started, 'duration': 60.0, 'status': 'succeeded',
+                 'image': f'ami-{build_id}'}, **kwargs)
+
+
+def test_history_stores_builds(tmp_path):
+    history = History(str(tmp_path / 'sub' / 'history.db'))
+    history.add_build(_build('b1', 100), [
+        {'step': 1, 'instruction': 'RUN make', 'fingerprint': 'f1',
+         'duration': 20.5, 'output_bytes': 10, 'exit_code': 0},
+        {'step': 2, 'instruction': 'RUN test', 'fingerprint': 'f2'}])
+    history.add_build(_build('b2', 200, 'other'), [])
+    history.add_build(_build('b3', 300), [
+        {'step': 1, 'instruction': 'RUN make', 'fingerprint': 'f1',
+         'duration': 30.0, 'output_bytes': 10, 'exit_code': 0}])
+
+    assert [build['id'] for build in history.builds()] == ['b3', 'b2', 'b1']
+    assert [build['id'] for build in history.builds('app', 1)] == ['b3']
+
+    build, steps = history.build('b1')
+    assert build['image'] == 'ami-b1'
+    assert [(step['step'], step['duration'], step['exit_code'])
+            for step in steps] == [(1, 20.5, 0), (2, None, None)]
+    # Prefixes that match several builds or none match nothing
+    assert history.build('b') == (None, [])
+    assert history.build('x') == (None, [])
+
+    assert [(run['build_id'], run['duration'], run['image_name'])
+            for run in history.step_runs('f')] == [('b3', 30.0, 'app'),
+                                                   ('b1', 20.5, 'app')]
+    assert [run['build_id'] for run in history.step_runs('f2')] == []
+
+
+def test_history_replaces_a_build(tmp_path):
+    history = History(str(tmp_path / 'history.db'))
+    history.add_build(_build('b1', 100), [{'step': 1, 'duration': 1.0}])
+    history.add_build(_build('b1', 100, status='failed'),
+                      [{'step': 1, 'duration': 2.0}])
+    build, steps = history.build('b1')
+    assert build['status'] == 'failed'
+    assert [step['duration'] for step in steps] == [2.0]
+
+
+def test_history_indexes(tmp_path):
+    history = History(str(tmp_path / 'history.db'))
+    history.builds()
+    db = sqlite3.connect(str(tmp_path / 'history.db'))
+    plan = db.execute('EXPLAIN QUERY PLAN SELECT * FROM steps WHERE '
+                      "fingerprint = 'f1'").fetchall()
+    assert 'steps_fingerprint' in str(plan)
+    plan = db.execute('EXPLAIN QUERY PLAN SELECT * FROM builds WHERE '
+                      "image_name = 'app' ORDER BY started DESC").fetchall()
+    assert 'builds_image_name' in str(plan)
+    plan = db.execute('EXPLAIN QUERY PLAN SELECT * FROM steps WHERE '
+                      "instruction = 'RUN make'").fetchall()
+    assert 'steps_instruction' in str(plan)
+
+
+def test_history_upgrades_schema(tmp_path):
+    history = History(str(tmp_path / 'history.db'))
+    history.add_build(_build('b1', 100), [])
+    db = sqlite3.connect(str(tmp_path / 'history.db'))
+    db.executescript('DROP TABLE phases; DROP INDEX steps_instruction; '
+                     'PRAGMA user_version = 1;')
+    db.close()
+    history.add_build(_build('b2', 200), [], {'launch': 1.0})
+    assert history.phases('b2') == {'launch': 1.0}
+    assert len(history.builds()) == 2
+
+
+def test_history_durations(tmp_path):
+    history = History(str(tmp_path / 'history.db'))
+    for build_id, started, status, duration in (
+            ('b1', 100, 'succeeded', 10.0), ('b2', 200, 'failed', 20.0),
+            ('b3', 300, 'succeeded', 30.0)):
+        history.add_build(
+            _build(build_id, started, status=status),
+            [{'step': 1, 'instruction': 'RUN make', 'fingerprint': 'f1',
+              'duration': duration, 'exit_code': 0},
+             {'step': 2, 'instruction': 'RUN make test', 'fingerprint': 'f2',
+              'duration': duration, 'exit_code': 1}],
+            {'launch': duration})
+    assert history.step_durations(fingerprint='f1') == [30.0, 20.0, 10.0]
+    assert history.step_durations(instruction='RUN make', before=300,
+                                  limit=1) == [20.0]
+    assert history.step_durations(fingerprint='f2') == []
+    assert history.phase_durations('launch') == [30.0, 10.0]
+    assert history.phase_durations('launch', 'other') == []
+    assert history.phases('b1') == {'launch': 10.0}
+    assert history.instructions('RUN') == ['RUN make', 'RUN make test']
+    assert history.instructions('COPY') == []
+
+
+@patch('docker2ami.history.time.time')
+def test_recorder_records_build(time, tmp_path):
+    time.return_value = 1000.0
+    history = History(str(tmp_path / 'history.db'))
+    events = MagicMock()
+    target = HistoryRecorder(
+        history, 'b1', _aws_config(), [('RUN make', 'f1'), ('RUN test', 'f2'),
+                                       ('RUN never', 'f3')], 'fp', events)
+    target.emit('build_started', source_dir='.')
+    target.emit('step_finished', step=0, exit_code=0, duration=1)
+    target.emit('output', step=1, text='héllo\n')
+    target.emit('step_finished', step=1, exit_code=0, duration=1.5)
+    target.emit('step_finished', step=1, exit_code=0, duration=2)
+    target.emit('step_finished', step=2, exit_code=2, duration=0.25)
+    target.emit('build_finished', status='failed', error='exit code 2',
+                duration=9)
+    assert events.emit.call_count == 7
+
+    build, steps = history.build('b1')
+    assert (build['image_name'], build['instance_type'], build['source_image'],
+            build['fingerprint'], build['started'], build['status'],
+            build['error']) == ('app', 'm5.large', 'ami-0', 'fp', 1000.0,
+                                'failed', 'exit code 2')
+    config = json.loads(build['config'])
+    assert config['region'] == 'us-west-1'
+    assert 'aws_secret_access_key' not in config
+    assert [tuple(step)[1:] for step in steps] == [
+        (0, None, None, 1.0, 0, 0),
+        (1, 'RUN make', 'f1', 3.5, 7, 0),
+        (2, 'RUN test', 'f2', 0.25, 0, 2),
+        (3, 'RUN never', 'f3', None, None, None)]
+
+
+@patch('docker2ami.history.time.monotonic')
+def test_recorder_records_phases(monotonic, tmp_path, capsys):
+    history = History(str(tmp_path / 'history.db'))
+    for build_id in ('b1', 'b2', 'b3'):
+        history.add_build(_build(build_id, 100), [
+            {'step': 1, 'fingerprint': 'f1', 'duration': 10.0,
+             'exit_code': 0}], {'launch': 30.0, 'save': 60.0})
+    events = MagicMock()
+    target = HistoryRecorder(history, 'b4', _aws_config(
+        regression_threshold='50'), [('RUN make', 'f1')], events=events)
+    for now, event, fields in (
+            (1000, 'build_started', {}),
+            (1040, 'instance_ready', {}),
+            (1041, 'step_finished', {'step': 0, 'exit_code': 0,
+                                     'duration': 1}),
+            (1060, 'step_finished', {'step': 1, 'exit_code': 0,
+                                     'duration': 19}),
+            (1062, 'step_finished', {'step': 0, 'exit_code': 0,
+                                     'duration': 2}),
+            (1120, 'image_created', {'image': 'ami-1'}),
+            (1121, 'teardown_finished', {'duration': 1.0})):
+        monotonic.return_value = now
+        target.emit(event, **fields)
+    events.reset_mock()
+    target.emit('build_finished', status='succeeded', image='ami-1',
+                duration=121)
+    assert history.phases('b4') == {'launch': 40, 'steps': 20, 'save': 60,
+                                    'teardown': 1.0}
+    assert events.emit.call_args_list == [
+        call('regression', name='step 1', duration=19.0, baseline=10.0),
+        call('build_finished', status='succeeded', image='ami-1',
+             duration=121)]
+    assert capsys.readouterr().out.splitlines() == [
+        'Slower than the median of the last builds by more than 50%:',
+        '  step 1: 19.0s instead of 10.0s']
+
+
+def test_recorder_records_reused_image(tmp_path):
+    history = History(str(tmp_path / 'history.db'))
+    target = HistoryRecorder(history, 'b1', _aws_config(), [])
+    target.emit('image_reused', image='ami-1')
+    build, steps = history.build('b1')
+    assert (build['status'], build['image']) == ('reused', 'ami-1')
+
+
+@patch('docker2ami.history.logger')
+def test_recorder_does_not_fail_the_build(logger, tmp_path):
+    (tmp_path / 'history.db').write_text('not a database')
+    target = HistoryRecorder(History(str(tmp_path / 'history.db')), 'b1',
+                             _aws_config(), [])
+    target.emit('build_finished', status='succeeded', image='ami-1',
+                duration=1)
+    assert logger.warning.called
@@ -0,0 +1,60 @@
+import os
+import pytest
+import subprocess
+import tarfile
+
+from docker2ami.indexed_archive import IndexedArchive, merge_ranges, \
+    read_chunks_cmd
+
+
+@pytest.fixture(scope='function')
+def archive_path(tmp_path, monkeypatch):
+    start_dir = os.getcwd()
+    os.chdir(os.path.join(os.path.dirname(__file__), 'fixtures/archive'))
+    monkeypatch.setattr(IndexedArchive, 'CHUNK_SIZE', 1)
+    path = str(tmp_path / 'context.tar.gz')
+    with IndexedArchive(path, 'w') as archive:
+        archive.add('hello.c')
+        archive.flush()
+        archive.add('images')
+    yield path
+    os.chdir(start_dir)
+
+
+def test_chunks(archive_path):
+    archive = IndexedArchive(archive_path)
+    hello = archive.chunks(['hello.c'])
+    images = archive.chunks(['images'])
+    docker = archive.chunks(['images/docker.png'])
+    assert len(hello) == 1
+    assert len(images) == 2
+    assert docker < images
+    assert not hello & images
+    assert archive.chunks(['.']) == hello | images
+    assert archive.chunks(['hello.c', 'images']) == hello | images
+    assert archive.chunks(['missing']) is None
+    assert archive.chunks(['hello.c'], min(images)[0]) is None
+
+
+def test_merge_ranges():
+    assert merge_ranges({(10, 5), (0, 10), (20, 5)}) == [(0, 15), (20, 5)]
+
+
+def test_whole_archive_is_a_tar_gz(archive_path):
+    # Each chunk ends like a tar archive, which tar skips with -i
+    with tarfile.open(archive_path) as tar:
+        assert tar.getnames() == ['hello.c']
+    out = subprocess.check_output(['tar', '-tzif', archive_path])
+    assert sorted(out.decode('utf8').split()) == [
+        'hello.c', 'images/', 'images/apple.jpg', 'images/docker.png']
+
+
+def test_read_chunks_cmd_extracts_only_them(archive_path, tmp_path):
+    archive = IndexedArchive(archive_path)
+    cmd = read_chunks_cmd(archive_path, archive.chunks(['images/docker.png']))
+    dst = tmp_path / 'dst'
+    dst.mkdir()
+    subprocess.check_call(f'{cmd} | tar -xzi -C {dst}', shell=True)
+    assert os.listdir(str(dst / 'images')) == ['docker.png']
+    with open('images/docker.png', 'rb') as f:
+        assert (dst / 'images/docker.png').read_bytes() == f.read()
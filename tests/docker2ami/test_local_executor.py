@@ -0,0 +1,298 @@
+import os
+import pytest
+import signal
+import tarfile
+import time
+from unittest.mock import call, MagicMock, patch
+
+from docker2ami.docker2ami import Docker2AmiParserDelegate
+from docker2ami.executor import AbstractExecutor, StepDeadline, \
+    cancel_running
+from docker2ami.local_executor import LocalExecutor
+from docker2ami.parser import ParserState
+
+
+class EmptyObj(object):
+    """ So we can dynamically add attributes """
+    pass
+
+
+class RecordingExecutor(AbstractExecutor):
+    def __init__(self, ecodes):
+        self.ecodes = ecodes
+        self.calls = []
+
+    def _exec(self, cmd, step, prefix=None):
+        self.calls.append((cmd, step, prefix))
+        return self.ecodes.get(cmd, 0)
+
+
+def test_abstract_executor_runs_parallel_cmds_with_prefix():
+    target = RecordingExecutor({})
+    target.run_parallel([('make a', 2), ('make b', 3)])
+    assert sorted(target.calls) == [('make a', 2, '[step 2] '),
+                                    ('make b', 3, '[step 3] ')]
+
+
+@patch('builtins.exit')
+def test_abstract_executor_run_parallel_waits_for_all(exit):
+    target = RecordingExecutor({'make a': 5, 'make b': 6})
+    target.run_parallel([('make a', 2), ('make b', 3), ('make c', 4)])
+    assert len(target.calls) == 3
+    assert exit.call_args_list[0] == call(5)
+
+
+def test_abstract_executor_requires_implementation():
+    target = AbstractExecutor()
+    assert target.context_dir == '/tmp/docker-build-ami'
+    with pytest.raises(NotImplementedError):
+        target.send_archive()
+    with pytest.raises(NotImplementedError):
+        target.update_env('FOO=BAR')
+    with pytest.raises(NotImplementedError):
+        target.run_cmd('true')
+    with pytest.raises(NotImplementedError):
+        target.save_image()
+
+
+@patch('docker2ami.executor.time.monotonic')
+def test_step_deadline(monotonic):
+    monotonic.return_value = 100
+    deadline = StepDeadline(60, 10)
+    assert deadline.poll_interval == 1.0
+    monotonic.return_value = 109
+    assert deadline.expired() is None
+    deadline.output()
+    monotonic.return_value = 118
+    assert deadline.expired() is None
+    monotonic.return_value = 119
+    assert deadline.expired() == 'printed nothing for 10s'
+    deadline.output()
+    monotonic.return_value = 160
+    assert deadline.expired() == 'ran longer than 60s'
+    assert StepDeadline().poll_interval is None
+    assert StepDeadline().expired() is None
+
+
+def test_abstract_executor_finishes_when_start_fails():
+    target = RecordingExecutor({})
+    target.start = MagicMock(side_effect=RuntimeError('No instance'))
+    target.finish = MagicMock()
+    previous = signal.getsignal(signal.SIGTERM)
+    with pytest.raises(RuntimeError):
+        with target:
+            pass
+    assert target.finish.called
+    assert signal.getsignal(signal.SIGTERM) == previous
+
+
+def test_abstract_executor_tears_down_on_sigterm():
+    target = RecordingExecutor({})
+    handlers = []
+    target.finish = MagicMock(side_effect=lambda: handlers.append(
+        signal.getsignal(signal.SIGINT)))
+    previous = signal.getsignal(signal.SIGTERM)
+    with pytest.raises(KeyboardInterrupt):
+        with target:
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(1)
+    # finish() cannot be interrupted
+    assert handlers == [signal.SIG_IGN]
+    assert signal.getsignal(signal.SIGTERM) == previous
+
+
+def test_cancel_running_cancels_entered_executors():
+    entered, left = RecordingExecutor({}), RecordingExecutor({})
+    entered.cancel = MagicMock()
+    left.cancel = MagicMock()
+    with left:
+        pass
+    with entered:
+        cancel_running()
+    cancel_running()
+    entered.cancel.assert_called_once_with()
+    assert not left.cancel.called
+
+
+@pytest.fixture(scope='function')
+def local_executor_fixtures(request, tmp_path):
+    request.cls.config = EmptyObj()
+    request.cls.config.tmp_dir = str(tmp_path)
+    request.cls.config.image_name = 'local-image'
+    request.cls.config.log_file = ''
+    request.cls.config.log_tail_lines = '20'
+    request.cls.config.step_timeout = '0'
+    request.cls.config.idle_timeout = '0'
+    request.cls.root_dir = str(tmp_path / 'root')
+    request.cls.start_dir = os.getcwd()
+    yield
+    os.chdir(request.cls.start_dir)
+
+
+@pytest.mark.usefixtures('local_executor_fixtures')
+class TestLocalExecutor(object):
+    def test_context_dir(self):
+        target = LocalExecutor(self.config, self.root_dir)
+        assert target.context_dir == os.path.join(
+            self.root_dir, 'tmp/docker-build-ami')
+        target = LocalExecutor(self.config, self.root_dir, chroot=True)
+        assert target.context_dir == '/tmp/docker-build-ami'
+
+    @patch('builtins.print')
+    def test_send_archive(self, print):
+        os.chdir(os.path.join(os.path.dirname(__file__), 'fixtures/archive'))
+        with LocalExecutor(self.config, self.root_dir) as target:
+            target.send_archive()
+            assert os.path.isfile(
+                os.path.join(target.context_dir, 'hello.c'))
+            assert os.path.isfile(
+                os.path.join(target.context_dir, 'images/docker.png'))
+
+    def test_check_destination(self):
+        target = LocalExecutor(self.config, self.root_dir)
+        assert target.check_destination('opt/app') is None
+        assert target.check_destination(
+            os.path.join(self.root_dir, 'opt')) is None
+        assert target.check_destination('/etc/x') == \
+            f'/etc/x is outside of {self.root_dir}, use a relative path or ' \
+            '--chroot'
+        assert target.check_destination(
+            os.path.join(self.root_dir, '../etc')) is not None
+        target = LocalExecutor(self.config, self.root_dir, chroot=True)
+        assert target.check_destination('/etc/x') is None
+
+    @patch('builtins.print')
+    @patch('builtins.exit', side_effect=SystemExit(1))
+    def test_absolute_copy_does_not_write_to_host(self, exit, print,
+                                                  tmp_path):
+        host_path = str(tmp_path / 'host/hello.c')
+        os.chdir(os.path.join(os.path.dirname(__file__), 'fixtures/archive'))
+        with LocalExecutor(self.config, self.root_dir) as target:
+            target.send_archive()
+            state = ParserState()
+            state.step = 1
+            delegate = Docker2AmiParserDelegate(target, state)
+            with pytest.raises(SystemExit):
+                delegate.run_copy('hello.c', host_path)
+        assert not os.path.exists(os.path.dirname(host_path))
+
+    @patch('builtins.print')
+    def test_run_cmd_uses_env_and_workdir(self, print):
+        with LocalExecutor(self.config, self.root_dir) as target:
+            target.run_cmd('mkdir -p app')
+            target.update_env('FOO=BAR')
+            target.update_env('cd app')
+            target.run_cmd('echo $FOO > foo.txt')
+            target.update_env('FOO=BAZ')
+            target.run_cmd('echo $FOO > baz.txt')
+        with open(os.path.join(self.root_dir, 'app/foo.txt')) as f:
+            assert f.read() == 'BAR\n'
+        with open(os.path.join(self.root_dir, 'app/baz.txt')) as f:
+            assert f.read() == 'BAZ\n'
+
+    @patch('builtins.print')
+    @patch('docker2ami.build_log.stdout')
+    def test_run_cmd_prints_output(self, stdout, print):
+        with LocalExecutor(self.config, self.root_dir) as target:
+            target.run_cmd('echo hello; echo oops >&2')
+        written = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        assert 'hello\n' in written
+        assert 'oops\n' in written
+
+    @patch('builtins.print')
+    @patch('builtins.exit')
+    def test_run_cmd_error(self, exit, print):
+        with LocalExecutor(self.config, self.root_dir) as target:
+            target.run_cmd('exit 3')
+        exit.assert_called_with(3)
+
+    @patch('builtins.print')
+    @patch('builtins.exit')
+    @patch('docker2ami.build_log.stdout')
+    def test_run_parallel_runs_concurrently(self, stdout, exit, print):
+        # Each command waits for the other one to have started
+        wait = ('echo {0}; touch {0}; for i in $(seq 100); do '
+                '[ -f {1} ] && exit 0; sleep 0.05; done; exit 1')
+        with LocalExecutor(self.config, self.root_dir) as target:
+            target.run_parallel([(wait.format('a', 'b'), 3),
+                                 (wait.format('b', 'a'), 4)])
+        written = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        assert '[step 3] a' in written
+        assert '[step 4] b' in written
+        assert not exit.called
+
+    @patch('builtins.print')
+    @patch('builtins.exit')
+    def test_run_parallel_fails_if_any_fails(self, exit, print):
+        with LocalExecutor(self.config, self.root_dir) as target:
+            target.run_parallel([('true', 1), ('exit 4', 2), ('true', 3)])
+        exit.assert_called_once_with(4)
+
+    @patch('builtins.print')
+    @patch('builtins.exit')
+    def test_run_cmd_stops_at_timeout(self, exit, print):
+        self.config.step_timeout = '1'
+        start = time.monotonic()
+        with LocalExecutor(self.config, self.root_dir) as target:
+            target.run_cmd('sleep 30 & echo started; sleep 30')
+        assert time.monotonic() - start < 10
+        exit.assert_called_with(124)
+        print.assert_any_call('\033[31mStep 0 ran longer than 1s, stopped '
+                              'it\033[0m')
+
+    @patch('builtins.print')
+    @patch('builtins.exit')
+    @patch('docker2ami.build_log.stdout')
+    def test_run_cmd_stops_when_idle(self, stdout, exit, print):
+        self.config.idle_timeout = '1'
+        with LocalExecutor(self.config, self.root_dir) as target:
+            target.set_timeouts(2, 0, 0)
+            target.run_cmd('sleep 1.5; echo done', 2)
+            assert not exit.called
+            target.set_timeouts(3, 0)
+            target.run_cmd('sleep 1.5; echo done', 3)
+        exit.assert_called_once_with(124)
+
+    @patch('builtins.print')
+    def test_save_image_contains_changes(self, print):
+        os.makedirs(os.path.join(self.root_dir, 'etc'))
+        for name in ('keep', 'change', 'delete'):
+            with open(os.path.join(self.root_dir, 'etc', name), 'w') as f:
+                f.write(name)
+        os.chdir(os.path.join(os.path.dirname(__file__), 'fixtures/archive'))
+        with LocalExecutor(self.config, self.root_dir) as target:
+            target.send_archive()
+            target.run_cmd('echo changed >> etc/change; rm etc/delete; '
+                           'mkdir -p usr/bin; touch usr/bin/tool')
+            image_path = target.save_image()
+
+        assert os.path.dirname(image_path) == self.config.tmp_dir
+        assert os.path.basename(image_path).startswith('local-image-')
+        with tarfile.open(image_path) as tar:
+            names = tar.getnames()
+        assert 'etc/change' in names
+        assert 'etc/.wh.delete' in names
+        assert 'usr/bin/tool' in names
+        assert 'etc/keep' not in names
+        assert not [n for n in names if n.startswith('tmp/docker-build-ami')]
+        assert 'tmp/docker-build-ami.env' not in names
+
+    @patch('builtins.print')
+    @patch('builtins.exit')
+    @patch('docker2ami.build_log.stdout')
+    def test_emits_events(self, stdout, exit, print):
+        events = MagicMock()
+        with LocalExecutor(self.config, self.root_dir,
+                           events=events) as target:
+            target.run_cmd('echo hello; exit 2', 4)
+            image_path = target.save_image()
+        emitted = [(c[0][0], c[1]) for c in events.emit.call_args_list]
+        names = [name for name, fields in emitted]
+        assert names == ['step_started', 'output', 'step_finished',
+                         'image_created', 'teardown_started',
+                         'teardown_finished']
+        assert emitted[0][1] == {'step': 4, 'command': 'echo hello; exit 2'}
+        assert emitted[1][1] == {'step': 4, 'text': 'hello\n'}
+        assert emitted[2][1]['exit_code'] == 2
+        assert emitted[2][1]['duration'] >= 0
+        assert emitted[3][1] == {'image': image_path}
@@ -1,3 +1,4 @@
+import io
 import os
 import pytest
 import re
@@ -69,6 +70,32 @@ def test_aws_skip_regex():
     assert None is target.match('#aWS-SKIP')
 
 
+def test_aws_parallel_regex():
+    target = parser.AWS_PARALLEL_REGEX
+    assert None is not target.match('# AWS-PARALLEL')
+    assert None is not target.match('  #AWS-PARALLEL  ')
+    assert None is target.match('# AWS-PARALLEL-END')
+    assert None is target.match('AWS-PARALLEL')
+
+
+def test_aws_parallel_end_regex():
+    target = parser.AWS_PARALLEL_END_REGEX
+    assert None is not target.match('# AWS-PARALLEL-END')
+    assert None is not target.match('  #AWS-PARALLEL-END  ')
+    assert None is target.match('# AWS-PARALLEL')
+
+
+def test_aws_timeout_regex():
+    target = parser.AWS_TIMEOUT_REGEX
+    assert target.match('# AWS-TIMEOUT 30m').groups() == \
+        ('30', 'm', None, None)
+    assert target.match('  #AWS-TIMEOUT 2h 90  ').groups() == \
+        ('2', 'h', '90', '')
+    assert None is target.match('# AWS-TIMEOUT')
+    assert None is target.match('# AWS-TIMEOUT 30 minutes')
+    assert None is target.match('AWS-TIMEOUT 30m')
+
+
 def test_comment_regex():
     target = parser.COMMENT_REGEX
     assert None is not target.match('# AWSSKIP')
@@ -174,6 +201,8 @@ def dockerfile_fixtures(request):
       os.path.join(fixture_dir, 'workdir_dockerfile'))
     request.cls.misc_dockerfile_stream = open(
       os.path.join(fixture_dir, 'misc_dockerfile'))
+    request.cls.parallel_dockerfile_stream = open(
+      os.path.join(fixture_dir, 'parallel_dockerfile'))
 
     yield
     request.cls.example_dockerfile_stream.close()
@@ -183,6 +212,7 @@ def dockerfile_fixtures(request):
     request.cls.run_dockerfile_stream.close()
     request.cls.workdir_dockerfile_stream.close()
     request.cls.misc_dockerfile_stream.close()
+    request.cls.parallel_dockerfile_stream.close()
 
 
 @pytest.mark.usefixtures('dockerfile_fixtures')
@@ -262,28 +292,51 @@ class TestParseDockerfileWithDelegate(object):
            mock.call.run_nop(),
            mock.call.run_skip()])
 
+    def test_parses_parallel(self):
+        delegate = mock.MagicMock()
+        parser.parse_dockerfile_with_delegate(
+          self.parallel_dockerfile_stream, delegate)
+        assert delegate.mock_calls == [
+          mock.call.run_run('apt-get update'),
+          mock.call.run_parallel_start(),
+          mock.call.run_run(
+            'git clone https://github.com/jamieleecho/coco-tools.git'),
+          mock.call.run_run(
+            'git clone https://github.com/milliluk/milliluk-tools.git'),
+          mock.call.run_parallel_end(),
+          mock.call.run_run('apt-get clean'),
+          mock.call.run_parallel_start(),
+          mock.call.run_run('make -C foo'),
+          mock.call.run_run('make -C bar'),
+          mock.call.run_parallel_end()]
+
+
+def test_parses_timeouts():
+    delegate = mock.MagicMock()
+    parser.parse_dockerfile_with_delegate(io.StringIO(
+        '# AWS-TIMEOUT 2h\nRUN make\n# AWS-TIMEOUT 0 5m\nRUN make test\n'),
+        delegate)
+    assert delegate.mock_calls == [
+        mock.call.run_timeout(7200, None), mock.call.run_run('make'),
+        mock.call.run_timeout(0, 300), mock.call.run_run('make test')]
+
 
 def test_parser_state_initializes_with_right_state():
     target = parser.ParserState()
     assert target.step == 0
     assert target.skip is False
-    assert target.env == ''
 
 
 def test_parser_state_updates_state():
     target = parser.ParserState()
     target.step = target.step + 1
     target.skip = True
-    target.env = target.env + 'foo = bar;'
     assert target.step == 1
     assert target.skip is True
-    assert target.env == 'foo = bar;'
     target.step = target.step + 1
     target.skip = False
-    target.env = target.env + 'foo2 = bar2;'
     assert target.step == 2
     assert target.skip is False
-    assert target.env == 'foo = bar;foo2 = bar2;'
 
 
 @pytest.fixture(scope='function')
@@ -324,6 +377,10 @@ class TestSimpleStateParserDelegate(object):
         assert self.parser_state.skip is False
         target.run_skip()
         mock_parser_delegate.run_skip_called_with()
+        target.run_parallel_start()
+        mock_parser_delegate.run_parallel_start.assert_called_with()
+        target.run_parallel_end()
+        mock_parser_delegate.run_parallel_end.assert_called_with()
 
     @mock.patch('docker2ami.parser.AbstractParserDelegate')
     def test_invokes_delegate_when_skip_is_true(self, mock_parser_delegate):
@@ -478,9 +535,10 @@ class TestSimpleStateParserDelegate(object):
           mock_parser_delegate, self.parser_state)
 
         target.run_env('FOO', 'BAR')
-        assert self.parser_state.env == "FOO=BAR;"
         target.run_env('BAR', '`echo hello`')
-        assert self.parser_state.env == "FOO=BAR;BAR=`echo hello`;"
+        assert self.parser_state.step == 2
+        assert mock_parser_delegate.run_env.call_args_list == [
+            mock.call('FOO', 'BAR'), mock.call('BAR', '`echo hello`')]
 
     @mock.patch('docker2ami.parser.AbstractParserDelegate')
     def test_run_workdir(self, mock_parser_delegate):
@@ -488,6 +546,7 @@ class TestSimpleStateParserDelegate(object):
           mock_parser_delegate, self.parser_state)
 
         target.run_workdir('/foo/bar')
-        assert self.parser_state.env == "cd /foo/bar;"
         target.run_workdir('bar')
-        assert self.parser_state.env == "cd /foo/bar;cd bar;"
+        assert self.parser_state.step == 2
+        assert mock_parser_delegate.run_workdir.call_args_list == [
+            mock.call('/foo/bar'), mock.call('bar')]
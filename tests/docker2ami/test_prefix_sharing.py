@@ -0,0 +1,143 @@
+import threading
+
+from docker2ami import build_graph, prefix_sharing
+from docker2ami.history import History
+from docker2ami.prefix_sharing import Target
+
+
+def _target(name, *instructions):
+    """
+    Returns a Target whose steps are fingerprinted by the arguments of the
+    instructions up to them
+    """
+    args = [instruction.split(' ', 1)[1] for instruction in instructions]
+    steps = [(instruction, '/'.join(args[:i + 1]))
+             for i, instruction in enumerate(instructions)]
+    return Target(name, f'/src/{name}', f'fp-{name}', steps)
+
+
+def _plan(builds):
+    return [(depth, build.image_name, list(build.steps), build.targets)
+            for depth, build in build_graph.iter_graph(builds)]
+
+
+def test_plan_shares_prefixes():
+    targets = [
+        _target('a', 'RUN apt', 'RUN gcc', 'RUN a'),
+        _target('b', 'RUN apt', 'RUN gcc', 'RUN b', 'RUN b2'),
+        _target('c', 'RUN apt', 'RUN make'),
+        _target('d', 'RUN yum'),
+    ]
+    builds = prefix_sharing.plan_shared_builds(targets)
+    apt = 'docker-build-ami-shared-apt'
+    gcc = 'docker-build-ami-shared-apt/gcc'
+    assert _plan(builds) == [
+        (0, apt, [1], 3),
+        (1, gcc, [2], 2),
+        (2, 'a', [3], 1),
+        (2, 'b', [3, 4], 1),
+        (1, 'c', [2], 1),
+        (0, 'd', [1], 1)]
+    assert builds[0].source_dir == '/src/a'
+    assert builds[0].fingerprint == 'apt'
+    assert builds[0].children[0].children[1].fingerprint == 'fp-b'
+    assert str(builds[0]) == f'step 1 of /src/a -> {apt}'
+    assert str(builds[0].children[0].children[1]) == \
+        'steps 3-4 of /src/b -> b'
+
+
+def test_plan_starts_from_targets():
+    targets = [
+        _target('base', 'RUN apt'),
+        _target('app', 'RUN apt', 'RUN app'),
+        _target('copy', 'RUN apt'),
+        _target('empty'),
+    ]
+    builds = prefix_sharing.plan_shared_builds(targets)
+    assert _plan(builds) == [
+        (0, 'empty', [], 1),
+        (0, 'base', [1], 3),
+        (1, 'app', [2], 1)]
+    assert builds[1].aliases == [targets[2]]
+    assert str(builds[0]) == 'no steps -> empty'
+    assert str(builds[1]) == 'step 1 of /src/base -> base, copy'
+
+
+def test_plan_leaves_environment_steps_to_later_builds():
+    targets = [
+        _target('a', 'RUN apt', 'ENV A=1', 'WORKDIR /opt', 'RUN a'),
+        _target('b', 'RUN apt', 'ENV A=1', 'WORKDIR /opt', 'RUN b'),
+        _target('c', 'RUN apt', 'RUN c'),
+    ]
+    builds = prefix_sharing.plan_shared_builds(targets)
+    assert [(depth, name, steps) for depth, name, steps, _
+            in _plan(builds)] == [
+        (0, 'docker-build-ami-shared-apt', [1]),
+        (1, 'a', [2, 3, 4]),
+        (1, 'b', [2, 3, 4]),
+        (1, 'c', [2])]
+
+
+def test_estimate_saving(tmp_path):
+    targets = [_target('a', 'RUN apt', 'RUN a'),
+               _target('b', 'RUN apt', 'RUN b'),
+               _target('c', 'RUN apt', 'RUN c')]
+    builds = prefix_sharing.plan_shared_builds(targets)
+    saving = prefix_sharing.estimate_saving(builds, targets)
+    assert (saving.step_runs, saving.total_step_runs, saving.extra_builds,
+            saving.seconds) == (2, 6, 1, None)
+
+    history = History(str(tmp_path / 'history.db'))
+    history.add_build(
+        {'id': 'b1', 'image_name': 'a', 'config': '{}', 'started': 1,
+         'status': 'succeeded'},
+        [{'step': 0, 'duration': 10.0, 'exit_code': 0},
+         {'step': 1, 'instruction': 'RUN apt', 'fingerprint': 'apt',
+          'duration': 300.0, 'exit_code': 0}],
+        {'launch': 60.0, 'save': 120.0, 'teardown': 5.0})
+    saving = prefix_sharing.estimate_saving(builds, targets, history)
+    assert (saving.seconds, saving.overhead) == (600.0, 195.0)
+
+
+def test_run_shared_builds():
+    targets = [_target('a', 'RUN apt', 'RUN a'),
+               _target('b', 'RUN apt', 'RUN b'),
+               _target('c', 'RUN yum', 'RUN c'),
+               _target('d', 'RUN yum', 'RUN d')]
+    builds = prefix_sharing.plan_shared_builds(targets)
+    started = []
+    lock = threading.Lock()
+
+    def build(shared, image_id):
+        with lock:
+            started.append((shared.image_name, image_id))
+        if shared.image_name.endswith('yum'):
+            raise SystemExit(2)
+        return f'ami-{shared.image_name}'
+
+    results = prefix_sharing.run_shared_builds(builds, build, 2)
+    apt = 'docker-build-ami-shared-apt'
+    assert sorted(started) == [
+        ('a', f'ami-{apt}'), ('b', f'ami-{apt}'), (apt, None),
+        ('docker-build-ami-shared-yum', None)]
+    assert results['a'] == 'ami-a'
+    assert results['b'] == 'ami-b'
+    assert isinstance(results['c'], SystemExit)
+    assert results['d'] is results['c']
+
+
+def test_run_shared_builds_gives_aliases_the_ami():
+    targets = [_target('base', 'RUN apt'),
+               _target('copy', 'RUN apt'),
+               _target('app', 'RUN apt', 'RUN app')]
+    builds = prefix_sharing.plan_shared_builds(targets)
+    started = []
+
+    def build(shared, image_id):
+        started.append(shared.image_name)
+        return f'ami-{shared.image_name}'
+
+    results = prefix_sharing.run_shared_builds(builds, build, 2)
+    assert sorted(started) == ['app', 'base']
+    assert results == {'base': 'ami-base', 'copy': 'ami-base',
+                       'app': 'ami-app'}
@@ -0,0 +1,161 @@
+import io
+import os
+import pytest
+
+from unittest.mock import MagicMock, patch
+
+from docker2ami import preflight
+from docker2ami.config import AwsConfig, parse_duration
+from docker2ami.docker2ami import create_config_parser
+
+
+DOCKERFILE = '''FROM ubuntu:18.04
+COPY hello.c /opt/
+COPY images/*.png /opt/images/
+ADD missing.tar.gz /srv
+# AWS-SKIP
+COPY skipped /skipped
+ADD https://example.com/tool.sh /usr/bin/tool.sh
+COPY $FOO/bar /bar
+COPY ../outside /outside
+COPY "images/apple.jpg" /opt/
+COPY *.py /opt/
+'''
+
+
+@pytest.fixture(scope='function')
+def context_dir():
+    return os.path.join(os.path.dirname(__file__), 'fixtures/archive')
+
+
+def test_check_context(context_dir):
+    assert preflight.check_context(io.StringIO(DOCKERFILE), context_dir) == [
+        'COPY/ADD source is missing from the build context: missing.tar.gz',
+        'COPY/ADD source is outside of the build context: ../outside',
+        'COPY/ADD source is missing from the build context: *.py',
+    ]
+
+
+@pytest.fixture(scope='function')
+def aws_config():
+    config = create_config_parser()
+    config.set('main', 'security_group_ids', '["sg-1", "sg-2"]')
+    config.set('main', 'subnet_id', 'subnet-1')
+    return AwsConfig(config, 'main', object())
+
+
+def test_check_config(aws_config):
+    assert preflight.check_config(aws_config) == []
+    aws_config.security_group_ids = '[sg-1]'
+    aws_config.host_tags = '[{"Key": "a"}]'
+    aws_config.cache_volume_size = '0'
+    aws_config.log_tail_lines = 'ten'
+    aws_config.retry_mode = 'never'
+    problems = preflight.check_config(aws_config)
+    assert len(problems) == 5
+    assert problems[0].startswith('security_group_ids is not valid JSON')
+    assert problems[1] == ('host_tags must be a list of {"Key", "Value"} '
+                           'tags: [{"Key": "a"}]')
+    assert problems[2] == \
+        'log_tail_lines must be an integer of at least 0: ten'
+    assert problems[3] == \
+        'cache_volume_size must be an integer of at least 1: 0'
+    assert problems[4] == \
+        'retry_mode must be one of legacy, standard, adaptive: never'
+
+
+def test_check_config_durations(aws_config):
+    assert parse_duration('90') == 90
+    assert parse_duration('90s') == 90
+    assert parse_duration(' 30m ') == 1800
+    assert parse_duration('2h') == 7200
+    with pytest.raises(ValueError):
+        parse_duration('2 hours')
+    aws_config.step_timeout = '2h'
+    aws_config.idle_timeout = '5 min'
+    assert preflight.check_config(aws_config) == [
+        'idle_timeout must be a duration such as 90s, 30m or 2h: 5 min']
+
+
+def test_check_config_root_volume(aws_config):
+    aws_config.root_volume_size = '100'
+    aws_config.root_volume_type = 'gp3'
+    assert preflight.check_config(aws_config) == []
+    aws_config.root_volume_iops = '-1'
+    aws_config.root_volume_type = 'ssd'
+    assert preflight.check_config(aws_config) == [
+        'root_volume_iops must be an integer of at least 0: -1',
+        'root_volume_type must be one of gp2, gp3, io1, io2, st1, sc1, '
+        'standard: ssd']
+
+
+class NotFoundError(Exception):
+    """ Like the ClientError of botocore """
+    def __init__(self, code, message):
+        super().__init__(f'{code}: {message}')
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+def test_preflight_reports_all_problems(aws_config, context_dir, tmp_path):
+    dockerfile = tmp_path / 'Dockerfile'
+    dockerfile.write_text('COPY missing /opt/\n')
+    factory = MagicMock()
+    ec2 = factory.session.return_value.client.return_value
+    ec2.describe_images.side_effect = NotFoundError(
+        'InvalidAMIID.NotFound', "The image id '[ami-1]' does not exist")
+    ec2.describe_subnets.return_value = {'Subnets': [{}]}
+    ec2.describe_security_groups.return_value = {
+        'SecurityGroups': [{'GroupId': 'sg-1'}]}
+    ec2.describe_instance_types.side_effect = IOError('Timeout')
+    assert preflight.preflight(str(dockerfile), aws_config, context_dir,
+                               factory) == [
+        'COPY/ADD source is missing from the build context: missing',
+        "Invalid AMI: The image id '[ami-1]' does not exist",
+        'Security groups do not exist in us-west-1: sg-2',
+        'Unable to check the instance type: Timeout',
+    ]
+    factory.session.assert_called_with(aws_config)
+    ec2.describe_subnets.assert_called_with(SubnetIds=['subnet-1'])
+
+
+@patch('docker2ami.preflight.logger')
+def test_preflight_skips_unauthorized_checks(logger, aws_config, context_dir,
+                                             tmp_path):
+    dockerfile = tmp_path / 'Dockerfile'
+    dockerfile.write_text('COPY hello.c /opt/\n')
+    factory = MagicMock()
+    ec2 = factory.session.return_value.client.return_value
+    ec2.describe_images.side_effect = NotFoundError(
+        'UnauthorizedOperation', 'You are not authorized to perform this '
+        'operation.')
+    ec2.describe_subnets.side_effect = NotFoundError(
+        'InvalidSubnetID.Malformed', 'Invalid id: "subnet-1"')
+    ec2.describe_security_groups.side_effect = NotFoundError(
+        'AccessDenied', 'Access denied')
+    ec2.describe_instance_types.side_effect = NotFoundError(
+        'InvalidInstanceType', 'The following supplied instance types do '
+        'not exist: [t9.huge]')
+    assert preflight.preflight(str(dockerfile), aws_config, context_dir,
+                               factory) == [
+        'Invalid subnet: Invalid id: "subnet-1"',
+        'Invalid instance type: The following supplied instance types do '
+        'not exist: [t9.huge]']
+    assert sorted(c[0][0] for c in logger.warning.call_args_list) == [
+        'Skipped the check of the AMI: UnauthorizedOperation: You are not '
+        'authorized to perform this operation.',
+        'Skipped the check of the security groups: AccessDenied: Access '
+        'denied']
+
+
+def test_preflight_without_aws(aws_config, context_dir, tmp_path):
+    dockerfile = tmp_path / 'Dockerfile'
+    dockerfile.write_text('COPY hello.c /opt/\n')
+    assert preflight.preflight(str(dockerfile), aws_config,
+                               context_dir) == []
+    factory = MagicMock()
+    aws_config.image_tags = '{}'
+    assert preflight.preflight(str(dockerfile), aws_config, context_dir,
+                               factory) == [
+        'image_tags must be a list of {"Key", "Value"} tags: {}']
+    # The AWS clients need a valid configuration
+    assert not factory.session.called
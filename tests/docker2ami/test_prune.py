@@ -0,0 +1,116 @@
+import datetime
+import threading
+import time
+
+from unittest.mock import MagicMock
+
+from docker2ami import prune
+
+
+NOW = datetime.datetime(2020, 1, 10)
+
+
+def _image(image_id, day, snapshot_ids=(), tags=(), name='app'):
+    return {
+        'ImageId': image_id,
+        'Name': f'{name}-202001{day:02}000000',
+        'CreationDate': f'2020-01-{day:02}T00:00:00.000Z',
+        'BlockDeviceMappings': [
+            {'DeviceName': '/dev/sda1', 'Ebs': {'SnapshotId': snapshot_id}}
+            for snapshot_id in snapshot_ids
+        ] + [{'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'}],
+        'Tags': [{'Key': key, 'Value': value} for key, value in tags],
+    }
+
+
+def test_find_images():
+    ec2 = MagicMock()
+    ec2.describe_images.return_value = {'Images': [
+        _image('ami-1', 1), _image('ami-3', 3), _image('ami-2', 2),
+        _image('ami-4', 4, name='app-server'),
+        dict(_image('ami-5', 5), Name='app-manual')]}
+    assert [image['ImageId'] for image in prune.find_images(ec2, 'app')] == \
+        ['ami-3', 'ami-2', 'ami-1']
+    ec2.describe_images.assert_called_with(Owners=['self'], Filters=[
+        {'Name': 'name', 'Values': ['app-*']},
+        {'Name': 'state', 'Values': ['available']}])
+
+
+def test_parse_protected_tag():
+    assert prune.parse_protected_tag('keep') == ('keep', None)
+    assert prune.parse_protected_tag('env=prod') == ('env', 'prod')
+    assert prune.parse_protected_tag('env=') == ('env', '')
+
+
+def test_plan_prune():
+    images = [
+        _image('ami-9', 9), _image('ami-8', 8), _image('ami-7', 7),
+        _image('ami-6', 6, tags=[('env', 'prod')]),
+        _image('ami-5', 5, tags=[('env', 'dev')]),
+        _image('ami-4', 4, tags=[('keep', 'yes')]), _image('ami-3', 3)]
+    plan = prune.plan_prune(images, 2, datetime.timedelta(days=3.5),
+                            [('env', 'prod'), ('keep', None)], NOW)
+    assert [(image['ImageId'], reason) for image, reason in plan] == [
+        ('ami-9', 'newest 2'), ('ami-8', 'newest 2'), ('ami-7', 'too young'),
+        ('ami-6', 'protected'), ('ami-5', None), ('ami-4', 'protected'),
+        ('ami-3', None)]
+    assert all(reason is None
+               for image, reason in prune.plan_prune(images, 0, now=NOW))
+
+
+def test_pruned_snapshots_leaves_kept_ones():
+    plan = [(_image('ami-2', 2, ['snap-2', 'snap-shared']), 'newest 1'),
+            (_image('ami-1', 1, ['snap-1', 'snap-shared']), None),
+            (_image('ami-0', 0), None)]
+    assert prune.pruned_snapshots(plan) == {'ami-1': ['snap-1'],
+                                            'ami-0': []}
+
+
+def test_prune_images():
+    ec2 = MagicMock()
+    plan = [(_image('ami-3', 3, ['snap-3']), 'newest 1'),
+            (_image('ami-2', 2, ['snap-2a', 'snap-2b']), None),
+            (_image('ami-1', 1, ['snap-1']), None)]
+    assert prune.prune_images(ec2, plan) == []
+    assert sorted(call[1]['ImageId']
+                  for call in ec2.deregister_image.call_args_list) == \
+        ['ami-1', 'ami-2']
+    assert sorted(call[1]['SnapshotId']
+                  for call in ec2.delete_snapshot.call_args_list) == \
+        ['snap-1', 'snap-2a', 'snap-2b']
+
+
+def test_prune_images_reports_problems():
+    ec2 = MagicMock()
+
+    def deregister_image(ImageId):
+        if ImageId == 'ami-1':
+            raise Exception('InvalidAMIID.Unavailable')
+    ec2.deregister_image.side_effect = deregister_image
+    ec2.delete_snapshot.side_effect = Exception('InvalidSnapshot.InUse')
+    plan = [(_image('ami-2', 2, ['snap-2']), None),
+            (_image('ami-1', 1, ['snap-1']), None)]
+    assert prune.prune_images(ec2, plan) == [
+        'Unable to delete snapshot snap-2 of ami-2: InvalidSnapshot.InUse',
+        'Unable to deregister ami-1: InvalidAMIID.Unavailable']
+    ec2.delete_snapshot.assert_called_once_with(SnapshotId='snap-2')
+
+
+def test_prune_images_runs_workers_at_a_time():
+    running = []
+    most = []
+    lock = threading.Lock()
+
+    def deregister_image(ImageId):
+        with lock:
+            running.append(ImageId)
+            most.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(ImageId)
+    ec2 = MagicMock()
+    ec2.deregister_image.side_effect = deregister_image
+    plan = [(_image(f'ami-{day}', day), None) for day in range(1, 9)]
+    prune.prune_images(ec2, plan, workers=3)
+    assert ec2.deregister_image.call_count == 8
+    assert max(most) == 3
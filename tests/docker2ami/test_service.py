@@ -0,0 +1,184 @@
+import http.client
+import json
+import os
+import pytest
+import threading
+import time
+
+from argparse import Namespace
+from unittest.mock import MagicMock, patch
+
+from docker2ami import service
+from docker2ami.ami_builder import AwsConfig
+from docker2ami.docker2ami import create_config_parser
+
+
+def _job(job_id, priority=0, region='us-west-1', key='AKIA1'):
+    aws_config = Namespace(aws_access_key_id=key, region=region,
+                           instance_type='m5.large', log_file='')
+    return service.Job(job_id, '/src', aws_config, priority)
+
+
+class TestJobQueue(object):
+    def test_priority_then_order(self):
+        queue = service.JobQueue()
+        for job in (_job('a'), _job('b', 5), _job('c'), _job('d', 5)):
+            queue.put(job)
+        assert [queue.get().id for i in range(4)] == ['b', 'd', 'a', 'c']
+
+    def test_limits_skip_jobs(self):
+        queue = service.JobQueue(max_per_account=2, max_per_region=1)
+        for job in (_job('a'), _job('b'), _job('c', region='eu-west-1'),
+                    _job('d', region='eu-north-1')):
+            queue.put(job)
+        first = queue.get()
+        assert first.id == 'a'
+        assert queue.get().id == 'c'
+        # The account has two running jobs and us-west-1 one
+        assert queue._next() is None
+        queue.done(first)
+        assert queue.get().id == 'b'
+
+    def test_get_waits_for_a_job(self):
+        queue = service.JobQueue()
+        jobs = []
+        thread = threading.Thread(target=lambda: jobs.append(queue.get()))
+        thread.start()
+        queue.put(_job('a'))
+        thread.join(5)
+        assert [job.id for job in jobs] == ['a']
+
+    def test_remove_and_close(self):
+        queue = service.JobQueue()
+        a, b = _job('a'), _job('b')
+        queue.put(a)
+        queue.put(b)
+        assert queue.remove(a)
+        assert not queue.remove(a)
+        assert queue.close() == [b]
+        assert queue.get() is None
+
+
+@pytest.fixture(scope='function')
+def build_service(request, tmp_path):
+    config = create_config_parser()
+    config.set('main', 'aws_access_key_id', 'AKIA1')
+    config.set('main', 'aws_secret_access_key', 'secret')
+    context = tmp_path / 'context'
+    context.mkdir()
+    (context / 'Dockerfile').write_text('FROM centos:7\n')
+    request.cls.context = str(context)
+    request.cls.jobs_dir = tmp_path / 'jobs'
+    request.cls.build = MagicMock(return_value='ami-1')
+    request.cls.service = service.BuildService(
+        config, request.cls.build, str(request.cls.jobs_dir), 1)
+
+
+@pytest.mark.usefixtures('build_service')
+class TestBuildService(object):
+    def test_submit_configures_job(self):
+        job = self.service.submit(self.context, 3, {
+            'region': 'eu-west-1', 'image_tags': [{'Key': 'a', 'Value': 'b'}]
+        }, True)
+        job_dir = self.jobs_dir / job.id
+        assert job_dir.is_dir()
+        assert job.priority == 3
+        assert job.direct_copy
+        assert isinstance(job.aws_config, AwsConfig)
+        assert job.aws_config.region == 'eu-west-1'
+        assert job.aws_config.image_tags == '[{"Key": "a", "Value": "b"}]'
+        assert job.aws_config.tmp_dir == str(job_dir)
+        assert job.aws_config.log_file == str(job_dir / 'build.log')
+        assert self.service.jobs() == [job]
+
+    def test_submit_checks_job(self):
+        with pytest.raises(ValueError):
+            self.service.submit(os.path.dirname(self.context))
+        with pytest.raises(ValueError):
+            self.service.submit(self.context, config={'no_such_key': 'x'})
+        with pytest.raises(ValueError):
+            self.service.submit(self.context,
+                                config={'aws_access_key_id': ''})
+        assert self.service.jobs() == []
+
+    def test_runs_jobs_with_sessions_of_factory(self):
+        with patch.object(self.service, '_sessions') as factory:
+            jobs = [self.service.submit(self.context) for i in range(2)]
+            self.service.start()
+            for i in range(500):
+                if jobs[1].finished:
+                    break
+                time.sleep(0.01)
+            self.service.stop()
+        assert [job.state for job in jobs] == [service.SUCCEEDED] * 2
+        assert [job.image_id for job in jobs] == ['ami-1'] * 2
+        factory.session.assert_called_with(jobs[1].aws_config)
+        self.build.assert_called_with(jobs[1].aws_config, self.context,
+                                      False, factory.session.return_value)
+
+    def test_failed_jobs(self):
+        self.build.side_effect = [SystemExit(2), RuntimeError('No EC2')]
+        jobs = [self.service.submit(self.context) for i in range(2)]
+        self.service._run(jobs[0])
+        self.service._run(jobs[1])
+        assert [job.state for job in jobs] == [service.FAILED] * 2
+        assert jobs[0].error == 'Exited with code 2'
+        assert jobs[1].error == 'No EC2'
+
+    def test_cancel(self):
+        job = self.service.submit(self.context)
+        assert self.service.cancel(job.id)
+        assert job.state == service.CANCELLED
+        assert not self.service.cancel(job.id)
+        assert not self.service.cancel('missing')
+
+    def test_stop_cancels_queued_jobs(self):
+        job = self.service.submit(self.context)
+        self.service.stop()
+        assert job.state == service.CANCELLED
+
+
+@pytest.mark.usefixtures('build_service')
+class TestApi(object):
+    def setup(self):
+        self.server = None
+
+    def teardown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _request(self, method, path, body=None):
+        if not self.server:
+            self.server = service.create_server(self.service,
+                                                ('127.0.0.1', 0))
+            threading.Thread(target=self.server.serve_forever,
+                             daemon=True).start()
+        conn = http.client.HTTPConnection(*self.server.server_address)
+        conn.request(method, path, body and json.dumps(body))
+        response = conn.getresponse()
+        result = response.status, json.loads(str(response.read(), 'utf8'))
+        conn.close()
+        return result
+
+    def test_job_round_trip(self):
+        status, job = self._request('POST', '/jobs', {
+            'context': self.context, 'priority': 2,
+            'config': {'region': 'eu-west-1'}})
+        assert status == 202
+        assert job['state'] == 'queued'
+        assert job['priority'] == 2
+        assert self._request('GET', f'/jobs/{job["id"]}') == (200, job)
+        assert self._request('GET', '/jobs') == (200, [job])
+
+        status, cancelled = self._request('DELETE', f'/jobs/{job["id"]}')
+        assert status == 200
+        assert cancelled['state'] == 'cancelled'
+        assert self._request('DELETE', f'/jobs/{job["id"]}')[0] == 409
+
+    def test_errors(self):
+        assert self._request('POST', '/jobs', {})[0] == 400
+        assert self._request('POST', '/jobs', {'context': 'rel'})[0] == 400
+        assert self._request('POST', '/builds', {})[0] == 404
+        assert self._request('GET', '/jobs/missing')[0] == 404
+        assert self._request('DELETE', '/jobs/missing')[0] == 404
@@ -0,0 +1,58 @@
+from argparse import Namespace
+from unittest.mock import patch
+
+from docker2ami import sessions
+
+
+def _aws_config(key='AKIA1', region='us-west-1', pool='10', limit='20'):
+    return Namespace(aws_access_key_id=key, aws_secret_access_key='secret',
+                     region=region, max_pool_connections=pool,
+                     retry_mode='adaptive', api_rate_limit=limit)
+
+
+@patch('docker2ami.sessions.boto3')
+def test_factory_caches_sessions(boto3):
+    factory = sessions.SessionFactory()
+    session = factory.session(_aws_config())
+    assert factory.session(_aws_config()) is session
+    assert factory.session(_aws_config(region='eu-west-1')) is not session
+    assert factory.session(_aws_config(pool='50')) is not session
+    boto3.session.Session.assert_called_with(
+        aws_access_key_id='AKIA1', aws_secret_access_key='secret',
+        region_name='us-west-1')
+    assert boto3.session.Session.call_count == 3
+
+
+@patch('docker2ami.sessions.boto3')
+def test_clients_are_shared(boto3):
+    session = sessions.SessionFactory().session(_aws_config(pool='50'))
+    ec2 = session.client('ec2')
+    assert session.client('ec2') is ec2
+    resource = session.resource('ec2')
+    assert session.resource('ec2') is resource
+    assert resource.meta.client is ec2
+    boto3_session = boto3.session.Session.return_value
+    assert boto3_session.client.call_count == 1
+    assert boto3_session.resource.call_count == 1
+    config = boto3_session.resource.call_args[1]['config']
+    assert boto3_session.client.call_args[1]['config'] is config
+    assert config.max_pool_connections == 50
+    assert config.retries == {'mode': 'adaptive', 'max_attempts': 10}
+
+
+@patch('docker2ami.sessions.instrument')
+@patch('docker2ami.sessions.boto3')
+def test_sessions_share_rate_limiter(boto3, instrument):
+    factory = sessions.SessionFactory()
+    session = factory.session(_aws_config())
+    session.resource('ec2')
+    session.client('ec2')
+    limiter = instrument.call_args[0][2]
+    assert [call[0][1:] for call in instrument.call_args_list] == [
+        (session.metrics, limiter)]
+    factory.session(_aws_config(pool='50')).client('ec2')
+    assert instrument.call_args[0][2] is limiter
+    factory.session(_aws_config(region='eu-west-1')).client('ec2')
+    assert instrument.call_args[0][2] is not limiter
+    factory.session(_aws_config(limit='0')).client('ec2')
+    assert instrument.call_args[0][2] is None
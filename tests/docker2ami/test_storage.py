@@ -0,0 +1,41 @@
+from argparse import Namespace
+from unittest.mock import MagicMock
+
+from docker2ami import storage
+
+
+def _aws_config(**kwargs):
+    config = {'image_id': 'ami-1', 'root_volume_size': '0',
+              'root_volume_type': '', 'root_volume_iops': '0',
+              'root_volume_throughput': '0'}
+    config.update(kwargs)
+    return Namespace(**config)
+
+
+def test_block_device_mappings():
+    ec2 = MagicMock()
+    ec2.describe_images.return_value = {
+        'Images': [{'RootDeviceName': '/dev/xvda'}]}
+    assert storage.block_device_mappings(ec2, _aws_config()) == []
+    assert not ec2.describe_images.called
+    assert storage.block_device_mappings(ec2, _aws_config(
+        root_volume_size='100', root_volume_type='gp3',
+        root_volume_throughput='500')) == [
+        {'DeviceName': '/dev/xvda',
+         'Ebs': {'VolumeSize': 100, 'VolumeType': 'gp3', 'Throughput': 500,
+                 'DeleteOnTermination': True}}]
+    ec2.describe_images.assert_called_with(ImageIds=['ami-1'])
+
+
+def test_commands():
+    mount = storage.scratch_mount_cmd()
+    assert f'mount -o noatime $dev {storage.SCRATCH_DIR}' in mount
+    assert f'mkdir -p {storage.SCRATCH_DIR}/context' in mount
+    assert storage.scratch_unmount_cmd().endswith(
+        f'rm -rf {storage.SCRATCH_DIR}')
+    prewarm = storage.prewarm_cmd(4)
+    assert prewarm.startswith('setsid nohup sh -c ')
+    assert prewarm.endswith(' &')
+    assert 'for i in $(seq 0 3)' in prewarm
+    assert f'touch {storage.PREWARM_MARKER}' in prewarm
+    assert storage.PREWARM_MARKER in storage.prewarm_wait_cmd()
@@ -0,0 +1,106 @@
+import io
+
+from unittest.mock import patch
+
+from docker2ami.build_log import BuildLog
+from docker2ami.color import Color
+from docker2ami.tty_renderer import TtyRenderer
+
+
+def _renderer(fp):
+    # Only close() draws at this rate
+    return TtyRenderer(fp, fps=0.001, output_lines=2)
+
+
+def test_shows_running_steps_with_last_lines():
+    fp = io.StringIO()
+    target = _renderer(fp)
+    target.emit('build_started', source_dir='.')
+    target.emit('step_started', step=3, command='make\n  all')
+    target.emit('output', step=3, text='one\ntwo\nthr')
+    target.emit('output', step=3, text='ee\n\x1b[1mfo\tur\x1b[0m\n')
+    target.emit('step_started', step=4, command='make docs')
+    target.close()
+    lines = fp.getvalue().split('\n')
+    assert lines[0].startswith('[+] Building ')
+    assert lines[1].startswith(' => [step 3] make all ')
+    assert lines[2:4] == [f'    {Color.DARK_GREY}three{Color.CLEAR}',
+                          f'    {Color.DARK_GREY}fo      ur{Color.CLEAR}']
+    assert lines[4].startswith(' => [step 4] make docs ')
+    assert lines[5:] == ['']
+
+
+def test_finished_steps_scroll_up_and_failed_ones_expand():
+    fp = io.StringIO()
+    target = _renderer(fp)
+    target.emit('step_started', step=1, command='true')
+    target.emit('step_finished', step=1, exit_code=0, duration=1.25)
+    target.emit('step_started', step=2, command='make')
+    target.emit('output', step=2, text='a\nb\nc\nError 1\n')
+    target.emit('step_finished', step=2, exit_code=2, duration=3)
+    target.emit('build_finished', status='failed', error='exit code 2',
+                duration=4)
+    target.close()
+    lines = fp.getvalue().split('\n')
+    assert lines[:6] == [
+        '=> [step 1] true 1.2s',
+        f'{Color.RED}=> [step 2] make failed with exit code 2 after 3.0s'
+        f'{Color.CLEAR}',
+        f'{Color.YELLOW}a{Color.CLEAR}', f'{Color.YELLOW}b{Color.CLEAR}',
+        f'{Color.YELLOW}c{Color.CLEAR}',
+        f'{Color.YELLOW}Error 1{Color.CLEAR}']
+    assert lines[6].startswith(f'{Color.RED}[+] Failed: exit code 2 ')
+
+
+def test_failed_steps_expand_with_tail_without_log():
+    fp = io.StringIO()
+    target = TtyRenderer(fp, fps=0.001, output_lines=2, tail_lines=3)
+    target.emit('step_started', step=2, command='make')
+    for i in range(1000):
+        target.emit('output', step=2, text=f'line {i}\n')
+    assert target._running[2].tail(5) == ['line 997', 'line 998', 'line 999']
+    target.emit('output', step=2, text='x' * 10000)
+    assert target._running[2].tail(1) == ['x' * 4096]
+    target.emit('step_finished', step=2, exit_code=2, duration=3)
+    target.close()
+    lines = fp.getvalue().split('\n')
+    assert lines[1:4] == [f'{Color.YELLOW}line 998{Color.CLEAR}',
+                          f'{Color.YELLOW}line 999{Color.CLEAR}',
+                          f'{Color.YELLOW}{"x" * 4096}{Color.CLEAR}']
+
+
+def test_failed_steps_expand_with_build_log(tmp_path):
+    log_path = str(tmp_path / 'build.log')
+    build_log = BuildLog(log_path, 'w')
+    fp = io.StringIO()
+    target = TtyRenderer(fp, fps=0.001, output_lines=2, log_file=log_path,
+                         tail_lines=3)
+    target.emit('step_started', step=2, command='make')
+    for i in range(100):
+        build_log.write(2, f'line {i}\n'.encode('utf8'))
+        target.emit('output', step=2, text=f'line {i}\n')
+    build_log.flush(2)
+    target.emit('step_finished', step=2, exit_code=2, duration=3)
+    target.close()
+    build_log.close()
+    lines = fp.getvalue().split('\n')
+    assert lines[1:101] == [f'{Color.YELLOW}line {i}{Color.CLEAR}'
+                            for i in range(100)]
+    assert lines[101].startswith('[+] ')
+
+
+@patch('docker2ami.tty_renderer.TtyRenderer._width')
+def test_redraws_status_area_in_place(width):
+    width.return_value = 30
+    fp = io.StringIO()
+    target = _renderer(fp)
+    target.emit('step_started', step=1, command='x' * 100)
+    target.emit('output', step=1, text='y' * 100 + '\n')
+    target._draw()
+    first = fp.getvalue()
+    assert all(len(line) < 30 for line in first.split('\n')
+               if Color.DARK_GREY not in line)
+    target.emit('step_finished', step=1, exit_code=0, duration=1)
+    target.close()
+    # The three lines of the status area are erased before the next frame
+    assert fp.getvalue()[len(first):].startswith('\033[3F\033[J')